@@ -0,0 +1 @@
+"""Performance benchmarks for Hosebeast. See benchmarks/README.md."""
@@ -0,0 +1,144 @@
+#! /usr/bin/env python3
+"""
+Check and time leak and sensor-fault detection in `hosebeast.anomaly`.
+
+Replays sensor faults through the same path as the live controller: a
+simulated ADS1115 read through the default filter chain, into
+`Controller.sample()` and `Controller.detect()`. Each case settles for half
+an hour with every pump off, then shifts the sensor's output by a step
+(or gives it one bad read) and watches for half an hour more, at both the
+fast and slow read intervals. A step of at least `jump_cm` must raise one
+`sensor_jump` alert of about its size and no `leak`. A smaller step must
+raise no `sensor_jump` (a sudden drop may fairly raise a `leak`: the water
+went somewhere), and a single bad read nothing at all. Then times
+`detect()` per reading.
+
+    python -m benchmarks.bench_anomaly [--save-baseline]
+"""
+
+import argparse
+import sys
+from datetime import datetime
+
+from hosebeast.anomaly import LEAK, SENSOR_JUMP, DetectionPolicy
+from hosebeast.calibration import CalibrationTable
+from hosebeast.controller import Controller
+from hosebeast.filters import DEFAULT_CHAIN, FilteredChannel, parse_chain
+from hosebeast.sampling import SamplingPolicy
+from hosebeast.simulation import SensorModel, Simulation
+
+from .harness import Result, add_arguments, measure, report
+
+# Sensor steps in cm, either side of DetectionPolicy.jump_cm with room for
+# noise; None is a single bad read instead
+STEPS = [1.0, -1.0, 2.5, -2.5, 3.5, -3.5, 5.0, -5.0, 10.0, -10.0, 40.0, None]
+READ_SECS = [SamplingPolicy.fast_secs, SamplingPolicy.slow_secs]
+SETTLE_SECS = 30 * 60
+WATCH_SECS = 30 * 60
+# How far the reported jump may be from the step, for sensor noise
+JUMP_TOLERANCE_CM = 0.5
+
+
+def build(seed: int) -> tuple[Simulation, Controller]:
+    """A controller reading a simulated tank through the default chain"""
+    sim = Simulation(start=datetime(2024, 6, 1), seed=seed)
+    # Flat, so the level only changes when a case changes it
+    sim.tank.refill_cm_per_min = sim.tank.evaporation_cm_per_day = 0.0
+    channel = sim.channel(0, gain=1.0)
+    sensor = FilteredChannel(channel, parse_chain(DEFAULT_CHAIN), clock=sim.clock.time)
+    controller = Controller(sensor)
+    controller.calibrations = CalibrationTable({1.0: sim.sensor.calibration()})
+    return sim, controller
+
+
+def replay(sim: Simulation, controller: Controller, secs: float, read_secs: float):
+    """Read every `read_secs` for `secs`; returns the alerts raised or cleared"""
+    alerts = []
+    end = sim.clock.time() + secs
+    while sim.clock.time() < end:
+        sim.clock.advance(read_secs)
+        controller.sample()
+        alerts += controller.detect(sim.clock.time())
+    return alerts
+
+
+def check_case(step: float | None, read_secs: float, seed: int) -> list[str]:
+    sim, controller = build(seed)
+    fault = "bad read" if step is None else f"{step:+g} cm step"
+    name = f"{fault} every {read_secs:g}s"
+    settled = replay(sim, controller, SETTLE_SECS, read_secs)
+    if settled:
+        return [f"{name}: {len(settled)} alert(s) before the step"]
+    sensor = sim.sensor
+    if step is None:
+        sensor.spike_probability = 1.0
+        replay(sim, controller, read_secs, read_secs)
+        sensor.spike_probability = SensorModel.spike_probability
+    else:
+        sensor.zero_volts += step * sensor.volts_per_cm
+    raised = [
+        alert
+        for alert in replay(sim, controller, WATCH_SECS, read_secs)
+        if alert.raised
+    ]
+    kinds = [alert.kind for alert in raised]
+
+    if step is None:
+        return [f"{name}: raised {kinds}"] if raised else []
+    if abs(step) < DetectionPolicy.jump_cm:
+        allowed = [LEAK] if step < 0 else []
+        return [f"{name}: raised {kinds}"] if set(kinds) - set(allowed) else []
+    if LEAK in kinds:
+        return [f"{name}: false leak alert"]
+    if kinds != [SENSOR_JUMP]:
+        return [f"{name}: raised {kinds}, expected one {SENSOR_JUMP}"]
+    if abs(raised[0].value - step) > JUMP_TOLERANCE_CM:
+        return [f"{name}: reported {raised[0].message!r}"]
+    return []
+
+
+def check_correctness(seed: int) -> list[str]:
+    failures = []
+    checked = 0
+    for read_secs in READ_SECS:
+        for step in STEPS:
+            failures += check_case(step, read_secs, seed)
+            checked += 1
+    print(f"Checked {checked} sensor fault cases; {len(failures)} failures")
+    return failures
+
+
+def time_detection(repeat: int, seed: int) -> list[Result]:
+    sim, controller = build(seed)
+    replay(sim, controller, SETTLE_SECS, SamplingPolicy.fast_secs)
+    batch = 1000
+
+    def readings(i: int):
+        for _ in range(batch):
+            sim.clock.advance(SamplingPolicy.fast_secs)
+            controller.sample()
+            controller.detect(sim.clock.time())
+
+    return [measure(f"sample+detect[x{batch}]", readings, repeat=repeat)]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    failures = check_correctness(args.seed)
+    status = report("anomaly", time_detection(args.repeat, args.seed), args)
+
+    if failures:
+        print(f"\n{len(failures)} failure(s):")
+        for failure in failures:
+            print(f"  {failure}")
+        return 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,201 @@
+#! /usr/bin/env python3
+"""
+Check and time the scheduling math in `hosebeast.scheduling`.
+
+Sweeps start times, durations (including ones longer than the repeat
+interval), intervals and units across ordinary days and DST transitions,
+comparing `calculate_next_relay_times` and `even_minute` against brute-force
+oracles. Then times both, and fails if the per-call cost of
+`calculate_next_relay_times` grows with the number of intervals that have
+elapsed since the day's start time.
+
+    python -m benchmarks.bench_scheduling [--save-baseline]
+"""
+
+import argparse
+import itertools
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from hosebeast.scheduling import calculate_next_relay_times, even_minute, repeat_step
+
+from .harness import Result, add_arguments, measure, report
+
+# Local-time zones to run the sweep in; naive datetimes are local times,
+# so the DST transitions below only matter in zones that have them
+TIMEZONES = ["UTC", "America/Los_Angeles", "Europe/London", "Australia/Sydney"]
+
+# Days with a DST transition in at least one of TIMEZONES, plus ordinary days
+SWEEP_DAYS = [
+    datetime(2024, 3, 10),  # US spring forward
+    datetime(2024, 3, 31),  # EU spring forward
+    datetime(2024, 4, 7),  # Sydney falls back
+    datetime(2024, 10, 6),  # Sydney springs forward
+    datetime(2024, 10, 27),  # EU fall back
+    datetime(2024, 11, 3),  # US fall back
+    datetime(2024, 6, 15),
+    datetime(2024, 12, 31),
+]
+
+START_TIMES = ["0:00", "2:30", "4:30", "23:45"]
+DURATIONS = [0, 15, 90, 24 * 60 + 5]
+# One-minute repeats are covered by the timing checks; walking them in
+# the oracle makes the sweep too slow
+REPEATS = [
+    (17, "minutes"),
+    (45, "minutes"),
+    (1, "hours"),
+    (5, "hours"),
+    (1, "days"),
+    (3, "days"),
+    (1, "weeks"),
+]
+
+
+def oracle_next_relay_times(
+    start_time: str,
+    duration_mins: int,
+    repeat_interval: int,
+    repeat_units: str,
+    now: datetime,
+) -> tuple[datetime, datetime]:
+    """
+    Walk the runs one at a time from before now and pick the answer by
+    definition: the earliest run containing now, else the next one.
+    """
+    hour, minute = map(int, start_time.split(":"))
+    base = datetime.combine(now.date(), datetime.min.time()).replace(
+        hour=hour, minute=minute
+    )
+    duration = timedelta(minutes=duration_mins)
+    step = repeat_step(repeat_interval, repeat_units)
+    run_start = base
+    while run_start + duration >= now:
+        run_start -= step
+    while True:
+        if run_start <= now <= run_start + duration or run_start > now:
+            return run_start, run_start + duration
+        run_start += step
+
+
+def sample_times(day: datetime, rng: random.Random) -> list[datetime]:
+    # Every 90 minutes through the day, plus random instants to the second
+    times = [day + timedelta(minutes=90 * i) for i in range(16)]
+    times += [day + timedelta(seconds=rng.randrange(86400)) for _ in range(8)]
+    return times
+
+
+def set_timezone(tz: str):
+    os.environ["TZ"] = tz
+    time.tzset()
+
+
+def check_correctness(rng: random.Random) -> list[str]:
+    failures = []
+    checked = 0
+    for tz in TIMEZONES:
+        set_timezone(tz)
+        for day in SWEEP_DAYS:
+            for now in sample_times(day, rng):
+                # even_minute: truncates to the minute, idempotent, never later
+                em = even_minute(now)
+                if not (
+                    em <= now < em + timedelta(minutes=1)
+                    and em.second == em.microsecond == 0
+                    and even_minute(em) == em
+                ):
+                    failures.append(f"{tz} even_minute({now}) = {em}")
+                # The timestamps we store must round-trip through local time
+                datetime.fromtimestamp(em.timestamp())
+
+                for start, dur, (interval, units) in itertools.product(
+                    START_TIMES, DURATIONS, REPEATS
+                ):
+                    got = calculate_next_relay_times(start, dur, interval, units, now)
+                    want = oracle_next_relay_times(start, dur, interval, units, now)
+                    checked += 1
+                    if got != want:
+                        failures.append(
+                            f"{tz} now={now} ({start}, {dur}m, every {interval} "
+                            f"{units}): got {got}, expected {want}"
+                        )
+    set_timezone("UTC")
+    print(f"Checked {checked} schedule cases; {len(failures)} failures")
+    return failures
+
+
+def check_flat_cost(repeat: int, max_growth: float) -> tuple[list[Result], list[str]]:
+    """
+    Time calculate_next_relay_times with 0 to ~1400 one-minute intervals
+    elapsed since today's start time. The slowest case must stay within
+    `max_growth` times the fastest.
+    """
+    results = []
+    day = datetime(2024, 6, 15)
+    batch = 200
+    for elapsed in [0, 10, 100, 1000, 1400]:
+        now = day + timedelta(minutes=elapsed, seconds=30)
+        results.append(
+            measure(
+                f"calculate_next_relay_times[{elapsed} intervals x{batch}]",
+                lambda i, now=now: [
+                    calculate_next_relay_times("0:00", 15, 1, "minutes", now)
+                    for _ in range(batch)
+                ],
+                repeat=repeat,
+            )
+        )
+    now = day + timedelta(hours=13, seconds=7, microseconds=5)
+    results.append(
+        measure(
+            f"even_minute[x{batch}]",
+            lambda i: [even_minute(now) for _ in range(batch)],
+            repeat=repeat,
+        )
+    )
+
+    p50s = [r.p50_ms for r in results if r.name.startswith("calculate_")]
+    growth = max(p50s) / min(p50s)
+    print(f"Per-call cost growth across interval counts: {growth:.2f}x\n")
+    failures = []
+    if growth > max_growth:
+        failures.append(
+            f"calculate_next_relay_times cost grows {growth:.2f}x with interval "
+            f"count (limit {max_growth:.2f}x)"
+        )
+    return results, failures
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--max-growth",
+        type=float,
+        default=2.0,
+        help="Allowed slowdown from fewest to most elapsed intervals",
+    )
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    failures = check_correctness(random.Random(args.seed))
+    results, cost_failures = check_flat_cost(args.repeat, args.max_growth)
+    failures += cost_failures
+    status = report("scheduling", results, args)
+
+    if failures:
+        print(f"\n{len(failures)} failure(s):")
+        for failure in failures[:20]:
+            print(f"  {failure}")
+        if len(failures) > 20:
+            print(f"  ... and {len(failures) - 20} more")
+        return 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+#! /usr/bin/env python3
+"""
+Benchmark the storage and chart query paths in `hosebeast.storage`:
+full-row and compact chart loads for every `VALID_TIME_RANGES` value,
+zoomed and panned chart windows from an hour to the whole dataset, depth
+inserts, range deletes and calibration lookups, over datasets from
+a week to five years of minute data.
+
+    python -m benchmarks.bench_storage [--datasets 1w,1m,1y,5y] [--save-baseline]
+"""
+
+import argparse
+import shutil
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from sqlite_utils import Database
+
+from hosebeast import storage
+from hosebeast.pressure_estimator import VALID_GAINS
+
+from .datasets import DATASET_DAYS, END, dataset_path, get_dataset
+from .harness import Result, add_arguments, measure, report
+
+VIEW_SPANS = {
+    "1h": timedelta(hours=1),
+    "1d": timedelta(days=1),
+    "1w": timedelta(weeks=1),
+    "90d": timedelta(days=90),
+    "all": timedelta(days=10 * 365),
+}
+
+
+def bench_dataset(name: str, repeat: int, workdir: Path) -> list[Result]:
+    results = []
+    db = get_dataset(name)
+    for time_range in storage.VALID_TIME_RANGES:
+        results.append(
+            measure(
+                f"{name}/load_water_depth_data[{time_range}]",
+                lambda i, time_range=time_range: storage.load_water_depth_data(
+                    time_range, now=END, db=db
+                ),
+                repeat=repeat,
+            )
+        )
+        results.append(
+            measure(
+                f"{name}/load_depth_chart[{time_range}]",
+                lambda i, time_range=time_range: storage.load_depth_chart(
+                    time_range, now=END, db=db
+                ),
+                repeat=repeat,
+            )
+        )
+    # Zoom and pan should cost about the same whatever the window
+    earliest = datetime.fromtimestamp(storage.earliest_depth_time(db))
+    for label, span in VIEW_SPANS.items():
+        span = min(span, END - earliest)
+        for where, end in (
+            ("latest", END),
+            ("middle", earliest + (END - earliest) / 2),
+        ):
+            start = max(earliest, end - span)
+            results.append(
+                measure(
+                    f"{name}/load_depth_range[{label}, {where}]",
+                    lambda i, start=start, end=end: storage.load_depth_range(
+                        start.timestamp(), end.timestamp(), db=db
+                    ),
+                    repeat=repeat,
+                )
+            )
+    db.close()
+
+    # Writes go to a scratch copy so the cached dataset stays pristine
+    scratch_path = workdir / f"{name}.db"
+    shutil.copy(dataset_path(name), scratch_path)
+    scratch = Database(scratch_path)
+
+    def insert(i: int):
+        when = END + timedelta(minutes=i + 1)
+        storage.store_water_depth(
+            {
+                "timestamp": when.timestamp(),
+                "datetime": when.isoformat(),
+                "raw_value": 12000,
+                "water_depth": 50.0,
+            },
+            db=scratch,
+        )
+
+    results.append(measure(f"{name}/store_water_depth", insert, repeat=repeat * 5))
+
+    def delete_day(i: int):
+        end = END - timedelta(days=i + 1)
+        storage.delete_db_range(end - timedelta(days=1), end, db=scratch)
+
+    # Each call deletes a different day, so the dataset needs enough of them
+    delete_repeat = min(repeat, DATASET_DAYS[name] - 2)
+    results.append(measure(f"{name}/delete_db_range[1 day]", delete_day, delete_repeat))
+
+    add_calibration_history(scratch)
+    results.append(
+        measure(
+            f"{name}/calibration_points",
+            lambda i: storage.calibration_points(1.0, db=scratch),
+            repeat=repeat,
+        )
+    )
+    results.append(
+        measure(
+            f"{name}/latest_calibration",
+            lambda i: storage.latest_calibration(db=scratch),
+            repeat=repeat,
+        )
+    )
+    scratch.close()
+    return results
+
+
+def add_calibration_history(db: Database, points_per_gain: int = 50):
+    """A plausible few years of recalibrating at every gain"""
+    when = END - timedelta(days=3 * 365)
+    for i in range(points_per_gain):
+        for gain in VALID_GAINS:
+            when += timedelta(minutes=1)
+            storage.store_calibration_point(when, 10000 + i * 100, i * 2.0, gain, db=db)
+            storage.store_calibration(when, 0.01, -40.0, gain, db=db)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--datasets",
+        default=",".join(DATASET_DAYS),
+        help=f"Comma-separated subset of {list(DATASET_DAYS)}",
+    )
+    parser.add_argument("--repeat", type=int, default=20)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in args.datasets.split(","):
+            results.extend(bench_dataset(name, args.repeat, Path(workdir)))
+    return report("storage", results, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+"""
+Synthetic `water_depths` databases for benchmarking.
+
+Databases are generated with `hosebeast.simulation` (one row per minute,
+daily pump runs) and cached under `benchmarks/.data/`, since five years of
+minute data takes a while to build.
+"""
+
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from sqlite_utils import Database
+
+from hosebeast import pyramid
+from hosebeast.scheduling import even_minute
+from hosebeast.simulation import Simulation
+
+DATA_DIR = Path(__file__).parent / ".data"
+
+DATASET_DAYS = {
+    "1w": 7,
+    "1m": 30,
+    "1y": 365,
+    "5y": 5 * 365,
+}
+
+SCHEDULE = {
+    "start_time": "4:30",
+    "duration_mins": 15,
+    "repeat_interval": 1,
+    "repeat_units": "days",
+}
+
+# Datasets all end at the same fixed moment so cached files stay valid and
+# time-range queries see the same rows on every run
+END = datetime(2024, 9, 1)
+
+
+def dataset_path(name: str) -> Path:
+    return DATA_DIR / f"water_depths_{name}.db"
+
+
+def get_dataset(name: str) -> Database:
+    path = dataset_path(name)
+    if not path.exists():
+        build_dataset(name, path)
+    db = Database(path)
+    # Datasets cached before the pyramid existed get their summaries here,
+    # rather than inside the first timed query
+    pyramid.ensure_pyramid(db)
+    return db
+
+
+def build_dataset(name: str, path: Path):
+    days = DATASET_DAYS[name]
+    DATA_DIR.mkdir(exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.unlink(missing_ok=True)
+    print(f"Building {days}-day dataset {path.name}...", flush=True)
+    start = time.perf_counter()
+    sim = Simulation(start=even_minute(END) - timedelta(days=days), seed=days)
+    db = Database(tmp_path)
+    db["water_depths"].insert_all(
+        sim.replay(days, SCHEDULE), pk="timestamp", replace=True, batch_size=5000
+    )
+    pyramid.ensure_pyramid(db)
+    db.close()
+    tmp_path.rename(path)
+    print(f"  built in {time.perf_counter() - start:.1f}s", flush=True)
@@ -0,0 +1,147 @@
+"""
+Shared timing, reporting and baseline comparison for the benchmark scripts.
+
+A benchmark script collects `Result`s with `measure()`, then hands them to
+`report()`, which prints a table and compares it against the JSON baseline
+stored next to the scripts (`benchmarks/baselines/<suite>.json`).
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import time
+import tracemalloc
+from collections.abc import Callable
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+BASELINE_DIR = Path(__file__).parent / "baselines"
+
+# A case regresses if its p50 is this many times slower than the baseline
+DEFAULT_TOLERANCE = 1.25
+
+
+@dataclass
+class Result:
+    name: str
+    calls: int
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    max_ms: float
+    peak_kib: float
+
+
+def percentile(sorted_values: list[float], pct: float) -> float:
+    if len(sorted_values) == 1:
+        return sorted_values[0]
+    # "inclusive" keeps percentiles inside the observed range for small n
+    cuts = statistics.quantiles(sorted_values, n=100, method="inclusive")
+    return cuts[min(98, max(0, int(pct) - 1))]
+
+
+def measure(
+    name: str,
+    fn: Callable[[int], object],
+    repeat: int = 20,
+    setup: Callable[[], object] | None = None,
+) -> Result:
+    """
+    Call `fn(i)` `repeat` times, timing each call. Peak memory is measured
+    with tracemalloc on one extra, untimed call so tracing overhead doesn't
+    pollute the latencies.
+    """
+    if setup:
+        setup()
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn(i)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    tracemalloc.start()
+    fn(repeat)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings.sort()
+    return Result(
+        name=name,
+        calls=repeat,
+        p50_ms=percentile(timings, 50),
+        p95_ms=percentile(timings, 95),
+        p99_ms=percentile(timings, 99),
+        max_ms=timings[-1],
+        peak_kib=peak / 1024,
+    )
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Store these results as the new baseline for this machine",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help="Fail if a case's p50 exceeds baseline p50 by this factor",
+    )
+
+
+def report(suite: str, results: list[Result], args: argparse.Namespace) -> int:
+    """Print results, compare with the stored baseline; return an exit code"""
+    baseline_path = BASELINE_DIR / f"{suite}.json"
+    baseline = {}
+    if baseline_path.exists():
+        baseline = json.loads(baseline_path.read_text())["results"]
+
+    header = (
+        f"{'case':<50} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+        f"{'max ms':>9} {'peak KiB':>9} {'vs base':>8}"
+    )
+    print(header)
+    print("-" * len(header))
+    regressions = []
+    for r in results:
+        ratio = ""
+        base = baseline.get(r.name)
+        if base and base["p50_ms"] > 0:
+            change = r.p50_ms / base["p50_ms"]
+            ratio = f"{change:.2f}x"
+            if change > args.tolerance:
+                regressions.append((r.name, change))
+        print(
+            f"{r.name:<50} {r.p50_ms:9.3f} {r.p95_ms:9.3f} {r.p99_ms:9.3f} "
+            f"{r.max_ms:9.3f} {r.peak_kib:9.1f} {ratio:>8}"
+        )
+
+    if args.save_baseline:
+        BASELINE_DIR.mkdir(exist_ok=True)
+        baseline_path.write_text(
+            json.dumps(
+                {
+                    "machine": platform.node(),
+                    "platform": platform.platform(),
+                    "saved": time.strftime("%Y-%m-%d %H:%M:%S"),
+                    "results": {r.name: asdict(r) for r in results},
+                },
+                indent=2,
+            )
+            + "\n"
+        )
+        print(f"\nSaved baseline to {baseline_path}")
+        return 0
+
+    if not baseline:
+        print(f"\nNo baseline at {baseline_path}; run with --save-baseline")
+        return 0
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) beyond {args.tolerance:.2f}x:")
+        for name, change in regressions:
+            print(f"  {name}: {change:.2f}x baseline p50")
+        return 1
+    print("\nNo regressions against baseline")
+    return 0
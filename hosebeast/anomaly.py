@@ -0,0 +1,235 @@
+"""
+Leak and sensor-fault detection on the live depth readings.
+
+The controller passes every reading to `AnomalyDetector.observe()`, which
+keeps a handful of running sums rather than a window of readings, so it
+costs the same few arithmetic operations per reading however long it
+runs. Each reading comes as two depths: the filtered one (filters.py),
+which is smooth but spreads a sudden step over many readings, and the
+depth of the read itself, passed through no more than a short median so
+a step arrives whole. Two rules:
+
+- A leak (or a tap left open): with every pump off, the level falls
+  steadily. A CUSUM adds up how far the level has dropped beyond what
+  `leak_cm_per_hour` allows, and once that reaches `leak_cusum_cm` an
+  exponentially weighted least-squares slope confirms the fall is steady
+  rather than one noisy step. Time to alert shrinks as the leak grows:
+  about ten minutes at 6 cm an hour. It watches the filtered depth, and
+  waits `jump_settle_secs` after a jump for the filter to catch up.
+- A sensor fault: the level moves further in one read than water can,
+  by at least `jump_cm` and `jump_z` standard deviations of the usual
+  read-to-read change.
+
+An alert is raised once, when its rule first fires, and cleared when the
+readings look normal again: the level steadies, or no more jumps are seen
+for `jump_clear_secs`. The controller stores each alert and its clearing
+(storage.raise_alert, storage.clear_alert) and shows active alerts on the
+dashboard.
+"""
+
+import math
+from dataclasses import dataclass
+
+LEAK = "leak"
+SENSOR_JUMP = "sensor_jump"
+
+
+@dataclass
+class DetectionPolicy:
+    # With every pump off, the level may fall this fast (evaporation, noise)
+    leak_cm_per_hour: float = 0.5
+    # Alert once it has fallen this much further than that allows
+    leak_cusum_cm: float = 1.0
+    # Smoothing for the level's slope, and how much of it to see before
+    # trusting it
+    slope_time_constant_secs: float = 30 * 60
+    min_slope_secs: float = 10 * 60
+    # The level sloshes and drains back for a while after a pump stops
+    settle_secs: float = 5 * 60
+    # A reading this far from the last, in cm and in standard deviations of
+    # the usual change, is a fault
+    jump_cm: float = 3.0
+    jump_z: float = 6.0
+    # Smoothing for the usual reading-to-reading change
+    step_time_constant_secs: float = 10 * 60
+    # Clear a fault alert after this long without another jump
+    jump_clear_secs: float = 10 * 60
+    # The filtered level takes this long to catch up with a jump; until
+    # then its slow approach would look like a leak
+    jump_settle_secs: float = 3 * 60
+    # Readings further apart than this aren't compared at all
+    max_gap_secs: float = 5 * 60
+
+
+@dataclass
+class Alert:
+    kind: str
+    message: str
+    value: float
+    timestamp: float
+    # False for the reading that clears an alert
+    raised: bool = True
+
+
+class RollingSlope:
+    """
+    Exponentially weighted least-squares slope of (t, y) points, from five
+    running sums. Times are kept relative to the latest point and values
+    relative to the first, so the sums stay small.
+    """
+
+    def __init__(self, time_constant_secs: float):
+        self.time_constant_secs = time_constant_secs
+        self.reset()
+
+    def reset(self):
+        self.start: float | None = None
+        self._t: float | None = None
+        self._y0 = 0.0
+        self._w = self._wt = self._wy = self._wtt = self._wty = 0.0
+
+    def add(self, t: float, y: float):
+        if self._t is None:
+            self.start, self._y0 = t, y
+        else:
+            # Move the origin to t, then age everything before it
+            dt = t - self._t
+            wtt = self._wtt - 2 * dt * self._wt + dt * dt * self._w
+            wty = self._wty - dt * self._wy
+            wt = self._wt - dt * self._w
+            decay = math.exp(-dt / self.time_constant_secs)
+            self._w *= decay
+            self._wy *= decay
+            self._wt, self._wtt, self._wty = wt * decay, wtt * decay, wty * decay
+        self._t = t
+        # The new point sits at t = 0, so only w and wy change
+        self._w += 1
+        self._wy += y - self._y0
+
+    def span(self) -> float:
+        return 0.0 if self.start is None else self._t - self.start
+
+    def slope(self) -> float | None:
+        """Units of y per second, or None until there are two points"""
+        denominator = self._w * self._wtt - self._wt * self._wt
+        if denominator <= 1e-9:
+            return None
+        return (self._w * self._wty - self._wt * self._wy) / denominator
+
+
+class AnomalyDetector:
+    def __init__(self, policy: DetectionPolicy | None = None):
+        self.policy = policy or DetectionPolicy()
+        # kind: the Alert that raised it, for alerts not yet cleared
+        self.active: dict[str, Alert] = {}
+        self.slope = RollingSlope(self.policy.slope_time_constant_secs)
+        # (time, depth, read_depth) of the last reading
+        self._last: tuple[float, float, float] | None = None
+        self._cusum = 0.0
+        self._pumps_stopped_at = float("-inf")
+        self._step_var: float | None = None
+        self._last_jump = float("-inf")
+
+    def reset(self):
+        """Forget the readings so far, e.g. when calibration changes them"""
+        self.slope.reset()
+        self._last = None
+        self._cusum = 0.0
+        self._step_var = None
+
+    def observe(
+        self,
+        now: float,
+        depth: float,
+        pumps_on: bool,
+        read_depth: float | None = None,
+    ) -> list[Alert]:
+        """
+        Check a reading taken at `now`: the filtered `depth`, and the
+        `read_depth` it was filtered from (the same, if not given). Returns
+        any alerts raised or cleared.
+        """
+        changes: list[Alert] = []
+        read_depth = depth if read_depth is None else read_depth
+        last, self._last = self._last, (now, depth, read_depth)
+        if pumps_on:
+            self._pumps_stopped_at = now
+        if last is None or not 0 < now - last[0] <= self.policy.max_gap_secs:
+            self._restart_leak()
+            return changes
+        dt, read_step = now - last[0], read_depth - last[2]
+        if self._is_jump(read_step, dt):
+            self._last_jump = now
+            self._restart_leak()
+            changes += self._raise(
+                SENSOR_JUMP,
+                f"Depth jumped {read_step:+.1f} cm in {dt:.0f} s; check the sensor",
+                read_step,
+                now,
+            )
+            return changes
+        if now - self._last_jump >= self.policy.jump_clear_secs:
+            changes += self._clear(SENSOR_JUMP, now)
+        if (
+            pumps_on
+            or now - self._pumps_stopped_at < self.policy.settle_secs
+            or now - self._last_jump < self.policy.jump_settle_secs
+        ):
+            self._restart_leak()
+        else:
+            changes += self._check_leak(now, depth, last[1] - depth, dt)
+        return changes
+
+    def _is_jump(self, step: float, dt: float) -> bool:
+        if self._step_var is not None and abs(step) >= max(
+            self.policy.jump_cm, self.policy.jump_z * math.sqrt(self._step_var)
+        ):
+            return True
+        # A jump would inflate the usual change, so only normal steps count
+        alpha = 1 - math.exp(-dt / self.policy.step_time_constant_secs)
+        if self._step_var is None:
+            self._step_var = step * step
+        else:
+            self._step_var += alpha * (step * step - self._step_var)
+        return False
+
+    def _restart_leak(self):
+        self.slope.reset()
+        self._cusum = 0.0
+
+    def _check_leak(self, now: float, depth: float, drop: float, dt: float):
+        policy = self.policy
+        allowed = policy.leak_cm_per_hour / 3600 * dt
+        self._cusum = max(0.0, self._cusum + drop - allowed)
+        self.slope.add(now, depth)
+        slope = self.slope.slope()
+        if slope is None or self.slope.span() < policy.min_slope_secs:
+            return []
+        cm_per_hour = -slope * 3600
+        if (
+            self._cusum >= policy.leak_cusum_cm
+            and cm_per_hour >= policy.leak_cm_per_hour
+        ):
+            return self._raise(
+                LEAK,
+                f"Level falling {cm_per_hour:.1f} cm/hour with every pump off; "
+                "check for a leak or an open tap",
+                cm_per_hour,
+                now,
+            )
+        if cm_per_hour < policy.leak_cm_per_hour / 2:
+            return self._clear(LEAK, now)
+        return []
+
+    def _raise(self, kind: str, message: str, value: float, now: float) -> list[Alert]:
+        if kind in self.active:
+            return []
+        alert = Alert(kind, message, round(value, 2), now)
+        self.active[kind] = alert
+        return [alert]
+
+    def _clear(self, kind: str, now: float) -> list[Alert]:
+        alert = self.active.pop(kind, None)
+        if alert is None:
+            return []
+        return [Alert(kind, alert.message, alert.value, now, raised=False)]
@@ -0,0 +1,112 @@
+"""
+Fitting ADC readings to known depths.
+
+The controller collects (raw reading, measured depth) pairs when someone
+calibrates from the dashboard; the fit here turns them into the slope and
+intercept used to convert every later reading into a depth.
+
+Raw readings only mean a depth at the gain they were taken at, so points
+and fits are kept per ADC gain. A `CalibrationTable` holds a fit for
+every gain, worked out once rather than per reading: a gain's own fit if
+it has one, otherwise the nearest calibrated gain's, scaled by the ratio
+of the gains (the intercept, a depth, doesn't change). Calibrating again
+at a gain the table has been covering this way needs only one point: it
+keeps the scaled slope and corrects the offset.
+"""
+
+import math
+
+from .pressure_estimator import VALID_GAINS
+
+# Until anything's calibrated: (slope, intercept) at gain 1
+DEFAULT_FIT = (0.0001, -2.0)
+
+
+def linear_regression_with_outlier_removal(
+    points: list[tuple[float, float]], std_dev_threshold: float = 2.0
+) -> tuple[float, float]:
+    """
+    Perform linear regression on a list of (x, y) points, removing outliers.
+
+    Args:
+        points: A list of tuples, where each tuple contains (x, y) coordinates.
+        std_dev_threshold: Number of standard deviations to use as threshold for outlier removal.
+
+    Returns:
+        A tuple containing (slope, intercept) of the best-fit line after outlier removal.
+    """
+
+    def calculate_regression(pts: list[tuple[float, float]]) -> tuple[float, float]:
+        n = len(pts)
+        sum_x = sum(x for x, _ in pts)
+        sum_y = sum(y for _, y in pts)
+        sum_xy = sum(x * y for x, y in pts)
+        sum_xx = sum(x * x for x, _ in pts)
+        denom = n * sum_xx - sum_x * sum_x
+        # avoid divide by zero
+        if n == 0 or denom == 0:
+            return (0, 0)
+        slope = (n * sum_xy - sum_x * sum_y) / denom
+        intercept = (sum_y - slope * sum_x) / n
+        return slope, intercept
+
+    # Initial regression
+    slope, intercept = calculate_regression(points)
+
+    # Calculate residuals
+    residuals = [(y - (slope * x + intercept)) for x, y in points]
+
+    # Calculate standard deviation of residuals
+    mean_residual = sum(residuals) / len(residuals)
+    std_dev_residual = math.sqrt(
+        sum((r - mean_residual) ** 2 for r in residuals) / len(residuals)
+    )
+
+    # Remove outliers
+    filtered_points = [
+        point
+        for point, residual in zip(points, residuals)
+        if abs(residual) <= std_dev_threshold * std_dev_residual
+    ]
+
+    # Recalculate regression with filtered points
+    return calculate_regression(filtered_points)
+
+
+class CalibrationTable:
+    def __init__(self, fits: dict[float, tuple[float, float]] | None = None):
+        # gain: (slope, intercept) fitted at that gain
+        self.fits = {gain: fit for gain, fit in (fits or {}).items() if fit[0]}
+        self._table: dict[float, tuple[float, float]] = {}
+        self._rebuild()
+
+    def _rebuild(self):
+        fits = self.fits or {1.0: DEFAULT_FIT}
+        self._table = {}
+        for gain in VALID_GAINS:
+            nearest = min(fits, key=lambda fitted: abs(math.log(fitted / gain)))
+            slope, intercept = fits[nearest]
+            self._table[gain] = (slope * nearest / gain, intercept)
+
+    def __getitem__(self, gain: float) -> tuple[float, float]:
+        """(slope, intercept) for readings at `gain`"""
+        return self._table[gain]
+
+    def depth(self, raw: float, gain: float) -> float:
+        slope, intercept = self._table[gain]
+        return raw * slope + intercept
+
+    def fit(
+        self, gain: float, points: list[tuple[float, float]]
+    ) -> tuple[float, float]:
+        """Refit `gain` from its (raw, depth) points, and return the fit"""
+        slope, intercept = linear_regression_with_outlier_removal(points)
+        if not slope and points:
+            # One reading (or several of the same): keep the slope and move
+            # the line through the points
+            slope = self._table[gain][0]
+            intercept = math.fsum(depth - slope * raw for raw, depth in points)
+            intercept /= len(points)
+        self.fits[gain] = (slope, intercept)
+        self._rebuild()
+        return slope, intercept
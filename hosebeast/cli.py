@@ -0,0 +1,510 @@
+"""
+`hosebeast`: query and maintain Hosebeast from a shell, cron or SSH.
+
+    hosebeast tail -n 30 --follow
+    hosebeast stats --since week
+    hosebeast usage --since month --unit gal
+    hosebeast runs --since week --daily
+    hosebeast alerts --since month
+    hosebeast export --since 2024-09-01 --format parquet -o september.parquet
+    hosebeast import old_logger.csv --fill-gaps 30
+    hosebeast prune --until 2024-08-15 --yes
+    HOSEBEAST_PARTITIONS=hosebeast-data hosebeast partition
+    hosebeast hub --dir hub-data --site garden=http://pi1:8000 --once
+    hosebeast calibrate --depth 42.5
+    hosebeast schedule show
+    hosebeast schedule set --start 5:00 --duration 20
+
+Only storage, scheduling and the socket client are imported, never Reflex
+or the ADC and GPIO drivers, so commands start in a fraction of a second.
+Commands that change what a running controller is doing (calibrating,
+changing the schedule) go through its socket; a schedule set while no
+controller runs is saved for its next start.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import os
+import sys
+import time
+from datetime import datetime
+
+from sqlite_utils import Database
+
+from . import export, hub, importer, partitions, storage, tank
+from .client import (
+    DEFAULT_SOCKET,
+    ControllerClient,
+    ControllerError,
+    ControllerUnavailable,
+)
+from .scheduling import (
+    DEFAULT_SCHEDULE,
+    VALID_TIME_UNITS,
+    calculate_next_relay_times,
+)
+
+
+def parse_when(value: str) -> float:
+    try:
+        return export.parse_time(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e)) from None
+
+
+def parse_start_time(value: str) -> str:
+    hour, _, minute = value.partition(":")
+    if not (hour.isdigit() and minute.isdigit()):
+        raise argparse.ArgumentTypeError(f"{value!r} isn't a time like 4:30")
+    if int(hour) > 23 or int(minute) > 59:
+        raise argparse.ArgumentTypeError(f"{value!r} isn't a time of day")
+    return f"{int(hour)}:{int(minute):02d}"
+
+
+def format_row(row: dict) -> str:
+    return f"{row['datetime']}  {row['water_depth']:6.1f} cm  raw {row['raw_value']}"
+
+
+def format_ts(ts: float) -> str:
+    return datetime.fromtimestamp(ts).isoformat(sep=" ", timespec="minutes")
+
+
+# ============
+# = COMMANDS =
+# ============
+def cmd_tail(args, db: Database):
+    rows = storage.recent_depths(args.lines, db=db)
+    for row in rows:
+        print(format_row(row))
+    if not args.follow:
+        return
+    last_ts = rows[-1]["timestamp"] if rows else 0
+    sys.stdout.flush()
+    while True:
+        time.sleep(args.interval)
+        for row in storage.depth_rows(last_ts + 1, db=db):
+            print(format_row(row), flush=True)
+            last_ts = row["timestamp"]
+
+
+def cmd_stats(args, db: Database):
+    stats = storage.depth_stats(args.since, args.until, db=db)
+    if stats is None:
+        print("No readings in that range")
+        return
+    hours = (stats["last_ts"] - stats["first_ts"]) / 3600
+    print(f"Readings:  {stats['count']} over {hours:.1f} h")
+    print(f"From:      {format_ts(stats['first_ts'])}  {stats['first_depth']:.1f} cm")
+    print(f"To:        {format_ts(stats['last_ts'])}  {stats['last_depth']:.1f} cm")
+    print(f"Change:    {stats['last_depth'] - stats['first_depth']:+.1f} cm")
+    print(
+        f"Depth:     min {stats['min_depth']:.1f}, "
+        f"mean {stats['mean_depth']:.1f}, max {stats['max_depth']:.1f} cm"
+    )
+
+
+def cmd_usage(args, db: Database):
+    table = tank.from_env()
+    if table is None:
+        raise SystemExit("Set HOSEBEAST_TANK to the tank's shape to track water use")
+    since = datetime.fromtimestamp(args.since) if args.since else None
+    until = datetime.fromtimestamp(args.until) if args.until else None
+    days = storage.load_water_use(since and since.date(), until and until.date(), db=db)
+    capacity = tank.litres_in(table.capacity, args.unit)
+    print(f"Tank {table.spec}: {capacity:g} {args.unit} when full")
+    print(f"{'Day':<12}{'Pumped':>10}{'Other use':>11}{'Refilled':>10}  ({args.unit})")
+    totals = [0.0, 0.0, 0.0]
+    for day in days:
+        litres = [day["pumped_l"], day["used_l"], day["refilled_l"]]
+        totals = [total + value for total, value in zip(totals, litres)]
+        pumped, used, refilled = (tank.litres_in(value, args.unit) for value in litres)
+        print(f"{day['day']:<12}{pumped:>10.1f}{used:>11.1f}{refilled:>10.1f}")
+    if len(days) > 1:
+        pumped, used, refilled = (tank.litres_in(value, args.unit) for value in totals)
+        print(f"{'Total':<12}{pumped:>10.1f}{used:>11.1f}{refilled:>10.1f}")
+
+
+def cmd_runs(args, db: Database):
+    until = args.until if args.until is not None else time.time()
+    if args.daily:
+        since = datetime.fromtimestamp(args.since).date() if args.since else None
+        days = storage.pump_runtime(since, datetime.fromtimestamp(until).date(), db=db)
+        print(f"{'Day':<12}{'Zone':<10}{'Runs':>6}{'Minutes':>10}")
+        for day in days:
+            minutes = day["seconds"] / 60
+            print(f"{day['day']:<12}{day['zone']:<10}{day['runs']:>6}{minutes:>10.1f}")
+        return
+    metered = "flow_rates" in db.table_names()
+    litres_header = f"{'Litres':>8}" if metered else ""
+    print(f"{'Start':<20}{'End':<20}{'Zone':<10}{'Minutes':>8}{litres_header}  Source")
+    for run in storage.pump_runs(args.since or 0, until, db=db):
+        start = datetime.fromtimestamp(run["start_ts"])
+        end = datetime.fromtimestamp(run["end_ts"] or time.time())
+        minutes = (end - start).total_seconds() / 60
+        litres = ""
+        if metered:
+            # Flow is stored per whole second, so include the one it started in
+            delivered = storage.delivered_litres(
+                int(run["start_ts"]), end.timestamp(), run["zone"], db=db
+            )
+            litres = f"{delivered.get(run['zone'], 0.0):>8.1f}"
+        ended = end.isoformat(" ", "seconds") if run["end_ts"] else "running"
+        source = run["source"]
+        if run["end_source"] and run["end_source"] != source:
+            source += f", stopped by {run['end_source']}"
+        print(
+            f"{start.isoformat(' ', 'seconds'):<20}{ended:<20}"
+            f"{run['zone']:<10}{minutes:>8.1f}{litres}  {source}"
+        )
+
+
+def cmd_alerts(args, db: Database):
+    print(f"{'Raised':<20}{'Cleared':<20}Alert")
+    for alert in storage.load_alerts(args.since or 0, db=db):
+        raised, cleared = (
+            datetime.fromtimestamp(ts).isoformat(" ", "seconds") if ts else "active"
+            for ts in (alert["raised_ts"], alert["cleared_ts"])
+        )
+        print(f"{raised:<20}{cleared:<20}{alert['message']}")
+
+
+def cmd_export(args, db: Database):
+    chunks = export.stream(args.table, args.format, args.since, args.until, db=db)
+    stdout = contextlib.nullcontext(sys.stdout.buffer)
+    with open(args.output, "wb") if args.output else stdout as f:
+        for chunk in chunks:
+            f.write(chunk)
+
+
+def cmd_import(args, db: Database):
+    for path in args.files:
+        result = importer.import_file(
+            path,
+            args.format,
+            keep_existing=args.keep_existing,
+            fill_gaps_secs=args.fill_gaps * 60,
+            db=db,
+        )
+        print(
+            f"{path}: {result.read} readings, {result.written} written, "
+            f"{result.filled} interpolated"
+        )
+
+
+def cmd_fill_gaps(args, db: Database):
+    start, end = args.since or 0, args.until or time.time()
+    filled = importer.fill_gaps(start, end, args.max_gap * 60, db=db)
+    if filled:
+        storage.refresh_summaries(start, end, db)
+    print(f"{filled} rows interpolated")
+
+
+def cmd_prune(args, db: Database):
+    start = args.since or 0
+    if args.table not in db.table_names():
+        raise SystemExit(f"No table {args.table!r} in {args.db}")
+    if args.dry_run or not args.yes:
+        if args.table == "water_depths":
+            stats = storage.depth_stats(start, args.until, db=db)
+            count = stats["count"] if stats else 0
+        else:
+            count = db[args.table].count_where(
+                "timestamp >= ? AND timestamp <= ?", [start, args.until]
+            )
+        print(
+            f"{count} rows of {args.table} between "
+            f"{format_ts(start)} and {format_ts(args.until)}"
+        )
+        if args.dry_run:
+            return
+        if not sys.stdin.isatty():
+            raise SystemExit("Refusing to delete without --yes")
+        if input("Delete them? [y/N] ").strip().lower() != "y":
+            return
+    deleted = storage.delete_db_range(
+        datetime.fromtimestamp(start),
+        datetime.fromtimestamp(args.until),
+        table_name=args.table,
+        db=db,
+    )
+    print(f"Deleted {deleted} rows")
+
+
+def cmd_hub(args, db: Database):
+    directory = args.dir or hub.HUB_DIR
+    if not directory:
+        raise SystemExit("Give the hub's directory with --dir or HOSEBEAST_HUB")
+    sites = hub.parse_sites(",".join(args.site or [])) or hub.parse_sites(
+        os.environ.get("HOSEBEAST_HUB_SITES", "")
+    )
+    if not sites:
+        raise SystemExit("Give sites with --site name=url or HOSEBEAST_HUB_SITES")
+    if not args.once:
+        asyncio.run(hub.run(directory, sites))
+        return
+    os.makedirs(directory, exist_ok=True)
+    failed = False
+    for site in sites:
+        try:
+            print(f"{site.name}: {hub.sync_site(site, directory)} rows")
+        except (OSError, ValueError) as e:
+            print(f"{site.name}: failed: {e}", file=sys.stderr)
+            failed = True
+    if failed:
+        raise SystemExit(1)
+
+
+def cmd_partition(args, db: Database):
+    if not isinstance(db, partitions.PartitionedDatabase):
+        raise SystemExit(
+            "Set HOSEBEAST_PARTITIONS to the directory for monthly partitions"
+        )
+    moved = partitions.migrate(db)
+    if moved:
+        print(f"Moved {moved} readings from {args.db} into {db.directory}/")
+    db.seal_before(partitions.month_of(time.time()))
+    for month in db.months():
+        path = db.partition_path(month)
+        sealed = "  (sealed)" if db.sealed(month) else ""
+        size = path.stat().st_size // 1024
+        print(f"{month}  {size:>8} KiB  {path.name}{sealed}")
+
+
+def cmd_calibrate(args, db: Database):
+    if args.depth is not None:
+        client = ControllerClient(args.socket)
+        result = asyncio.run(client.calibrate(args.depth))
+        print(
+            f"Calibrated: slope {result['slope']:g}, intercept {result['intercept']:g}"
+        )
+        return
+    calibrations = storage.calibrations_by_gain(db=db)
+    if not calibrations:
+        print("Not calibrated yet")
+        return
+    # Other gains are scaled from the nearest of these
+    for gain, calibration in sorted(calibrations.items()):
+        points = storage.calibration_points(gain, db=db)
+        print(f"Calibrated {calibration['datetime']} at gain {gain:.3g}")
+        print(f"depth = {calibration['slope']:g} * raw + {calibration['intercept']:g}")
+        print(f"from {len(points)} points")
+
+
+def cmd_schedule_show(args, db: Database):
+    schedule = storage.load_schedule(db=db)
+    if schedule is None:
+        print("No schedule saved; the controller uses its default")
+        return
+    start, end = calculate_next_relay_times(
+        schedule["start_time"],
+        schedule["duration_mins"],
+        schedule["repeat_interval"],
+        schedule["repeat_units"],
+    )
+    print(
+        f"Every {schedule['repeat_interval']} {schedule['repeat_units']} from "
+        f"{schedule['start_time']}, for {schedule['duration_mins']} minutes"
+    )
+    print(f"Next run:  {format_ts(start.timestamp())} to {end:%H:%M}")
+
+
+def cmd_schedule_set(args, db: Database):
+    schedule = storage.load_schedule(db=db) or DEFAULT_SCHEDULE
+    given = {
+        "start_time": args.start,
+        "duration_mins": args.duration,
+        "repeat_interval": args.every,
+        "repeat_units": args.units,
+    }
+    # Only flags left out keep their saved value; `--duration 0` is a value
+    updated = {
+        key: schedule[key] if value is None else value for key, value in given.items()
+    }
+    try:
+        asyncio.run(ControllerClient(args.socket).set_schedule(**updated))
+    except ControllerUnavailable:
+        storage.store_schedule(**updated, db=db)
+        print("No controller running; saved for its next start")
+    cmd_schedule_show(args, db)
+
+
+# ==========
+# = PARSER =
+# ==========
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="hosebeast", description="Query and maintain Hosebeast"
+    )
+    parser.add_argument(
+        "--db",
+        default=storage.DB_PATH,
+        help=f"Database file (default: {storage.DB_PATH})",
+    )
+    parser.add_argument(
+        "--socket",
+        default=os.environ.get("HOSEBEAST_CONTROLLER", DEFAULT_SOCKET),
+        help=f"Controller socket (default: {DEFAULT_SOCKET})",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def add_range(command, until_required=False):
+        command.add_argument(
+            "--since",
+            type=parse_when,
+            help="day, week, month, an ISO date or epoch seconds",
+        )
+        command.add_argument(
+            "--until",
+            type=parse_when,
+            required=until_required,
+            help="an ISO date" + ("" if until_required else " (default: now)"),
+        )
+
+    tail = commands.add_parser("tail", help="Show the latest readings")
+    tail.add_argument("-n", "--lines", type=int, default=20)
+    tail.add_argument("-f", "--follow", action="store_true", help="Keep watching")
+    tail.add_argument(
+        "--interval", type=float, default=10, help="Seconds between checks"
+    )
+    tail.set_defaults(run=cmd_tail)
+
+    stats = commands.add_parser("stats", help="Summarize readings in a range")
+    add_range(stats)
+    stats.set_defaults(run=cmd_stats)
+
+    usage_ = commands.add_parser(
+        "usage", help="Water pumped, otherwise used and refilled, by day"
+    )
+    add_range(usage_)
+    usage_.add_argument("--unit", choices=tank.VOLUME_UNITS, default="L")
+    usage_.set_defaults(run=cmd_usage)
+
+    runs = commands.add_parser("runs", help="When the pumps ran, and why")
+    add_range(runs)
+    runs.add_argument(
+        "--daily", action="store_true", help="Total runs and minutes per day and zone"
+    )
+    runs.set_defaults(run=cmd_runs)
+
+    alerts = commands.add_parser(
+        "alerts", help="Leak and sensor alerts: active ones and those raised since"
+    )
+    alerts.add_argument(
+        "--since",
+        type=parse_when,
+        help="day, week, month, an ISO date or epoch seconds (default: all)",
+    )
+    alerts.set_defaults(run=cmd_alerts)
+
+    export_ = commands.add_parser(
+        "export", help="Write history as CSV, JSON Lines or Parquet"
+    )
+    add_range(export_)
+    export_.add_argument(
+        "--table", choices=export.EXPORT_TABLES, default="water_depths"
+    )
+    export_.add_argument("--format", choices=export.FORMATS, default="csv")
+    export_.add_argument("-o", "--output", help="File to write (default: stdout)")
+    export_.set_defaults(run=cmd_export)
+
+    import_ = commands.add_parser(
+        "import", help="Load readings from CSV or JSONL files"
+    )
+    import_.add_argument("files", nargs="+")
+    import_.add_argument(
+        "--format", choices=importer.FORMATS, help="(default: from the suffix)"
+    )
+    import_.add_argument(
+        "--keep-existing",
+        action="store_true",
+        help="Keep stored rows for minutes the files also have",
+    )
+    import_.add_argument(
+        "--fill-gaps",
+        type=float,
+        default=0,
+        metavar="MINUTES",
+        help="Interpolate gaps up to this long",
+    )
+    import_.set_defaults(run=cmd_import)
+
+    fill = commands.add_parser(
+        "fill-gaps", help="Interpolate short gaps in stored readings"
+    )
+    add_range(fill)
+    fill.add_argument(
+        "--max-gap", type=float, required=True, metavar="MINUTES", help="Longest gap"
+    )
+    fill.set_defaults(run=cmd_fill_gaps)
+
+    prune = commands.add_parser("prune", help="Delete readings in a range")
+    add_range(prune, until_required=True)
+    prune.add_argument("--table", default="water_depths")
+    prune.add_argument("--dry-run", action="store_true", help="Only count them")
+    prune.add_argument("--yes", action="store_true", help="Don't ask first")
+    prune.set_defaults(run=cmd_prune)
+
+    partition = commands.add_parser(
+        "partition",
+        help="Move readings into monthly files, seal past months and list them",
+    )
+    partition.set_defaults(run=cmd_partition)
+
+    hub_ = commands.add_parser(
+        "hub", help="Pull new readings and pump runs from other units into a hub"
+    )
+    hub_.add_argument("--dir", help="Per-site databases (default: $HOSEBEAST_HUB)")
+    hub_.add_argument(
+        "--site",
+        action="append",
+        help="name=url of a unit, repeatable (default: $HOSEBEAST_HUB_SITES)",
+    )
+    hub_.add_argument(
+        "--once", action="store_true", help="Sync each site once, then exit"
+    )
+    hub_.set_defaults(run=cmd_hub)
+
+    calibrate = commands.add_parser(
+        "calibrate", help="Show the calibration, or calibrate against a depth"
+    )
+    calibrate.add_argument(
+        "--depth",
+        type=float,
+        help="The tank's measured depth in cm, recorded against the current reading",
+    )
+    calibrate.set_defaults(run=cmd_calibrate)
+
+    schedule = commands.add_parser("schedule", help="Show or change the schedule")
+    schedule_commands = schedule.add_subparsers(dest="schedule_command", required=True)
+    show = schedule_commands.add_parser("show", help="Show the saved schedule")
+    show.set_defaults(run=cmd_schedule_show)
+    set_ = schedule_commands.add_parser(
+        "set", help="Change the schedule; unset fields are kept"
+    )
+    set_.add_argument("--start", type=parse_start_time, help="e.g. 4:30")
+    set_.add_argument("--duration", type=int, help="Minutes per run")
+    set_.add_argument("--every", type=int, help="Repeat interval")
+    set_.add_argument("--units", choices=VALID_TIME_UNITS, help="Repeat units")
+    set_.set_defaults(run=cmd_schedule_set)
+    return parser
+
+
+def main(argv: list[str] | None = None):
+    args = build_parser().parse_args(argv)
+    db = storage.open_db(args.db)
+    try:
+        args.run(args, db)
+    except (ControllerError, export.ExportError, importer.BadReading) as e:
+        raise SystemExit(f"hosebeast: {e}") from None
+    except KeyboardInterrupt:
+        pass
+    except BrokenPipeError:
+        # e.g. `hosebeast export | head`; don't complain as stdout closes
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Talking to a running controller over its Unix socket.
+
+`ControllerClient` mirrors the `Controller` interface in controller.py,
+but imports nothing that touches the ADC or GPIO, so the dashboard and the
+`hosebeast` CLI can use it cheaply. See controller.py for the protocol.
+"""
+
+import asyncio
+import json
+import logging
+from collections.abc import AsyncIterator
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = "hosebeast-controller.sock"
+
+
+class ControllerError(Exception):
+    """A command the controller refused, or couldn't be reached for"""
+
+
+class ControllerUnavailable(ControllerError):
+    """No controller is listening on the socket"""
+
+
+class ControllerClient:
+    """The `Controller` interface, over the socket at `path`"""
+
+    def __init__(self, path: str = DEFAULT_SOCKET, reconnect_secs: float = 2.0):
+        self.path = path
+        self.reconnect_secs = reconnect_secs
+
+    async def request(self, cmd: str, **args):
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.path)
+        except OSError as e:
+            raise ControllerUnavailable(
+                f"Can't reach controller at {self.path}: {e}"
+            ) from e
+        try:
+            writer.write(json.dumps({"cmd": cmd, **args}).encode() + b"\n")
+            await writer.drain()
+            response = json.loads(await reader.readline() or "null")
+        finally:
+            writer.close()
+        if not response:
+            raise ControllerError(f"Controller closed the connection during {cmd!r}")
+        if not response["ok"]:
+            raise ControllerError(response["error"])
+        return response["result"]
+
+    async def subscribe(self) -> AsyncIterator[dict]:
+        """Statuses as they arrive, reconnecting whenever the controller restarts"""
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except OSError as e:
+                log.warning("Can't reach controller at %s: %s", self.path, e)
+                await asyncio.sleep(self.reconnect_secs)
+                continue
+            try:
+                writer.write(b'{"cmd": "subscribe"}\n')
+                await writer.drain()
+                while line := await reader.readline():
+                    yield json.loads(line)
+            except ConnectionError as e:
+                log.warning("Lost controller connection: %s", e)
+            finally:
+                writer.close()
+            await asyncio.sleep(self.reconnect_secs)
+
+    async def status(self) -> dict:
+        return await self.request("status")
+
+    async def set_relay(self, pin: int, off: bool):
+        return await self.request("set_relay", pin=pin, off=off)
+
+    async def set_schedule(
+        self,
+        start_time: str,
+        duration_mins: int,
+        repeat_interval: int,
+        repeat_units: str,
+    ):
+        return await self.request(
+            "set_schedule",
+            start_time=start_time,
+            duration_mins=duration_mins,
+            repeat_interval=repeat_interval,
+            repeat_units=repeat_units,
+        )
+
+    async def calibrate(self, actual_depth: float) -> dict:
+        return await self.request("calibrate", actual_depth=actual_depth)
+
+    async def set_gain(self, gain: str):
+        return await self.request("set_gain", gain=gain)
+
+    async def metrics(self) -> str:
+        return await self.request("metrics")
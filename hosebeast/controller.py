@@ -0,0 +1,624 @@
+#! /usr/bin/env python3
+"""
+The Hosebeast controller: owns the depth sensor, the pump relays and the
+database writer, and keeps sampling, logging and watering on schedule.
+
+It runs in one of two ways:
+
+- As its own process, `hosebeast-controller` (or `python -m
+  hosebeast.controller`), listening on a Unix socket. The dashboard sets
+  HOSEBEAST_CONTROLLER to the socket's path, so the web process can be
+  rebuilt, reloaded or crash without a pump missing a beat.
+  `start_hosebeast.sh` runs it this way.
+- Inside a web worker, when HOSEBEAST_CONTROLLER isn't set. Every backend
+  worker runs `serve_when_elected`, and whichever takes the lock file
+  beside the socket builds the sensor and serves; the rest stand by and
+  take over if it dies. Only one process ever touches the ADC, the GPIO
+  pins or the database writer, however many workers there are.
+
+Either way the dashboard talks to it through `ControllerClient` (client.py):
+`subscribe()` for a stream of status dicts, and awaitable commands
+(`set_relay`, `set_schedule`, `calibrate`, `set_gain`).
+
+The socket protocol is newline-delimited JSON. A client sends one request,
+`{"cmd": "set_relay", "pin": 18, "off": false}`, and gets one response,
+`{"ok": true, "result": ...}` or `{"ok": false, "error": "..."}`. A
+`{"cmd": "subscribe"}` request instead gets a status line now and after
+every change, until it disconnects.
+
+Environment:
+    HOSEBEAST_CONTROLLER   socket path; the dashboard uses a separate
+                           controller process when this is set
+    HOSEBEAST_MOCK, HOSEBEAST_SIM, HOSEBEAST_FILTERS
+                           sensor setup, as described in hosebeast.py
+    HOSEBEAST_FLOW_METERS  flow meter inputs, as described in flow_meter.py
+    HOSEBEAST_ADC_GAIN     the ADC gain to start at: "2/3", "1" (the
+                           default), "2", "4", "8", "16", or "auto" to
+                           choose it for every reading (filters.AutoRange)
+"""
+
+import argparse
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import time
+from collections.abc import AsyncIterator
+from contextlib import aclosing
+from datetime import datetime, timedelta
+
+from . import flow_meter, metrics, relay_control, relay_log, storage
+from .anomaly import Alert, AnomalyDetector
+from .calibration import CalibrationTable
+from .client import DEFAULT_SOCKET, ControllerClient, ControllerError  # noqa: F401
+from .filters import (
+    DEFAULT_CHAIN,
+    AutoRange,
+    FilteredChannel,
+    MedianFilter,
+    parse_chain,
+)
+from .logs import configure_logging, pump_log
+from .pressure_estimator import SomeADCWrapper, get_adc_channel
+from .relay_control import RELAY_1, RELAY_2
+from .sampling import AdaptiveSampler
+from .scheduling import (
+    DEFAULT_SCHEDULE,
+    VALID_TIME_UNITS,
+    calculate_next_relay_times,
+    even_minute,
+)
+from .web_utils import get_bool_from_env
+
+log = logging.getLogger(__name__)
+
+AUTO_GAIN = "auto"
+
+# The jump rule sees each read's depth through only this short a median:
+# enough to drop a single bad read, while a real step arrives whole
+JUMP_MEDIAN_WINDOW = 5
+
+
+def build_sensor() -> FilteredChannel:
+    """The ADC channel described by the environment, behind its filter chain"""
+    if get_bool_from_env("HOSEBEAST_SIM"):
+        from .simulation import Simulation
+
+        simulation = Simulation(speed=1.0)
+        relay_control.use_gpio_backend(simulation.gpio)
+        channel: SomeADCWrapper = simulation.channel(0, gain=1.0)
+    else:
+        channel = get_adc_channel(0, gain=1.0, mock=get_bool_from_env("HOSEBEAST_MOCK"))
+    chain = parse_chain(os.environ.get("HOSEBEAST_FILTERS", DEFAULT_CHAIN))
+    return FilteredChannel(channel, chain)
+
+
+def parse_gain(gain: str) -> float:
+    return 2 / 3 if gain == "2/3" else float(gain)
+
+
+def format_gain(gain: float) -> str:
+    return "2/3" if gain == 2 / 3 else f"{gain:g}"
+
+
+class Controller:
+    def __init__(
+        self,
+        sensor: FilteredChannel,
+        sampler: AdaptiveSampler | None = None,
+        flow: flow_meter.FlowMonitor | None = None,
+        adc_gain: str = "1",
+    ):
+        self.sensor = sensor
+        self.sampler = sampler or AdaptiveSampler()
+        self.flow = flow
+        self.schedule = dict(DEFAULT_SCHEDULE)
+        # A gain as parse_gain takes it, or AUTO_GAIN
+        self.adc_gain = "1"
+        self.apply_gain(adc_gain)
+        self.adc_raw = 0
+        # The gain adc_raw was read at; auto-ranging may since have moved on
+        self.adc_raw_gain = self.sensor.gain
+        self.adc_voltage = 0.0
+        # Fits for every gain, so readings convert at whichever they're taken
+        self.calibrations = CalibrationTable()
+        self.last_stored = 0.0
+        self.relay_events = relay_log.RelayEventWriter(storage.POOL)
+        # storage.load_scheduled_run's row: the schedule window last acted on
+        self.scheduled_run: dict | None = None
+        self.detector = AnomalyDetector()
+        # Depth of each unfiltered read, for the detector's jump rule
+        self.read_depths = MedianFilter(JUMP_MEDIAN_WINDOW)
+        self.read_depth = 0.0
+        self._subscribers: set[asyncio.Queue] = set()
+
+    @classmethod
+    def from_env(cls) -> "Controller":
+        mock = get_bool_from_env("HOSEBEAST_MOCK") or get_bool_from_env("HOSEBEAST_SIM")
+        flow = flow_meter.from_env(relay_control.PIN_NAMES, mock=mock)
+        adc_gain = os.environ.get("HOSEBEAST_ADC_GAIN", "1")
+        return cls(build_sensor(), flow=flow, adc_gain=adc_gain)
+
+    # ==========
+    # = STATUS =
+    # ==========
+    def status(self) -> dict:
+        depth_slope, depth_intercept = self.calibrations[self.adc_raw_gain]
+        return {
+            "time": time.time(),
+            "adc_gain": self.adc_gain,
+            "active_gain": format_gain(self.adc_raw_gain),
+            "adc_raw": self.adc_raw,
+            "adc_voltage": self.adc_voltage,
+            "depth_slope": depth_slope,
+            "depth_intercept": depth_intercept,
+            "relay_1_off": relay_control.RELAY_OFF[RELAY_1],
+            "relay_2_off": relay_control.RELAY_OFF[RELAY_2],
+            "schedule": dict(self.schedule),
+            "last_stored": self.last_stored,
+            "sample_interval": self.sampler.interval(),
+            "flow_lpm": self.flow.rates() if self.flow else {},
+            "alerts": [
+                {"kind": alert.kind, "message": alert.message, "since": alert.timestamp}
+                for alert in self.detector.active.values()
+            ],
+        }
+
+    async def subscribe(self) -> AsyncIterator[dict]:
+        """The current status, then each new one; slow readers skip to the latest"""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+        self._subscribers.add(queue)
+        try:
+            yield self.status()
+            while True:
+                yield await queue.get()
+        finally:
+            self._subscribers.discard(queue)
+
+    def publish(self):
+        status = self.status()
+        for queue in self._subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(status)
+
+    # ============
+    # = COMMANDS =
+    # ============
+    async def set_relay(self, pin: int, off: bool):
+        if pin not in relay_control.PIN_NAMES:
+            raise ControllerError(f"Unknown relay pin {pin}")
+        run = self.scheduled_run
+        if off and run and run["state"] == "running" and run["pin"] == pin:
+            # Stopped by hand: don't restart it this window, even after a reboot
+            await self.mark_scheduled_run("stopped")
+        self.switch_relay(pin, bool(off), "manual")
+        self.publish()
+
+    async def set_schedule(
+        self,
+        start_time: str,
+        duration_mins: int,
+        repeat_interval: int,
+        repeat_units: str,
+    ):
+        if repeat_units not in VALID_TIME_UNITS:
+            raise ControllerError(
+                f"Invalid repeat units {repeat_units!r}; must be one of {VALID_TIME_UNITS}"
+            )
+        self.schedule = {
+            "start_time": start_time,
+            "duration_mins": int(duration_mins),
+            "repeat_interval": int(repeat_interval),
+            "repeat_units": repeat_units,
+        }
+        await storage.POOL.write(storage.store_schedule, **self.schedule)
+        self.publish()
+
+    async def calibrate(self, actual_depth: float) -> dict:
+        """Record the current reading as `actual_depth` cm and refit its gain"""
+        raw = self.sensor.value
+        # After reading: auto-ranging may have just changed it
+        adc_gain = self.sensor.gain
+        now_minute = even_minute()
+        await storage.POOL.write(
+            storage.store_calibration_point, now_minute, raw, actual_depth, adc_gain
+        )
+        log.info(
+            "Calibration: storing raw value %d for depth %.1f cm",
+            raw,
+            actual_depth,
+            extra={"adc_gain": adc_gain},
+        )
+        points = await storage.POOL.read(storage.calibration_points, adc_gain)
+        slope, intercept = self.calibrations.fit(adc_gain, points)
+        # Depths before and after aren't comparable
+        self.detector.reset()
+        self.read_depths.reset()
+        await storage.POOL.write(
+            storage.store_calibration, now_minute, slope, intercept, adc_gain
+        )
+        self.publish()
+        return {"slope": slope, "intercept": intercept}
+
+    def apply_gain(self, gain: str):
+        if gain == AUTO_GAIN:
+            self.sensor.autorange = AutoRange()
+        else:
+            self.sensor.gain = parse_gain(gain)
+            self.sensor.autorange = None
+        self.adc_gain = gain
+
+    async def set_gain(self, gain: str):
+        self.apply_gain(gain)
+        self.detector.reset()
+        self.read_depths.reset()
+        self.publish()
+
+    async def metrics(self) -> str:
+        return metrics.render()
+
+    COMMANDS = frozenset(
+        {
+            "status",
+            "set_relay",
+            "set_schedule",
+            "calibrate",
+            "set_gain",
+            "metrics",
+        }
+    )
+
+    async def handle(self, request: dict):
+        cmd = request.get("cmd")
+        if cmd not in self.COMMANDS:
+            raise ControllerError(f"Unknown command {cmd!r}")
+        args = {k: v for k, v in request.items() if k != "cmd"}
+        result = getattr(self, cmd)(**args)
+        return await result if asyncio.iscoroutine(result) else result
+
+    # =========
+    # = LOOPS =
+    # =========
+    def switch_relay(self, pin: int, off: bool, source: str):
+        """Set a relay, recording the change in the pump run log if it is one"""
+        if relay_control.RELAY_OFF[pin] != off:
+            self.relay_events.record(pin, relay_control.PIN_NAMES[pin], not off, source)
+        relay_control.set_relay(pin, off)
+
+    def depth_for_raw(self, raw: int) -> float:
+        """The depth for a reading taken at `adc_raw_gain`"""
+        return round(self.calibrations.depth(raw, self.adc_raw_gain), 1)
+
+    async def save_scheduled_run(
+        self, window_start: float, planned_end: float, state: str
+    ):
+        self.scheduled_run = {
+            "pin": RELAY_1,
+            "zone": relay_control.PIN_NAMES[RELAY_1],
+            "window_start": window_start,
+            "planned_end": planned_end,
+            "state": state,
+        }
+        await storage.POOL.write(storage.store_scheduled_run, **self.scheduled_run)
+
+    async def mark_scheduled_run(self, state: str):
+        run = self.scheduled_run
+        await self.save_scheduled_run(run["window_start"], run["planned_end"], state)
+
+    async def resume(self):
+        """
+        Put the pumps back as the last controller left them, before loading
+        anything else. A scheduled run cut short by a crash or power blip
+        carries on to its planned end, never beyond; every other relay,
+        including one switched on by hand, is switched off.
+
+        A controller restarted without a reboot finds the resumed run's
+        pump still going: it's left running, and so is its pump_runs row.
+        """
+        try:
+            run = await storage.POOL.read(storage.load_scheduled_run)
+        except Exception:
+            # Don't leave a pump running that nothing will switch off
+            relay_control.configure_relays()
+            raise
+        self.scheduled_run = run
+        now = time.time()
+        running = bool(run) and run["state"] == "running"
+        resuming = running and now < run["planned_end"]
+        # Drives every other relay off
+        relay_control.configure_relays(keep=(run["pin"],) if resuming else ())
+        still_on = {}
+        if resuming and not relay_control.RELAY_OFF[run["pin"]]:
+            still_on[run["pin"]] = relay_control.PIN_NAMES[run["pin"]]
+        ended = await storage.POOL.write(storage.end_open_pump_runs, now, still_on)
+        if ended:
+            log.warning("Ended %d pump run(s) left open by the last controller", ended)
+        if resuming:
+            log.warning(
+                "Resuming scheduled run until %s",
+                datetime.fromtimestamp(run["planned_end"]).isoformat(" ", "seconds"),
+            )
+            if run["pin"] not in still_on:
+                self.switch_relay(run["pin"], False, "schedule")
+        elif running:
+            await self.mark_scheduled_run("done")
+
+    async def run(self):
+        """Load settings, then sample and follow the schedule until cancelled"""
+        await self.resume()
+        # Alerts the last controller raised stay up until readings clear them
+        for alert in await storage.POOL.read(storage.load_alerts, active_only=True):
+            self.detector.active[alert["kind"]] = Alert(
+                alert["kind"], alert["message"], alert["value"], alert["raised_ts"]
+            )
+        # Catches up on readings stored without the controller (an import),
+        # and rebuilds the totals if HOSEBEAST_TANK changed
+        await storage.POOL.write(storage.update_water_use)
+        # So chart queries, which only read, find every summary level
+        await storage.POOL.write(storage.ensure_summaries)
+        schedule = await storage.POOL.read(storage.load_schedule)
+        if schedule:
+            self.schedule = {key: schedule[key] for key in DEFAULT_SCHEDULE}
+        calibrations = await storage.POOL.read(storage.calibrations_by_gain)
+        if calibrations:
+            log.info(
+                "Loaded calibration at gain %s",
+                ", ".join(format_gain(gain) for gain in sorted(calibrations)),
+            )
+            self.calibrations = CalibrationTable(
+                {
+                    gain: (row["slope"], row["intercept"])
+                    for gain, row in calibrations.items()
+                }
+            )
+        loops = [self.sample_loop(), self.schedule_loop(), self.relay_events.run()]
+        if self.flow:
+            self.flow.start()
+            loops.append(self.flow_loop())
+        try:
+            await asyncio.gather(*loops)
+        finally:
+            if self.flow:
+                self.flow.close()
+
+    async def sample_loop(self):
+        while True:
+            try:
+                self.sample()
+                await self.check_readings()
+                await self.store_reading()
+            except Exception:
+                # A flaky bus or a full disk shouldn't stop the pumps
+                log.exception("Sampling failed")
+            self.publish()
+            await asyncio.sleep(self.sampler.interval())
+
+    def sample(self):
+        with metrics.timer("hosebeast_i2c_read_seconds", "ADC reads over I2C"):
+            self.adc_raw = self.sensor.value
+            self.adc_raw_gain = self.sensor.gain
+            self.adc_voltage = round(self.sensor.voltage, 3)
+        read_depth = self.calibrations.depth(self.sensor.raw, self.sensor.raw_gain)
+        self.read_depth = self.read_depths.update(read_depth, 0.0)
+        self.sampler.observe(
+            time.time(), self.depth_for_raw(self.adc_raw), relay_control.any_relay_on()
+        )
+        metrics.gauge(
+            "hosebeast_sample_interval_seconds", "Current sensor read interval"
+        ).set(self.sampler.interval())
+        metrics.gauge("hosebeast_adc_gain", "ADC gain in use").set(self.adc_raw_gain)
+
+    def detect(self, now: float) -> list[Alert]:
+        """Alerts raised or cleared by the latest reading"""
+        return self.detector.observe(
+            now,
+            self.depth_for_raw(self.adc_raw),
+            relay_control.any_relay_on(),
+            read_depth=self.read_depth,
+        )
+
+    async def check_readings(self):
+        """Look for leaks and sensor faults in the latest reading"""
+        for alert in self.detect(time.time()):
+            if alert.raised:
+                log.warning(alert.message, extra={"alert": alert.kind})
+                await storage.POOL.write(
+                    storage.raise_alert,
+                    alert.kind,
+                    alert.message,
+                    alert.value,
+                    alert.timestamp,
+                )
+            else:
+                log.info("Cleared %s alert", alert.kind)
+                await storage.POOL.write(
+                    storage.clear_alert, alert.kind, alert.timestamp
+                )
+
+    async def store_reading(self):
+        now = time.time()
+        # We can't go below 0
+        depth = max(0, self.depth_for_raw(self.adc_raw))
+        if not self.sampler.should_store(now, depth):
+            return
+        self.sampler.stored(now, depth)
+        # The sampler stores at most once a minute, so rows keyed by minute
+        # never overwrite each other
+        now_minute = even_minute()
+        row = {
+            "timestamp": now_minute.timestamp(),
+            "datetime": now_minute.isoformat(),
+            # Counts at gain 1, whatever the gain, so stored rows compare
+            "raw_value": round(self.adc_raw / self.adc_raw_gain),
+            "water_depth": depth,
+        }
+        log.debug("Storing ADC state", extra=row)
+        await storage.POOL.write(storage.store_water_depth, row)
+        self.last_stored = now
+
+    async def flow_loop(self):
+        """Store flow meter seconds in batches, and once more when cancelled"""
+        try:
+            while True:
+                await asyncio.sleep(relay_log.FLUSH_SECS)
+                await self.store_flow()
+        finally:
+            await self.store_flow()
+
+    async def store_flow(self):
+        rows = self.flow.drain()
+        if not rows:
+            return
+        try:
+            await storage.POOL.write(storage.store_flow_rates, rows)
+        except Exception:
+            # Readings are dropped on failure too; the pumps matter more
+            log.exception("Couldn't store %d seconds of flow", len(rows))
+
+    async def schedule_loop(self):
+        while True:
+            tick_start = time.perf_counter()
+            now = datetime.now()
+            try:
+                await self.check_schedule(now)
+            except Exception:
+                log.exception("Schedule check failed")
+            metrics.histogram(
+                "hosebeast_scheduler_tick_seconds", "Relay schedule checks"
+            ).observe(time.perf_counter() - tick_start)
+            self.publish()
+            # Sleep until the top of the next minute
+            until_next_minute = even_minute() + timedelta(seconds=60) - now
+            await asyncio.sleep(until_next_minute.total_seconds())
+
+    async def check_schedule(self, now: datetime):
+        next_start, next_end = calculate_next_relay_times(
+            self.schedule["start_time"],
+            self.schedule["duration_mins"],
+            self.schedule["repeat_interval"],
+            self.schedule["repeat_units"],
+            now=now,
+        )
+        window = {"start": next_start, "end": next_end, "source": "schedule"}
+        relay_1_off = relay_control.RELAY_OFF[RELAY_1]
+        run = self.scheduled_run
+        running = bool(run) and run["state"] == "running"
+        if next_start <= now < next_end:
+            window_start = next_start.timestamp()
+            if run and run["window_start"] == window_start and not running:
+                # Stopped by hand or finished early; don't water twice
+                return
+            if relay_1_off:
+                pump_log().info("Inside a pump-on region; turning on", extra=window)
+                # Saved first, so a crash from here on resumes the run
+                await self.save_scheduled_run(
+                    window_start, next_end.timestamp(), "running"
+                )
+                self.switch_relay(RELAY_1, False, "schedule")
+            return
+        if running:
+            await self.mark_scheduled_run("done")
+        if not relay_1_off:
+            pump_log().info("Outside pump-on region; turning off", extra=window)
+            self.switch_relay(RELAY_1, True, "schedule")
+
+
+# ==========
+# = SOCKET =
+# ==========
+async def serve(controller: Controller, path: str = DEFAULT_SOCKET):
+    """Run `controller` and answer requests on the Unix socket at `path`"""
+    await _claim_socket(path)
+
+    async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = json.loads(await reader.readline() or "null")
+            if not isinstance(request, dict):
+                raise ControllerError("Requests must be JSON objects")
+            if request.get("cmd") == "subscribe":
+                async with aclosing(controller.subscribe()) as statuses:
+                    async for status in statuses:
+                        writer.write(json.dumps(status).encode() + b"\n")
+                        await writer.drain()
+            try:
+                response = {"ok": True, "result": await controller.handle(request)}
+            except (ControllerError, TypeError, ValueError) as e:
+                response = {"ok": False, "error": str(e)}
+            writer.write(json.dumps(response).encode() + b"\n")
+            await writer.drain()
+        except (ConnectionError, json.JSONDecodeError, ControllerError) as e:
+            log.debug("Client dropped: %s", e)
+        finally:
+            writer.close()
+
+    server = await asyncio.start_unix_server(handle_client, path=path)
+    os.chmod(path, 0o600)
+    log.info("Controller listening on %s", path)
+    try:
+        async with server:
+            await asyncio.gather(
+                controller.run(),
+                metrics.monitor_event_loop_lag(loop_name="controller"),
+            )
+    finally:
+        os.unlink(path)
+
+
+async def serve_when_elected(path: str = DEFAULT_SOCKET, retry_secs: float = 5.0):
+    """
+    Wait to hold the lock on `path`.lock, then build a controller from the
+    environment and serve it on `path`.
+
+    Every process that might own the hardware calls this; the OS drops the
+    lock when its holder exits, so a standby takes over within `retry_secs`.
+    """
+    lock_file = await asyncio.to_thread(open, path + ".lock", "a")
+    with lock_file:
+        announced = False
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if not announced:
+                    log.info("Controller lock held elsewhere; standing by")
+                    announced = True
+                await asyncio.sleep(retry_secs)
+        log.info("Elected controller (pid %d)", os.getpid())
+        await serve(Controller.from_env(), path)
+
+
+async def _claim_socket(path: str):
+    """Remove a stale socket file, refusing to start beside a live controller"""
+    if not os.path.exists(path):
+        return
+    try:
+        _, writer = await asyncio.open_unix_connection(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        os.unlink(path)
+        return
+    writer.close()
+    raise SystemExit(f"Another controller is already listening on {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the Hosebeast controller: depth sensor, pumps and DB writes"
+    )
+    parser.add_argument(
+        "--socket",
+        default=os.environ.get("HOSEBEAST_CONTROLLER", DEFAULT_SOCKET),
+        help=f"Unix socket to listen on (default: {DEFAULT_SOCKET})",
+    )
+    args = parser.parse_args()
+    configure_logging(log_name="controller")
+    try:
+        asyncio.run(serve_when_elected(args.socket))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
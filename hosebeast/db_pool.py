@@ -0,0 +1,87 @@
+"""
+Run SQLite work off the asyncio event loop.
+
+`DBPool` owns a few reader threads and a single writer thread, each with
+its own `sqlite_utils.Database` connection (SQLite connections can't be
+shared across threads). Any function that takes a `db=` keyword, which is
+every function in `storage`, can be awaited through it:
+
+    chart = await POOL.read(storage.load_depth_range, start_ts, end_ts)
+    await POOL.write(storage.store_water_depth, row)
+
+Writes are serialized through the one writer, so they never contend with
+each other. The database runs in WAL mode, so a long chart query on a
+reader never blocks a write, and neither blocks the event loop.
+"""
+
+import asyncio
+import functools
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+from sqlite_utils import Database
+
+from . import metrics
+
+
+class DBPool:
+    def __init__(
+        self,
+        path: str,
+        readers: int = 2,
+        connect: Callable[[str], Database] = Database,
+    ):
+        self.path = path
+        self._connect = connect
+        self._local = threading.local()
+        self._readers = ThreadPoolExecutor(
+            max_workers=readers, thread_name_prefix="hosebeast-db-read"
+        )
+        self._writer = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="hosebeast-db-write"
+        )
+
+    def connection(self) -> Database:
+        """This thread's connection, opened on first use"""
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._connect(self.path)
+            # WAL lets readers and the writer run concurrently; NORMAL sync
+            # is still crash-safe in WAL mode and saves fsyncs on SD cards
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    async def read(self, fn: Callable, *args, **kwargs) -> Any:
+        return await self._run(self._readers, "read", fn, args, kwargs)
+
+    async def write(self, fn: Callable, *args, **kwargs) -> Any:
+        return await self._run(self._writer, "write", fn, args, kwargs)
+
+    async def _run(
+        self,
+        executor: ThreadPoolExecutor,
+        kind: str,
+        fn: Callable,
+        args: tuple,
+        kwargs: dict,
+    ) -> Any:
+        queued = time.perf_counter()
+        call = functools.partial(self._call, kind, queued, fn, args, kwargs)
+        return await asyncio.get_running_loop().run_in_executor(executor, call)
+
+    def _call(
+        self, kind: str, queued: float, fn: Callable, args: tuple, kwargs: dict
+    ) -> Any:
+        metrics.histogram(
+            "hosebeast_db_queue_wait_seconds", "Time DB calls wait for a thread"
+        ).observe(time.perf_counter() - queued, kind=kind)
+        return fn(*args, db=self.connection(), **kwargs)
+
+    def close(self):
+        self._readers.shutdown(wait=True)
+        self._writer.shutdown(wait=True)
@@ -0,0 +1,215 @@
+"""
+Streaming export of stored history to CSV, JSON Lines and Parquet.
+
+    for chunk in export.stream("water_depths", "parquet", start_ts, end_ts, db):
+        out.write(chunk)
+
+Rows are read with a cursor, `CHUNK_ROWS` at a time, and each chunk is
+encoded and handed on before the next is read, so exporting years of
+minute data holds one chunk in memory, not the whole table. The `hosebeast
+export` command writes the chunks to a file; the dashboard's backend
+serves them at `/export/<table>.<format>?since=...&until=...`.
+
+Parquet needs the optional `pyarrow` package, imported only when a
+Parquet export starts so the CLI stays quick. Each chunk becomes one row
+group, with column types taken from the table's declared SQLite types, so
+every row group has the same schema.
+"""
+
+import csv
+import importlib.util
+import io
+import json
+import sqlite3
+from collections.abc import Iterator
+from datetime import datetime
+
+from sqlite_utils import Database
+
+from . import metrics, partitions, storage
+
+EXPORT_TABLES = [
+    "water_depths",
+    "calibration_points",
+    "calibration",
+    "relay_events",
+    "flow_rates",
+]
+FORMATS = ["csv", "jsonl", "parquet"]
+MEDIA_TYPES = {
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+CHUNK_ROWS = 10_000
+
+
+class ExportError(ValueError):
+    """An export that can't be made: unknown table or format, or no pyarrow"""
+
+
+def parse_time(value: str, now: datetime | None = None) -> float:
+    """
+    Epoch seconds for a user-supplied time: "day", "week" or "month" (that
+    long before now), an ISO date or datetime, or epoch seconds
+    """
+    now = now or datetime.now()
+    if value in storage.VALID_TIME_RANGES:
+        start = storage.time_range_start(value, now)
+        return start.timestamp() if start else 0.0
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise ValueError(
+            f"{value!r} isn't one of {storage.VALID_TIME_RANGES}, "
+            "an ISO date or epoch seconds"
+        ) from None
+
+
+def check(table: str, fmt: str):
+    if table not in EXPORT_TABLES:
+        raise ExportError(f"Can't export {table!r}; choose from {EXPORT_TABLES}")
+    if fmt not in FORMATS:
+        raise ExportError(f"Unknown format {fmt!r}; choose from {FORMATS}")
+    if fmt == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        raise ExportError("Parquet export needs pyarrow: `uv pip install pyarrow`")
+
+
+def columns(table: str, db: Database) -> list[tuple[str, str]]:
+    """(name, declared SQLite type) of each column of `table`"""
+    return [(column.name, column.type) for column in db[table].columns]
+
+
+def iter_chunks(
+    table: str,
+    start_ts: float | None = None,
+    end_ts: float | None = None,
+    db: Database | None = None,
+    chunk_rows: int = CHUNK_ROWS,
+) -> Iterator[list[tuple]]:
+    """Rows of `table` between two epoch times (inclusive), oldest first"""
+    db = storage.get_db() if db is None else db
+    if table not in db.table_names():
+        return
+    window = [start_ts or 0, end_ts if end_ts is not None else float("inf")]
+    exported = metrics.counter("hosebeast_export_rows_total", "Rows exported")
+    months = partitions.each_month(db, *window) if table == "water_depths" else [None]
+    for _ in months:
+        cursor = db.execute(
+            f"SELECT * FROM [{table}] WHERE timestamp >= ? AND timestamp <= ? "
+            "ORDER BY timestamp",
+            window,
+        )
+        while rows := cursor.fetchmany(chunk_rows):
+            exported.inc(len(rows), table=table)
+            yield rows
+
+
+def stream(
+    table: str,
+    fmt: str,
+    start_ts: float | None = None,
+    end_ts: float | None = None,
+    db: Database | None = None,
+    chunk_rows: int = CHUNK_ROWS,
+) -> Iterator[bytes]:
+    """`table` between two epoch times, encoded as `fmt`, a chunk at a time"""
+    check(table, fmt)
+    db = storage.get_db() if db is None else db
+    cols = columns(table, db) if table in db.table_names() else []
+    chunks = iter_chunks(table, start_ts, end_ts, db, chunk_rows)
+    encode = {"csv": _csv, "jsonl": _jsonl, "parquet": _parquet}[fmt]
+    yield from encode(cols, chunks)
+
+
+def stream_file(
+    path: str,
+    table: str,
+    fmt: str,
+    start_ts: float | None = None,
+    end_ts: float | None = None,
+) -> Iterator[bytes]:
+    """
+    `stream()` over its own connection to the database at `path`. Web
+    servers may advance it from a different thread for each chunk.
+    """
+    db = storage.open_db(sqlite3.connect(path, check_same_thread=False))
+    try:
+        yield from stream(table, fmt, start_ts, end_ts, db=db)
+    finally:
+        db.close()
+
+
+def _csv(cols: list[tuple[str, str]], chunks: Iterator[list[tuple]]):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(name for name, _ in cols)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def _jsonl(cols: list[tuple[str, str]], chunks: Iterator[list[tuple]]):
+    names = [name for name, _ in cols]
+    for rows in chunks:
+        lines = (json.dumps(dict(zip(names, row))) for row in rows)
+        yield ("\n".join(lines) + "\n").encode()
+
+
+class _ChunkSink(io.RawIOBase):
+    """A write-only stream that hands back what was written since last asked"""
+
+    def __init__(self):
+        self._pending = bytearray()
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._pending += data
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def take(self) -> bytes:
+        data = bytes(self._pending)
+        self._pending.clear()
+        return data
+
+
+def _arrow_type(pa, sqlite_type: str):
+    sqlite_type = sqlite_type.upper()
+    if "INT" in sqlite_type:
+        return pa.int64()
+    if any(name in sqlite_type for name in ("REAL", "FLOA", "DOUB")):
+        return pa.float64()
+    return pa.string()
+
+
+def _parquet(cols: list[tuple[str, str]], chunks: Iterator[list[tuple]]):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(name, _arrow_type(pa, type_)) for name, type_ in cols])
+    sink = _ChunkSink()
+    with pq.ParquetWriter(sink, schema, compression="zstd") as writer:
+        for rows in chunks:
+            arrays = [
+                pa.array([row[i] for row in rows], type=field.type)
+                for i, field in enumerate(schema)
+            ]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            yield sink.take()
+    # The footer is written on close
+    yield sink.take()
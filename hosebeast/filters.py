@@ -0,0 +1,315 @@
+"""
+Streaming filters for ADC samples.
+
+A `FilterChain` runs each raw sample through a series of stages and keeps
+the latest output. Every stage works on state of a fixed size, so
+filtering costs the same however long the app runs:
+
+- `MedianFilter`: median of the last N samples, to reject single-sample
+  spikes (a bad I2C read, a pump starting). Its cost grows with N, so N
+  is capped at `MAX_MEDIAN_WINDOW`
+- `EMAFilter`: exponential moving average with a time constant in seconds
+- `KalmanFilter`: 1-D constant-level Kalman filter; tracks slow changes in
+  depth closely while smoothing sensor noise, with less lag than a block
+  average of the same noise floor
+
+Chains are described with a short spec, e.g. "median:5,kalman:1:36", as
+read from the HOSEBEAST_FILTERS environment variable. `FilteredChannel`
+wraps an ADC channel so every reader of `.value` sees the filtered
+reading, and the I2C bus is read at most once per `min_interval_s` however
+many readers there are.
+
+Given an `AutoRange`, a `FilteredChannel` also picks the ADC gain for
+each read from the one before: the highest gain the level fits in, so a
+low tank uses as much of the ADS1115's range as a full one. Switching
+gain rescales the filters' state rather than starting over, so the
+filtered reading carries straight on, in counts at the new gain.
+"""
+
+import math
+import time
+from bisect import bisect_left, insort
+from collections.abc import Callable
+
+from .pressure_estimator import VALID_GAINS, SomeADCWrapper
+
+# Spike rejection, then a Kalman filter tuned for ~6 counts of sensor noise
+DEFAULT_CHAIN = "median:5,kalman:1:36"
+
+# A median window costs O(N) per sample; a few samples reject a spike
+MAX_MEDIAN_WINDOW = 31
+
+# The ADS1115 reads +/-4.096 V at gain 1 as +/-32767 counts
+ADS1115_FULL_SCALE_VOLTS = 4.096
+ADS1115_MAX_COUNT = 32767
+
+
+class RingBuffer:
+    """Fixed-size FIFO of floats; `push` returns the value it overwrote"""
+
+    def __init__(self, size: int):
+        if size < 1:
+            raise ValueError(f"Ring buffer size must be at least 1, not {size}")
+        self._items = [0.0] * size
+        self._next = 0
+        self.count = 0
+
+    def push(self, value: float) -> float | None:
+        evicted = self._items[self._next] if self.count == len(self._items) else None
+        self._items[self._next] = value
+        self._next = (self._next + 1) % len(self._items)
+        self.count = min(self.count + 1, len(self._items))
+        return evicted
+
+    def clear(self):
+        self._next = 0
+        self.count = 0
+
+    def scale(self, factor: float):
+        self._items = [item * factor for item in self._items]
+
+
+class MedianFilter:
+    """
+    Median of the last `window` samples. The window is kept sorted as well,
+    with `bisect`, so each sample costs O(window): a search plus a list
+    insert and delete that move up to `window` items. That's trivial at the
+    default 5, but not a fixed cost, hence MAX_MEDIAN_WINDOW.
+    """
+
+    def __init__(self, window: int = 5):
+        if window > MAX_MEDIAN_WINDOW:
+            raise ValueError(
+                f"Median window must be at most {MAX_MEDIAN_WINDOW}, not {window}"
+            )
+        self._ring = RingBuffer(window)
+        # The ring's contents, kept sorted as samples come and go
+        self._sorted: list[float] = []
+
+    def update(self, value: float, dt: float) -> float:
+        evicted = self._ring.push(value)
+        if evicted is not None:
+            del self._sorted[bisect_left(self._sorted, evicted)]
+        insort(self._sorted, value)
+        return self._sorted[len(self._sorted) // 2]
+
+    def reset(self):
+        self._ring.clear()
+        self._sorted.clear()
+
+    def rescale(self, factor: float):
+        self._ring.scale(factor)
+        # A positive factor keeps the order
+        self._sorted = [value * factor for value in self._sorted]
+
+
+class EMAFilter:
+    def __init__(self, time_constant_s: float = 5.0):
+        self.time_constant_s = time_constant_s
+        self.value: float | None = None
+
+    def update(self, value: float, dt: float) -> float:
+        if self.value is None:
+            self.value = value
+        else:
+            # Weight by elapsed time, so irregular sampling doesn't change
+            # how quickly the average follows
+            alpha = 1 - math.exp(-dt / self.time_constant_s)
+            self.value += alpha * (value - self.value)
+        return self.value
+
+    def reset(self):
+        self.value = None
+
+    def rescale(self, factor: float):
+        if self.value is not None:
+            self.value *= factor
+
+
+class KalmanFilter:
+    """
+    Estimates a slowly wandering level from noisy samples. `process_variance`
+    is how far the true level may drift per second (squared), and
+    `measurement_variance` the sensor's noise (squared), both in the units
+    of the samples.
+    """
+
+    def __init__(
+        self, process_variance: float = 1.0, measurement_variance: float = 36.0
+    ):
+        self.process_variance = process_variance
+        self.measurement_variance = measurement_variance
+        self.value: float | None = None
+        self.error = measurement_variance
+
+    def update(self, value: float, dt: float) -> float:
+        if self.value is None:
+            self.value = value
+            self.error = self.measurement_variance
+            return value
+        self.error += self.process_variance * dt
+        gain = self.error / (self.error + self.measurement_variance)
+        self.value += gain * (value - self.value)
+        self.error *= 1 - gain
+        return self.value
+
+    def reset(self):
+        self.value = None
+
+    def rescale(self, factor: float):
+        if self.value is not None:
+            self.value *= factor
+            self.error *= factor * factor
+
+
+STAGES = {
+    "median": (MedianFilter, int),
+    "ema": (EMAFilter, float),
+    "kalman": (KalmanFilter, float),
+}
+
+
+class FilterChain:
+    def __init__(self, stages: list):
+        self.stages = stages
+        self.value: float | None = None
+
+    def update(self, value: float, dt: float = 1.0) -> float:
+        for stage in self.stages:
+            value = stage.update(value, dt)
+        self.value = value
+        return value
+
+    def reset(self):
+        for stage in self.stages:
+            stage.reset()
+        self.value = None
+
+    def rescale(self, factor: float):
+        """Convert the state to new units, e.g. counts at another gain"""
+        for stage in self.stages:
+            stage.rescale(factor)
+        if self.value is not None:
+            self.value *= factor
+
+
+def parse_chain(spec: str) -> FilterChain:
+    """
+    Build a chain from e.g. "median:5,ema:3" or "median:5,kalman:1:36":
+    comma-separated stage names, each followed by its arguments
+    """
+    stages = []
+    for item in spec.split(","):
+        name, *args = item.strip().split(":")
+        if not name:
+            continue
+        if name not in STAGES:
+            raise ValueError(f"Unknown filter {name!r}; must be one of {list(STAGES)}")
+        cls, arg_type = STAGES[name]
+        stages.append(cls(*(arg_type(arg) for arg in args)))
+    return FilterChain(stages)
+
+
+class AutoRange:
+    """
+    Chooses the gain for the next read from the last raw reading: the
+    highest gain that puts it under `up_fraction` of full scale, or a
+    step down once a reading passes `down_fraction`. Readings in between
+    keep the gain they have, so a level sitting near a boundary doesn't
+    switch back and forth. A clipped reading could be anything above full
+    scale, so it drops straight to the lowest gain.
+    """
+
+    def __init__(
+        self,
+        gains: list[float] = VALID_GAINS,
+        up_fraction: float = 0.75,
+        down_fraction: float = 0.95,
+    ):
+        self.gains = sorted(gains)
+        self.up_counts = up_fraction * ADS1115_MAX_COUNT
+        self.down_counts = down_fraction * ADS1115_MAX_COUNT
+
+    @staticmethod
+    def clipped(raw: int) -> bool:
+        return not -ADS1115_MAX_COUNT - 1 < raw < ADS1115_MAX_COUNT
+
+    def choose(self, raw: int, gain: float) -> float:
+        if self.clipped(raw):
+            return self.gains[0]
+        if abs(raw) >= self.down_counts:
+            lower = [candidate for candidate in self.gains if candidate < gain]
+            return lower[-1] if lower else gain
+        for candidate in reversed(self.gains):
+            if candidate <= gain:
+                break
+            if abs(raw) * candidate / gain < self.up_counts:
+                return candidate
+        return gain
+
+
+class FilteredChannel:
+    """Same interface as `ADCWrapper`, reading through a `FilterChain`"""
+
+    def __init__(
+        self,
+        channel: SomeADCWrapper,
+        chain: FilterChain,
+        min_interval_s: float = 1.0,
+        autorange: AutoRange | None = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.channel = channel
+        self.chain = chain
+        self.min_interval_s = min_interval_s
+        self.autorange = autorange
+        self.clock = clock
+        # The latest unfiltered sample, and the gain it was read at
+        self.raw: int | None = None
+        self.raw_gain = channel.gain
+        self._last_sample: float | None = None
+
+    def sample(self) -> float:
+        """The filtered reading, taking a new sample if one is due"""
+        now = self.clock()
+        if self._last_sample is None or now - self._last_sample >= self.min_interval_s:
+            dt = 0.0 if self._last_sample is None else now - self._last_sample
+            self.raw_gain = self.channel.gain
+            self.raw = self.channel.value
+            self._last_sample = now
+            if self.autorange is None:
+                self.chain.update(self.raw, dt)
+            else:
+                self._autorange(self.raw, dt)
+        return self.chain.value
+
+    def _autorange(self, raw: int, dt: float):
+        # Clipped readings say nothing about the level, unless there's no
+        # other yet
+        if not self.autorange.clipped(raw) or self.chain.value is None:
+            self.chain.update(raw, dt)
+        gain = self.gain
+        new_gain = self.autorange.choose(raw, gain)
+        if new_gain != gain:
+            self.channel.gain = new_gain
+            self.chain.rescale(new_gain / gain)
+
+    @property
+    def value(self) -> int:
+        return round(self.sample())
+
+    @property
+    def voltage(self) -> float:
+        volts_per_count = ADS1115_FULL_SCALE_VOLTS / self.gain / ADS1115_MAX_COUNT
+        return self.sample() * volts_per_count
+
+    @property
+    def gain(self) -> float:
+        return self.channel.gain
+
+    @gain.setter
+    def gain(self, gain: float):
+        self.channel.gain = gain
+        # Counts mean something else at the new gain; start over
+        self.chain.reset()
+        self._last_sample = None
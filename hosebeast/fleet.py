@@ -0,0 +1,100 @@
+"""
+The hub's dashboard: every site's level, last week and pump time at once.
+
+Everything comes from the hub's own copies of each site's data (hub.py),
+so opening it costs the units nothing, and a site that's offline still
+shows what it last sent, with when that was.
+"""
+
+import asyncio
+from datetime import datetime
+
+import reflex as rx
+
+from . import hub
+
+
+class SiteCard(rx.Base):
+    name: str
+    depth: str
+    reading_at: str
+    pump_minutes: str
+    synced_at: str
+    error: str
+    # {"t": epoch seconds, "d": depth} for the last week
+    points: list[dict[str, float]]
+
+
+def _when(ts: float | None) -> str:
+    return datetime.fromtimestamp(ts).strftime("%b %d %H:%M") if ts else "never"
+
+
+def site_card(summary: dict) -> SiteCard:
+    chart = summary["chart"]
+    depth = summary["depth"]
+    return SiteCard(
+        name=summary["name"],
+        depth="—" if depth is None else f"{depth:.1f} cm",
+        reading_at=_when(summary["reading_ts"]),
+        pump_minutes=f"{summary['pump_minutes']:.0f}",
+        synced_at=_when(summary["synced_ts"]),
+        error=summary["error"] or "",
+        points=[{"t": t, "d": d} for t, d in zip(chart["t"], chart["d"])],
+    )
+
+
+class FleetState(rx.State):
+    sites: list[SiteCard] = []
+
+    @rx.background
+    async def load_sites(self):
+        summaries = await asyncio.to_thread(hub.fleet_summary)
+        async with self:
+            self.sites = [site_card(summary) for summary in summaries]
+
+
+def site_panel(site: SiteCard) -> rx.Component:
+    return rx.card(
+        rx.vstack(
+            rx.heading(site.name, size="5"),
+            rx.hstack(
+                rx.text(site.depth, size="5", weight="bold"),
+                rx.text("at ", site.reading_at, color_scheme="gray"),
+            ),
+            rx.text("Pumps today: ", site.pump_minutes, " min"),
+            rx.cond(
+                site.error != "",
+                rx.callout(
+                    "Last sync failed: " + site.error,
+                    icon="triangle_alert",
+                    color_scheme="red",
+                ),
+                rx.text("Synced ", site.synced_at, color_scheme="gray", size="1"),
+            ),
+            rx.recharts.line_chart(
+                rx.recharts.line(
+                    data_key="d", stroke="#3182CE", dot=False, type_="monotone"
+                ),
+                rx.recharts.x_axis(
+                    data_key="t", type_="number", scale="time", hide=True
+                ),
+                rx.recharts.y_axis(hide=True),
+                data=site.points,
+                width=300,
+                height=100,
+            ),
+        ),
+    )
+
+
+def fleet_layout() -> rx.Component:
+    return rx.vstack(
+        rx.hstack(
+            rx.heading("Hosebeast Fleet", size="3xl"),
+            rx.button(rx.icon("refresh-cw"), on_click=FleetState.load_sites),
+        ),
+        rx.flex(rx.foreach(FleetState.sites, site_panel), wrap="wrap", spacing="4"),
+        padding_top="2em",
+        padding_left="2em",
+        on_mount=FleetState.load_sites,
+    )
@@ -0,0 +1,141 @@
+"""
+Flow meters: the litres each zone actually got.
+
+A hall-effect flow meter (e.g. the common YF-S201) sends a pulse for every
+few millilitres. Each meter is a gpiozero `DigitalInputDevice`, and its
+edge callback, on gpiozero's own thread, only adds one to a counter that
+nothing else writes, so it needs no lock. Hundreds of pulses a second
+cost the event loop nothing, and nothing polls the pin.
+
+Once a second a `FlowMonitor` thread turns each meter's new pulses into
+litres for that second. The controller drains those seconds every few
+seconds and stores them in `flow_rates` through the database writer,
+the same way it stores readings.
+
+Meters are set up by HOSEBEAST_FLOW_METERS, comma-separated:
+
+    <input pin>:<pulses per litre>:<relay pin>
+
+e.g. "17:450:18" for a YF-S201 on GPIO17 measuring the zone Relay 1 (pin
+18) waters. The relay pin only names the zone.
+"""
+
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+# Seconds of flow kept if they can't be stored, e.g. while the disk is full
+MAX_BUFFERED_SECS = 24 * 60 * 60
+
+
+class FlowMeter:
+    def __init__(self, pin: int, pulses_per_litre: float, zone: str, device=None):
+        self.pin = pin
+        self.pulses_per_litre = pulses_per_litre
+        self.zone = zone
+        # Written only by the edge callback's thread
+        self.pulses = 0
+        self.litres_per_min = 0.0
+        # (epoch second, pulses) for each second with flow, oldest first
+        self.seconds: deque[tuple[int, int]] = deque(maxlen=MAX_BUFFERED_SECS)
+        self._tallied = 0
+        if device is None:
+            from gpiozero import DigitalInputDevice
+
+            # Meters pull the line low for each pulse
+            device = DigitalInputDevice(pin, pull_up=True)
+        self.device = device
+        self.device.when_activated = self._pulse
+
+    def _pulse(self):
+        self.pulses += 1
+
+    def tally(self, second: int):
+        """Record the pulses since the last tally against `second`"""
+        pulses = self.pulses
+        new, self._tallied = pulses - self._tallied, pulses
+        self.litres_per_min = new / self.pulses_per_litre * 60
+        if new:
+            self.seconds.append((second, new))
+
+    def close(self):
+        self.device.close()
+
+
+class FlowMonitor:
+    """Tallies every meter once a second, on a background thread"""
+
+    def __init__(self, meters: list[FlowMeter]):
+        self.meters = meters
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="flow-meters", daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        next_second = math.floor(time.time()) + 1
+        while not self._stop.wait(max(0.0, next_second - time.time())):
+            for meter in self.meters:
+                meter.tally(next_second - 1)
+            # After a stall, pulses since land on the current second
+            next_second = max(next_second + 1, math.floor(time.time()) + 1)
+
+    def drain(self) -> list[tuple]:
+        """(timestamp, pin, zone, pulses, litres) for each second since last drained"""
+        rows = []
+        for meter in self.meters:
+            while meter.seconds:
+                second, pulses = meter.seconds.popleft()
+                litres = pulses / meter.pulses_per_litre
+                rows.append((second, meter.pin, meter.zone, pulses, litres))
+        return rows
+
+    def rates(self) -> dict[str, float]:
+        """Litres per minute over the last second, by zone"""
+        rates: dict[str, float] = {}
+        for meter in self.meters:
+            rates[meter.zone] = rates.get(meter.zone, 0.0) + meter.litres_per_min
+        return rates
+
+    def close(self):
+        self._stop.set()
+        for meter in self.meters:
+            meter.close()
+
+
+def parse_meters(spec: str, zones: dict[int, str]) -> list[tuple[int, float, str]]:
+    """(input pin, pulses per litre, zone) for each meter in `spec`"""
+    meters = []
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        try:
+            pin, pulses_per_litre, relay_pin = item.split(":")
+            meters.append((int(pin), float(pulses_per_litre), zones[int(relay_pin)]))
+        except (ValueError, KeyError):
+            raise ValueError(
+                f"Bad flow meter {item!r}; expected <input pin>:<pulses per litre>:"
+                f"<relay pin>, with the relay pin one of {list(zones)}"
+            ) from None
+    return meters
+
+
+def from_env(zones: dict[int, str], mock: bool = False) -> FlowMonitor | None:
+    """The meters described by HOSEBEAST_FLOW_METERS, if it's set"""
+    spec = os.environ.get("HOSEBEAST_FLOW_METERS")
+    if not spec:
+        return None
+    meters = parse_meters(spec, zones)
+    if mock:
+        from gpiozero import Device
+        from gpiozero.pins.mock import MockFactory
+
+        Device.pin_factory = MockFactory()
+    log.info("Flow meters on pins %s", [pin for pin, _, _ in meters])
+    return FlowMonitor([FlowMeter(*meter) for meter in meters])
@@ -0,0 +1,152 @@
+"""
+A prebuilt frontend, served by the backend itself.
+
+`reflex run --env prod` rebuilds the Next.js frontend on every start, which
+takes minutes on a Pi 4. Instead, `hosebeast-build-frontend` exports the
+static bundle once, into `frontend_build/`, and precompresses it. The
+backend is then started alone (`reflex run --env prod --backend-only`)
+with HOSEBEAST_FRONTEND=frontend_build, and serves the bundle on its own
+port, so a cold start after a power cut only waits for Python to import.
+
+Hashed assets under `_next/static/` never change for a given name, so
+they're cached for a year. Pages are revalidated on every load, so a new
+build shows up at once. When the browser accepts it, a `.br` or `.gz`
+sibling made at build time is sent instead of the file, so nothing is
+compressed per request.
+
+Brotli needs the optional `brotli` package; without it only gzip copies
+are made.
+"""
+
+import argparse
+import gzip
+import logging
+import os
+import shutil
+import subprocess
+from pathlib import Path
+
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BUILD_DIR = "frontend_build"
+# Where `reflex export --no-zip` leaves the static bundle
+EXPORT_DIR = Path(".web/_static")
+
+COMPRESSIBLE_SUFFIXES = {".html", ".js", ".css", ".json", ".svg", ".txt", ".map"}
+# Smaller files fit in a packet or two either way
+MIN_COMPRESS_BYTES = 1024
+
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE = "no-cache"
+
+# (Accept-Encoding token, file suffix), in order of preference
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """StaticFiles that sends precompressed siblings and sets cache headers"""
+
+    def file_response(
+        self,
+        full_path: os.PathLike,
+        stat_result: os.stat_result,
+        scope,
+        status_code: int = 200,
+    ) -> Response:
+        accepted = Headers(scope=scope).get("accept-encoding", "")
+        compressible = Path(full_path).suffix in COMPRESSIBLE_SUFFIXES
+        encoding = None
+        for token, suffix in ENCODINGS:
+            compressed = f"{full_path}{suffix}"
+            if token in accepted and os.path.isfile(compressed):
+                # FileResponse guesses the type from "x.js" in "x.js.br"
+                full_path, stat_result = compressed, os.stat(compressed)
+                encoding = token
+                break
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        if encoding:
+            response.headers["content-encoding"] = encoding
+        if compressible:
+            response.headers["vary"] = "Accept-Encoding"
+        if "/_next/static/" in str(full_path):
+            response.headers["cache-control"] = IMMUTABLE_CACHE
+        else:
+            response.headers["cache-control"] = REVALIDATE_CACHE
+        return response
+
+
+def mount_frontend(api, directory: str):
+    """
+    Serve the built frontend at "/" of the FastAPI app `api`. Mount it after
+    every API route, since a mount at "/" answers everything after it.
+    """
+    api.mount("/", PrecompressedStaticFiles(directory=directory, html=True))
+    log.info("Serving prebuilt frontend from %s", directory)
+
+
+def precompress(directory: str | Path) -> int:
+    """
+    Write .gz (and .br) copies of compressible files. Returns the bytes
+    saved by the smallest copy of each file.
+    """
+    saved = 0
+    for path in Path(directory).rglob("*"):
+        if path.suffix not in COMPRESSIBLE_SUFFIXES or not path.is_file():
+            continue
+        data = path.read_bytes()
+        if len(data) < MIN_COMPRESS_BYTES:
+            continue
+        copies = {".gz": gzip.compress(data, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            copies[".br"] = brotli.compress(data, quality=11)
+        smallest = len(data)
+        for suffix, compressed in copies.items():
+            if len(compressed) < len(data):
+                Path(f"{path}{suffix}").write_bytes(compressed)
+                smallest = min(smallest, len(compressed))
+        saved += len(data) - smallest
+    return saved
+
+
+def build(build_dir: str = DEFAULT_BUILD_DIR):
+    """Export the frontend and precompress it into `build_dir`"""
+    subprocess.run(
+        ["reflex", "export", "--frontend-only", "--no-zip", "--loglevel", "info"],
+        check=True,
+    )
+    tmp_dir = Path(f"{build_dir}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    shutil.copytree(EXPORT_DIR, tmp_dir)
+    saved = precompress(tmp_dir)
+    # Build beside the old bundle, so a failed build leaves it in place
+    shutil.rmtree(build_dir, ignore_errors=True)
+    tmp_dir.rename(build_dir)
+    print(f"Frontend built in {build_dir}/ ({saved // 1024} KiB saved by compression)")
+    if brotli is None:
+        print("Install `brotli` to also precompress with Brotli")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build the Hosebeast frontend once, for the backend to serve"
+    )
+    parser.add_argument(
+        "--out",
+        default=DEFAULT_BUILD_DIR,
+        help=f"Directory for the built frontend (default: {DEFAULT_BUILD_DIR})",
+    )
+    args = parser.parse_args()
+    build(args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,37 +3,86 @@
 # Import all the pages.
 # Ignore the unused imports here; they have template side effects
 # that add them to the app
-import reflex as rx
-import asyncio
-import math
+import logging
+import os
 import time
+import uuid
+from contextlib import aclosing
+from datetime import date, datetime, timedelta
 
-from datetime import datetime, timedelta
-
-from . import styles
-from .relay_control import set_relay, RELAY_1, RELAY_2
-from .pressure_estimator import (
-    get_adc_channel,
-    SomeADCWrapper,
-    MockADCWrapper,  # noqa: F401
-    ADCWrapper,  # noqa: F401
-)
-from .web_utils import red_green_button, get_bool_from_env
-
-
-from sqlite_utils import Database
-
-DB = Database("hosebeast.db")
-
-VALID_TIME_RANGES = ["day", "week", "month", "all"]
-
-VALID_TIME_UNITS = ["minutes", "hours", "days"]
-VALID_MEASUREMENT_UNITS = ["cm", "in", "gal", "L"]
+import reflex as rx
+from fastapi import HTTPException
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
+
+from . import export, fleet, hub, metrics, storage, styles, tank
+from .client import DEFAULT_SOCKET, ControllerClient
+from .controller import serve_when_elected
+from .frontend import mount_frontend
+from .logs import configure_logging
+from .relay_control import RELAY_1, RELAY_2
+from .sampling import SamplingPolicy
+from .scheduling import VALID_TIME_UNITS, calculate_next_relay_times
+from .state_store import StateManagerSQLite
+from .storage import VALID_TIME_RANGES, delete_db_range  # noqa: F401
+from .tank import VALID_MEASUREMENT_UNITS, VOLUME_UNITS  # noqa: F401
+from .web_utils import red_green_button
+
+# Depths are shown to 0.1 cm
+DEPTH_DISPLAY_STEP = 0.1
+# Narrowest window the chart zooms in to
+MIN_VIEW_SECS = 3600
+# Days of water use shown under the chart
+USAGE_DAYS = 7
+
+configure_logging()
+log = logging.getLogger(__name__)
 
 # reflex doesn't have a good way to get command line arguments.
-# So we read from environment vars instead
-HOSEBEAST_MOCK = get_bool_from_env("HOSEBEAST_MOCK")
-SENSOR: SomeADCWrapper = get_adc_channel(0, gain=1.0, mock=HOSEBEAST_MOCK)
+# So we read from environment vars instead:
+# - HOSEBEAST_CONTROLLER: the socket of a separate `hosebeast-controller`
+#   process, which then owns the sensor, pumps and DB writes. Without it,
+#   one backend worker is elected to run the controller; see controller.py
+# - HOSEBEAST_MOCK: use mock ADC data
+# - HOSEBEAST_SIM: run against a simulated tank, ADC and relays in real time
+# - HOSEBEAST_FILTERS: the sensor's filter chain, e.g. "median:5,kalman:1:36"
+# - HOSEBEAST_ADC_GAIN: the ADC gain to start at, or "auto" to have the
+#   controller pick the best one for every reading
+# - HOSEBEAST_FRONTEND: a frontend built by `hosebeast-build-frontend`, for
+#   the backend to serve itself; see frontend.py
+# - HOSEBEAST_PARTITIONS: a directory to keep each month of readings in, as
+#   its own file; read by storage.py, see partitions.py
+# - HOSEBEAST_TANK: the tank's shape, e.g. "cylinder:150:120", for volumes
+#   and daily water use; see tank.py
+# - HOSEBEAST_HUB: run as a hub instead of a unit: a directory of per-site
+#   databases, kept in sync from the units in HOSEBEAST_HUB_SITES and shown
+#   on the fleet page; see hub.py
+HOSEBEAST_CONTROLLER = os.environ.get("HOSEBEAST_CONTROLLER")
+# Every worker is a client, even the one that runs the controller, so no
+# worker touches the hardware at import (gunicorn imports before forking)
+CONTROLLER = ControllerClient(HOSEBEAST_CONTROLLER or DEFAULT_SOCKET)
+TANK = tank.from_env()
+# pid: an id no other process will have, even after a restart reuses the pid
+_PROCESS_IDS: dict[int, str] = {}
+
+
+def process_id() -> str:
+    """This process's id, worked out after gunicorn forks the workers"""
+    pid = os.getpid()
+    if pid not in _PROCESS_IDS:
+        _PROCESS_IDS[pid] = f"{pid}-{uuid.uuid4().hex}"
+    return _PROCESS_IDS[pid]
+
+async def time_range_view(time_range: str) -> tuple[float, float]:
+    """The (start, end) epoch seconds of `time_range`, ending now"""
+    now = datetime.now()
+    start = storage.time_range_start(time_range, now)
+    if start is None:
+        earliest = await storage.POOL.read(storage.earliest_depth_time)
+        if earliest is None:
+            return (now - timedelta(days=1)).timestamp(), now.timestamp()
+        start = datetime.fromtimestamp(earliest)
+    return start.timestamp(), now.timestamp()
+
 
 class HBState(rx.State):
     """The app state."""
@@ -41,12 +90,37 @@ class HBState(rx.State):
     relay_1_off: bool = True
     relay_2_off: bool = True
 
+    # A gain, or "auto" to let the controller choose one for each reading
     adc_gain: str = "1"
+    # Displayed readings; these only change when the displayed depth does,
+    # so ADC noise doesn't send a state update to every browser each tick.
+    # _adc_voltage and _adc_raw hold the latest filtered reading
     adc_voltage: float = 2.512
     adc_raw: int = 16000
-
-    time_range: str = "week"  # one of VALID_TIME_RANGES
-    depth_data: list[dict[str, float]] = []
+    # The gain adc_raw was read at
+    active_gain: str = "1"
+
+    # One of VALID_TIME_RANGES, or "" once the chart is zoomed or panned
+    time_range: str = "week"
+    # The chart's visible window, in epoch seconds
+    view_start: int = 0
+    view_end: int = 0
+    # Columnar chart data from storage.load_depth_range: {"t": [...], "d": [...]},
+    # with depths converted to measurement_unit
+    depth_data: dict[str, list[float]] = {"t": [], "d": []}
+    # Litres per minute through each zone's flow meter, if any are fitted
+    flow_rates: list[dict[str, str]] = []
+    # Leak and sensor alerts the controller has raised and not yet cleared
+    alerts: list[dict[str, str]] = []
+    # Pump runs within the view, {"x1": start, "x2": end}, shaded on the chart
+    pump_runs: list[dict[str, int]] = []
+
+    # One of measurement_units; volumes need HOSEBEAST_TANK
+    measurement_unit: str = "cm"
+    measurement_units: list[str] = tank.units(TANK)
+    has_tank: bool = TANK is not None
+    # The last USAGE_DAYS of storage.load_water_use, formatted for display
+    water_use: list[dict[str, str]] = []
 
     # Pump scheduling
     p1_start_time: str = "4:30"
@@ -55,38 +129,159 @@ class HBState(rx.State):
     p1_repeat_units: str = "days"  # from VALID_TIME_UNITS
 
     # Backend-only vars
-    _update_secs: int = 2
-    _update_is_running: bool = False
-    _db_update_secs: int = 60
-    _last_db_time: float = 0
+    _adc_voltage: float = 2.512
+    _adc_raw: int = 16000
+    _active_gain: str = "1"
+    # Visible tabs show every status from the controller. Hidden tabs
+    # (another app in front, screen off) are updated less often
+    _hidden_update_secs: int = 20
+    _visibility_check_secs: int = 10
+    _page_visible: bool = True
+    _last_visibility_check: float = 0
+    _last_status_applied: float = 0
+    # The minute of the controller's last status; next_relay_1_times follows it
+    _schedule_checked_at: float = 0
+    _last_stored: float = 0
+    # process_id() of the worker running start_adc_updates for this tab.
+    # State is saved across restarts, so a flag alone would outlive the loop
+    _updates_running_in: str = ""
+    # Whether the chart's window ends at the present and moves with it
+    _follow_now: bool = True
 
     _depth_slope: float = 0.0001
     _depth_intercept: float = -2
 
     async def toggle_relay_1(self):
         self.relay_1_off = not self.relay_1_off
-        set_relay(RELAY_1, self.relay_1_off)
+        await CONTROLLER.set_relay(RELAY_1, self.relay_1_off)
 
     async def toggle_relay_2(self):
         self.relay_2_off = not self.relay_2_off
-        set_relay(RELAY_2, self.relay_2_off)
+        await CONTROLLER.set_relay(RELAY_2, self.relay_2_off)
 
-    def set_time_range(self, time_range: str):
+    @rx.background
+    async def set_time_range(self, time_range: str):
         if time_range not in VALID_TIME_RANGES:
             raise ValueError(
                 f"Invalid time range: {time_range}; must be one of {VALID_TIME_RANGES}"
             )
-        self.time_range = time_range
-        self.update_depth_data()
+        start_ts, end_ts = await time_range_view(time_range)
+        await self.show_view(start_ts, end_ts, time_range, follow_now=True)
+
+    @rx.background
+    async def zoom_chart(self, factor: float):
+        """Scale the chart's window by `factor`; below 1 zooms in"""
+        async with self:
+            start_ts, end_ts = self.view_start, self.view_end
+            follow_now = self._follow_now
+        span = max(MIN_VIEW_SECS, (end_ts - start_ts) * factor)
+        if follow_now:
+            # Keep showing the present; only the start moves
+            end_ts = time.time()
+            start_ts = end_ts - span
+        else:
+            center = (start_ts + end_ts) / 2
+            start_ts, end_ts = center - span / 2, center + span / 2
+        await self.show_view(start_ts, end_ts, follow_now=follow_now)
 
-    def update_depth_data(self):
-        # If we change the time range, we should reload the data
-        self.depth_data = self.load_water_depth_data()
+    @rx.background
+    async def pan_chart(self, fraction: float):
+        """Move the chart's window by `fraction` of its width; negative is back"""
+        async with self:
+            start_ts, end_ts = self.view_start, self.view_end
+        span = end_ts - start_ts
+        now = time.time()
+        # There's nothing to see past the present
+        end_ts = min(now, end_ts + span * fraction)
+        await self.show_view(
+            end_ts - span,
+            end_ts,
+            follow_now=end_ts >= now - SamplingPolicy.min_store_secs,
+        )
 
-    @rx.var
+    async def show_view(
+        self,
+        start_ts: float,
+        end_ts: float,
+        time_range: str = "",
+        follow_now: bool = False,
+    ):
+        """Move the chart to [start_ts, end_ts] and load its data"""
+        view = (int(start_ts), int(end_ts))
+        async with self:
+            self.view_start, self.view_end = view
+            self.time_range = time_range
+            self._follow_now = follow_now
+            unit = self.measurement_unit
+        # Query without holding the state lock, so a slow chart query
+        # doesn't hold up relay clicks
+        depth_data = await storage.POOL.read(storage.load_depth_range, *view)
+        # A lookup per point, so volume charts cost what depth charts do
+        depth_data = tank.convert_chart(depth_data, unit, TANK)
+        runs = await storage.POOL.read(storage.pump_runs, *view)
+        # Clipped to the view; a run still going is drawn up to now
+        pump_runs = [
+            {
+                "x1": int(max(run["start_ts"], view[0])),
+                "x2": int(min(run["end_ts"] or time.time(), view[1])),
+            }
+            for run in runs
+        ]
+        async with self:
+            # Drop stale results if the view moved again meanwhile
+            if (self.view_start, self.view_end) == view:
+                self.depth_data = depth_data
+                self.pump_runs = pump_runs
+
+    @rx.var(cache=True)
     def water_depth(self) -> float:
-        depth = self.adc_raw * self._depth_slope + self._depth_intercept
-        return round(depth, 1)
+        return self.depth_for_raw(self.adc_raw)
+
+    def depth_for_raw(self, raw: int) -> float:
+        """Depth in cm for an ADC reading, at displayed precision"""
+        return round(raw * self._depth_slope + self._depth_intercept, 1)
+
+    @rx.var(cache=True)
+    def water_level(self) -> float:
+        """The current reading in measurement_unit"""
+        depth = self.depth_for_raw(self.adc_raw)
+        return tank.convert(depth, self.measurement_unit, TANK)
+
+    @rx.var(cache=True)
+    def level_label(self) -> str:
+        return "Volume" if self.measurement_unit in VOLUME_UNITS else "Depth"
+
+    @rx.background
+    async def set_measurement_unit(self, unit: str):
+        async with self:
+            if unit not in self.measurement_units:
+                raise ValueError(
+                    f"Invalid unit: {unit}; must be one of {self.measurement_units}"
+                )
+            self.measurement_unit = unit
+            view = (self.view_start, self.view_end)
+            time_range, follow_now = self.time_range, self._follow_now
+        await self.show_view(*view, time_range, follow_now=follow_now)
+        await self.load_water_use()
+
+    async def load_water_use(self):
+        """Show the last USAGE_DAYS of daily water use, in a volume unit"""
+        if TANK is None:
+            return
+        since = date.today() - timedelta(days=USAGE_DAYS - 1)
+        days = await storage.POOL.read(storage.load_water_use, since)
+        async with self:
+            unit = self.measurement_unit
+            unit = unit if unit in VOLUME_UNITS else "L"
+            self.water_use = [
+                {
+                    "day": day["day"],
+                    "pumped": f"{tank.litres_in(day['pumped_l'], unit):g} {unit}",
+                    "used": f"{tank.litres_in(day['used_l'], unit):g} {unit}",
+                    "refilled": f"{tank.litres_in(day['refilled_l'], unit):g} {unit}",
+                }
+                for day in reversed(days)
+            ]
 
     async def handle_calibration_submit(self, form_dict: dict):
         try:
@@ -94,318 +289,192 @@ class HBState(rx.State):
             actual_depth = float(form_dict["actual_depth"])
             await self.calibrate_depth(actual_depth)
         except ValueError:
-            print(f'Invalid depth: {form_dict["actual_depth"]}')
+            log.warning("Invalid depth: %r", form_dict["actual_depth"])
             return
 
-    async def average_raw_and_depths(
-        self, measurements=10, interval_s=1
-    ) -> tuple[int, float]:
-        measurements = int(max(measurements, 1))
-        total = 0
-        total_depth = 0
-        # average several readings before we record
-        for i in range(measurements):
-            total += self.adc_raw
-            total_depth += self.water_depth
-            await asyncio.sleep(1)
-        mean_raw = int(total / measurements)
-        mean_depth = float(total_depth / measurements)
-        mean_depth = round(mean_depth, 1)
-        return (mean_raw, mean_depth)
-
     async def calibrate_depth(self, actual_depth: float):
-        # TODO: Given a set of known depths and pressures, calculate the slope and intercept
-        # of the line that best fits the data.
-        # We should probably just store the data in the database and
-        # take a linear regression of the data to get the slope and intercept.
-
-        # 1. Store actual_depth and adc_raw in the database
-        # 2. Take a linear regression of all the data points to get the slope and intercept
-        # 3. Store the slope and intercept in the database
-        # 4. Use the slope and intercept to calculate the depth
-
-        mean_raw, mean_depth = await self.average_raw_and_depths()
-
-        # Store actual_depth and adc_raw in the database
-        adc_gain = float(self.adc_gain)
-        now_minute = even_minute()
-        DB["calibration_points"].insert(
-            {
-                "timestamp": now_minute.timestamp(),
-                "datetime": now_minute.isoformat(),
-                "adc_raw": mean_raw,
-                "actual_depth": actual_depth,
-                "adc_gain": adc_gain,
-            },
-            pk="timestamp",
-            replace=True,
-            alter=True,
-        )
+        # The controller records the current reading against actual_depth,
+        # refits the slope and intercept, and stores both
+        calibration = await CONTROLLER.calibrate(actual_depth)
+        self._depth_slope = calibration["slope"]
+        self._depth_intercept = calibration["intercept"]
 
-        print(
-            f"Calibration: {now_minute}: Storing raw value {mean_raw} for depth {actual_depth:.1f} cm"
-        )
-
-        # Retrieve all calibration points
-        calibration_points = [
-            (row["adc_raw"], float(row["actual_depth"]))
-            for row in DB["calibration_points"].rows_where("adc_gain = ?", [adc_gain])
-        ]
-
-        # Calculate slope and intercept
-        self._depth_slope, self._depth_intercept = (
-            linear_regression_with_outlier_removal(calibration_points)
-        )
-
-        # Store the new slope and intercept in the database
-        DB["calibration"].insert(
-            {
-                "timestamp": now_minute.timestamp(),
-                "datetime": now_minute.isoformat(),
-                "slope": self._depth_slope,
-                "intercept": self._depth_intercept,
-                "adc_gain": adc_gain,
-            },
-            pk="timestamp",
-            replace=True,
-            alter=True,
-        )
-
-    def load_calibration(self):
-        # Load the slope and intercept from the most recent database record
-        calibration = next(
-            DB["calibration"].rows_where(order_by="-timestamp", limit=1), None
-        )
-
-        if calibration:
-            print(f"Loaded calibration: {calibration}")
-            self._depth_slope = calibration["slope"]
-            self._depth_intercept = calibration["intercept"]
-
-    def load_water_depth_data(self) -> list[dict]:
-        now = datetime.now()
-        if "water_depths" not in DB.table_names():
-            return []
-        earliest_date_query = DB.query(
-            "SELECT MIN(timestamp) as earliest_date FROM water_depths"
-        )
-        start_ts = next(earliest_date_query)["earliest_date"]
-        earliest_date = datetime.fromtimestamp(start_ts)
-
-        if self.time_range == "day":
-            start_date = now - timedelta(days=1)
-        elif self.time_range == "week":
-            start_date = now - timedelta(weeks=1)
-        elif self.time_range == "month":
-            start_date = now - timedelta(days=30)
-        else:  # all time
-            earliest_date_query = DB.query(
-                "SELECT MIN(timestamp) as earliest_date FROM water_depths"
-            )
-            start_ts = next(earliest_date_query)["earliest_date"]
-            start_date = datetime.fromtimestamp(start_ts)
-
-        start_date = max(earliest_date, start_date)
-        start_ts = start_date.timestamp()
-
-        # total_seconds = (now - start_date).total_seconds()
-
-        rows_to_fetch = 200
-        # NOTE: 2024-08-31: Because this query skips integer-numbered rows,
-        # we can only be precise about the number of rows fetched within
-        # +/- rows_to_fetch rows. So... don't limit the query to rows_to_fetch
-        # rows; that results in missing the most recent data.
-
-
-        # Count the rows we'd get, in the entire range from start_ts to now,
-        # then divide by the number of rows we want to fetch and query for
-        # that many rows.
-        # NOTE: if we've been adding to the table irregularly, this will
-        # skip those gaps, overrepresenting times when we did get data
-        # Maybe we really want something like "get one value for each of
-        # rows_to_fetch timeslots between start_ts and now, and interpolate 
-        # vals if a given timeslot is empty"
-        rows_available = DB["water_depths"].count_where("timestamp >= ?", [start_ts])
-        interval_rows = max(1, int(rows_available / rows_to_fetch))
-
-        query = """
-        SELECT * FROM (
-            SELECT *, ROW_NUMBER() OVER (ORDER BY timestamp) AS row_num
-            FROM water_depths
-            WHERE timestamp >= ?
-        ) AS numbered
-        WHERE row_num % ? = 0
-        ORDER BY timestamp
-        """
-        # LIMIT ?
-        # data = DB.query(query, [start_ts, interval_rows, rows_to_fetch])
-        data = DB.query(query, [start_ts, interval_rows])
-        # NOTE: I'm not sure why I need to call list() on the returned "data"
-        # generator, but if I don't, I get an empty list
-        rows = [r for r in list(data)]
-        return rows
-
-    def update_adc_gain(self, gain: str):
+    async def update_adc_gain(self, gain: str):
         self.adc_gain = gain
-        SENSOR.gain = 2 / 3 if gain == "2/3" else int(gain)
-
-    async def update_adc_voltage(self):
-        self.adc_voltage = round(SENSOR.voltage, 3)
-        self.adc_raw = SENSOR.value
-        # every minute, we'll store the pressure in the database
-        await self.store_adc_state()
+        await CONTROLLER.set_gain(gain)
+
+    def _set_if_changed(self, name: str, value):
+        # Setting a var sends it to the browser even if it's unchanged
+        if getattr(self, name) != value:
+            setattr(self, name, value)
+
+    def apply_status(self, status: dict):
+        """Show a status from the controller"""
+        self._set_if_changed("relay_1_off", status["relay_1_off"])
+        self._set_if_changed("relay_2_off", status["relay_2_off"])
+        self._set_if_changed("adc_gain", status["adc_gain"])
+        self._set_if_changed("_depth_slope", status["depth_slope"])
+        self._set_if_changed("_depth_intercept", status["depth_intercept"])
+        schedule = status["schedule"]
+        self._set_if_changed("p1_start_time", schedule["start_time"])
+        self._set_if_changed("p1_duration_mins", schedule["duration_mins"])
+        self._set_if_changed("p1_repeat_interval", schedule["repeat_interval"])
+        self._set_if_changed("p1_repeat_units", schedule["repeat_units"])
+        self._set_if_changed("_schedule_checked_at", status["time"] // 60 * 60)
+        alerts = [
+            {
+                "message": alert["message"],
+                "since": datetime.fromtimestamp(alert["since"]).strftime("%b %d %H:%M"),
+            }
+            for alert in status.get("alerts", [])
+        ]
+        self._set_if_changed("alerts", alerts)
+        flow_rates = [
+            {"zone": zone, "rate": f"{rate:.1f}"}
+            for zone, rate in status.get("flow_lpm", {}).items()
+        ]
+        self._set_if_changed("flow_rates", flow_rates)
+
+        self._adc_voltage = status["adc_voltage"]
+        self._adc_raw = status["adc_raw"]
+        self._active_gain = status["active_gain"]
+        # Only touch the displayed readings when the displayed depth moves.
+        # Noise flips the last digit back and forth, so it has to move by
+        # more than one step
+        moved = abs(self.depth_for_raw(self._adc_raw) - self.water_depth)
+        pushed = moved > DEPTH_DISPLAY_STEP * 1.5
+        if pushed:
+            self.adc_voltage = round(self._adc_voltage, 3)
+            self.adc_raw = self._adc_raw
+            self.active_gain = self._active_gain
+        metrics.counter(
+            "hosebeast_live_updates_total", "Live readings, sent or unchanged"
+        ).inc(result="sent" if pushed else "unchanged")
+
+    def set_page_visibility(self, visibility_state: str):
+        """Callback with the browser's document.visibilityState"""
+        self._page_visible = visibility_state != "hidden"
 
     @rx.background
     async def start_adc_updates(self):
         # Make sure this is only called once, or rejects subsequent calls
         async with self:
-            if self._update_is_running:
+            if self._updates_running_in == process_id():
                 return
-            else:
-                self._update_is_running = True
-
-            # Load info data from the database;
-            # we only need to do this once
-            # self.check_relay_schedule()
-            self.load_schedule_from_db()
-            self.load_calibration()
-            self.update_depth_data()
-            yield HBState.check_relay_schedule()
-
-        while True:
-            async with self:
-                await self.update_adc_voltage()
-            await asyncio.sleep(self._update_secs)
-
-    @rx.background
-    async def check_relay_schedule(self):
-        while True:
+            self._updates_running_in = process_id()
+            time_range = self.time_range
+        try:
+            async for update in self._adc_updates(time_range):
+                yield update
+        finally:
             async with self:
-                now = datetime.now()
-                next_start, next_end = calculate_next_relay_times(
-                    self.p1_start_time,
-                    self.p1_duration_mins,
-                    self.p1_repeat_interval,
-                    self.p1_repeat_units,
-                )
-                # print(
-                #     f"{now}: Checking for relay schedules for range ({next_start}, {next_end})"
-                # )
-
-                if next_start <= now < next_end:
-                    print(
-                        f"{now}: Inside a pump-on region: ({next_start}, {next_end}); turning on"
-                    )
-
-                    if self.relay_1_off:
-                        await self.toggle_relay_1()
-                elif not self.relay_1_off:
-                    print(
-                        f"{now}: Outside region  ({next_start}, {next_end}); turning off"
-                    )
-                    await self.toggle_relay_1()
-            # Sleep until the top of the next minute
-            until_next_minute = even_minute() + timedelta(seconds=60) - now
-            await asyncio.sleep(until_next_minute.total_seconds())  # Check every minute
-
-    async def store_adc_state(self):
-        now = time.time()
-        # if we've already stored the data in the last self._db_update_secs
-        # seconds, just return
-        if now < self._last_db_time + self._db_update_secs:
-            return
-
-        mean_raw, mean_depth = await self.average_raw_and_depths()
-        # We can't go below 0
-        mean_depth = max(0, mean_depth)
-        # We haven't stored the data in the last self._db_update_secs seconds,
-        # so store it now
-        self._last_db_time = now
-        # NOTE: if we start storing differently than once a minute,
-        # we might need to adjust the datetime we set here
-        now_minute = even_minute()
-        row = {
-            "timestamp": now_minute.timestamp(),
-            "datetime": now_minute.isoformat(),
-            "raw_value": mean_raw,
-            "water_depth": mean_depth,
-        }
-        print(f"Storing ADC state: {row}")
-        DB["water_depths"].insert(row, pk="timestamp", replace=True)
-        # Every time we store data, let's reload the graph data, too
-        self.update_depth_data()
+                self._updates_running_in = ""
+
+    async def _adc_updates(self, time_range: str):
+        start_ts, end_ts = await time_range_view(time_range)
+        await self.show_view(start_ts, end_ts, time_range, follow_now=True)
+        await self.load_water_use()
+
+        # Sampling, storing and the pump schedule all happen in the
+        # controller; sessions just show what it reports
+        async with aclosing(CONTROLLER.subscribe()) as statuses:
+            async for status in statuses:
+                async with self:
+                    now = time.time()
+                    if (
+                        self._page_visible
+                        or now >= self._last_status_applied + self._hidden_update_secs
+                    ):
+                        self._last_status_applied = now
+                        self.apply_status(status)
+                    # Hidden tabs are asked on every update they get, so they
+                    # speed back up within one (slow) update of being shown
+                    last_check = self._last_visibility_check
+                    if (
+                        not self._page_visible
+                        or now >= last_check + self._visibility_check_secs
+                    ):
+                        self._last_visibility_check = now
+                        yield rx.call_script(
+                            "document.visibilityState",
+                            callback=HBState.set_page_visibility,
+                        )
+                    stored = status["last_stored"] != self._last_stored
+                    self._last_stored = status["last_stored"]
+                    start_ts, end_ts = self.view_start, self.view_end
+                    time_range, follow_now = self.time_range, self._follow_now
+                # If the chart is showing the present, move it along to
+                # include a new row; a window in the past hasn't changed
+                if stored and follow_now:
+                    span = end_ts - start_ts
+                    await self.show_view(now - span, now, time_range, follow_now=True)
+                if stored:
+                    await self.load_water_use()
 
     # ===================
     # = pump scheduling =
     # ===================
-    def set_p1_start_time(self, val: str):
+    async def set_p1_start_time(self, val: str):
         # val should be hh:mm, with integers on either side
         # of the colon. If we don't match those, just ignore
         try:
             h, m = (int(v) for v in val.split(":"))
             self.p1_start_time = val
-            self.store_schedule()
+            await self.store_schedule()
         except ValueError:
             pass
 
     # in case of bad data, just ignore; usually good data
     # is typed immediately afterwards
-    def set_p1_duration_mins(self, val: str):
+    async def set_p1_duration_mins(self, val: str):
         try:
             self.p1_duration_mins = int(val)
-            self.store_schedule()
+            await self.store_schedule()
         except ValueError:
             pass
 
-    def set_p1_repeat_interval(self, val: str):
+    async def set_p1_repeat_interval(self, val: str):
         # in case of bad data, just ignore; usually good data
         # is typed immediately afterwards
         try:
             self.p1_repeat_interval = int(val)
-            self.store_schedule()
+            await self.store_schedule()
         except ValueError:
             pass
 
-    def set_p1_repeat_units(self, val: str):
+    async def set_p1_repeat_units(self, val: str):
         self.p1_repeat_units = val
-        self.store_schedule()
+        await self.store_schedule()
 
-    @rx.var
+    @rx.var(cache=True)
     def next_relay_1_times(self) -> tuple[str, str]:
+        # Cached, so this only recomputes when the schedule changes or the
+        # minute does, not on every live reading
+        now = None
+        if self._schedule_checked_at:
+            now = datetime.fromtimestamp(self._schedule_checked_at)
         next_start, next_end = calculate_next_relay_times(
             self.p1_start_time,
             self.p1_duration_mins,
             self.p1_repeat_interval,
             self.p1_repeat_units,
+            now=now,
         )
         return (
             next_start.strftime("%Y-%m-%d %H:%M:%S"),
             next_end.strftime("%Y-%m-%d %H:%M:%S"),
         )
 
-    def load_schedule_from_db(self):
-        if "schedules" not in DB.table_names():
-            return
-        schedule = DB["schedules"].get(1)  # Assuming we use id=1 for the first schedule
-        if schedule:
-            self.p1_start_time = schedule["start_time"]
-            self.p1_duration_mins = schedule["duration_mins"]
-            self.p1_repeat_interval = schedule["repeat_interval"]
-            self.p1_repeat_units = schedule["repeat_units"]
-
-    def store_schedule(self):
-        DB["schedules"].upsert(
-            {
-                "id": 1,
-                "start_time": self.p1_start_time,
-                "duration_mins": self.p1_duration_mins,
-                "repeat_interval": self.p1_repeat_interval,
-                "repeat_units": self.p1_repeat_units,
-            },
-            pk="id",
+    async def store_schedule(self):
+        # The controller stores the schedule and follows it from now on
+        await CONTROLLER.set_schedule(
+            self.p1_start_time,
+            self.p1_duration_mins,
+            self.p1_repeat_interval,
+            self.p1_repeat_units,
         )
 
-    def update_schedule(
+    async def update_schedule(
         self,
         start_time: str,
         duration_mins: int,
@@ -416,129 +485,7 @@ class HBState(rx.State):
         self.p1_duration_mins = duration_mins
         self.p1_repeat_interval = repeat_interval
         self.p1_repeat_units = repeat_units
-        self.store_schedule()()
-
-
-# ===========
-# = HELPERS =
-# ===========
-def linear_regression_with_outlier_removal(
-    points: list[tuple[float, float]], std_dev_threshold: float = 2.0
-) -> tuple[float, float]:
-    """
-    Perform linear regression on a list of (x, y) points, removing outliers.
-
-    Args:
-        points: A list of tuples, where each tuple contains (x, y) coordinates.
-        std_dev_threshold: Number of standard deviations to use as threshold for outlier removal.
-
-    Returns:
-        A tuple containing (slope, intercept) of the best-fit line after outlier removal.
-    """
-
-    def calculate_regression(pts: list[tuple[float, float]]) -> tuple[float, float]:
-        n = len(pts)
-        sum_x = sum(x for x, _ in pts)
-        sum_y = sum(y for _, y in pts)
-        sum_xy = sum(x * y for x, y in pts)
-        sum_xx = sum(x * x for x, _ in pts)
-        denom = n * sum_xx - sum_x * sum_x
-        # avoid divide by zero
-        if n == 0 or denom == 0:
-            return (0, 0)
-        slope = (n * sum_xy - sum_x * sum_y) / denom
-        intercept = (sum_y - slope * sum_x) / n
-        return slope, intercept
-
-    # Initial regression
-    slope, intercept = calculate_regression(points)
-
-    # Calculate residuals
-    residuals = [(y - (slope * x + intercept)) for x, y in points]
-
-    # Calculate standard deviation of residuals
-    mean_residual = sum(residuals) / len(residuals)
-    std_dev_residual = math.sqrt(
-        sum((r - mean_residual) ** 2 for r in residuals) / len(residuals)
-    )
-
-    # Remove outliers
-    filtered_points = [
-        point
-        for point, residual in zip(points, residuals)
-        if abs(residual) <= std_dev_threshold * std_dev_residual
-    ]
-
-    # Recalculate regression with filtered points
-    return calculate_regression(filtered_points)
-
-
-def calculate_next_relay_times(
-    start_time: str, duration_mins: int, repeat_interval: int, repeat_units: str
-) -> tuple[datetime, datetime]:
-    """
-    Given input values defining a range & repeat pattern, tell us the next
-    time it will be valid. BUT- if we're currently INSIDE a valid range, return
-    that range.
-    """
-    now = datetime.now()
-    today = now.date()
-    start_hour, start_minute = (0, 0)
-    try:
-        # users will often have invalid values in a text field ('4:', '', '3')
-        # in the course of entering a date. ignore it if it doesn't work
-        start_hour, start_minute = map(int, start_time.split(":"))
-    except ValueError:
-        pass
-
-    next_start = datetime.combine(
-        today, datetime.min.time().replace(hour=start_hour, minute=start_minute)
-    )
-    next_end = next_start + timedelta(minutes=duration_mins)
-
-    while next_start <= now:
-        if repeat_units == "minutes":
-            next_start += timedelta(minutes=repeat_interval)
-        elif repeat_units == "hours":
-            next_start += timedelta(hours=repeat_interval)
-        elif repeat_units == "days":
-            next_start += timedelta(days=repeat_interval)
-        elif repeat_units == "weeks":
-            next_start += timedelta(weeks=repeat_interval)
-
-        next_end = next_start + timedelta(minutes=duration_mins)
-        # if now is between next_start and next_end, we're in a valid
-        # range right now; return it
-        if next_start <= now <= next_end:
-            break
-
-    return next_start, next_end
-
-
-def delete_db_range(
-    start_dt: datetime | None = None,
-    end_dt: datetime | None = None,
-    table_name: str = "water_depths",
-) -> int:
-    if start_dt is None:
-        start_dt = datetime(2024, 8, 1)
-    if end_dt is None:
-        end_dt = datetime.now()
-
-    start_ts = start_dt.timestamp()
-    end_ts = end_dt.timestamp()
-
-    table = DB[table_name]
-    rows_before = table.count
-    table.delete_where("timestamp >= ? AND timestamp <= ?", [start_ts, end_ts])
-    rows_after = table.count
-
-    return rows_before - rows_after
-
-
-def even_minute(dt: datetime | None = None) -> datetime:
-    dt = dt or datetime.now()
-    return dt.replace(second=0, microsecond=0)
+        await self.store_schedule()
 
 
 # ===============
@@ -550,6 +497,15 @@ def hosebeast_layout() -> rx.Component:
     """The main layout of the app."""
     return rx.vstack(
         rx.heading("Hosebeast", size="3xl"),
+        rx.foreach(
+            HBState.alerts,
+            lambda alert: rx.callout(
+                alert["message"] + " (since " + alert["since"] + ")",
+                icon="triangle_alert",
+                color_scheme="red",
+                role="alert",
+            ),
+        ),
         rx.hstack(
             red_green_button(
                 "Pump 1 On",
@@ -566,28 +522,39 @@ def hosebeast_layout() -> rx.Component:
         ),
         schedule_interface(),
         rx.vstack(
-            # rx.hstack(
-            #     rx.text("Gain:"),
-            #     rx.select(
-            #         ["2/3", "1", "2", "4", "8", "16"],
-            #         value=HBState.adc_gain,
-            #         default_value="1",
-            #         on_change=HBState.update_adc_gain,
-            #         width="100%",
-            #     ),
-            # ),
             rx.hstack(
-                rx.text("Depth:", size="5", weight="bold"),
+                rx.text("Gain:"),
+                rx.select(
+                    ["auto", "2/3", "1", "2", "4", "8", "16"],
+                    value=HBState.adc_gain,
+                    on_change=HBState.update_adc_gain,
+                ),
+            ),
+            rx.hstack(
+                rx.text(HBState.level_label, ":", size="5", weight="bold"),
                 rx.text(
-                    HBState.water_depth.to_string(),
-                    " cm",
+                    HBState.water_level.to_string(),
+                    " ",
+                    HBState.measurement_unit,
                     size="5",
                     weight="bold",
                 ),
+                rx.select(
+                    HBState.measurement_units,
+                    value=HBState.measurement_unit,
+                    on_change=HBState.set_measurement_unit,
+                ),
             ),
             rx.hstack(
                 rx.text("Raw:"),
-                rx.text(HBState.adc_raw, ""),
+                rx.text(HBState.adc_raw, " at gain ", HBState.active_gain),
+            ),
+            rx.foreach(
+                HBState.flow_rates,
+                lambda flow: rx.hstack(
+                    rx.text(flow["zone"], " flow:"),
+                    rx.text(flow["rate"], " L/min"),
+                ),
             ),
             # rx.hstack(
             #     rx.text("Voltage:"),
@@ -595,6 +562,7 @@ def hosebeast_layout() -> rx.Component:
             # ),
             rx.heading("Water Depth Over Time", size="xl"),
             water_depth_chart(),
+            rx.cond(HBState.has_tank, water_use_table()),
             calibration_accordion(),
         ),
         padding_top="2em",
@@ -678,31 +646,64 @@ def water_depth_chart() -> rx.Component:
                             ),
             spacing="4",
         ),
+        rx.hstack(
+            rx.button(
+                rx.icon("chevron-left"),
+                on_click=lambda: HBState.pan_chart(-0.5),
+                variant="soft",
+            ),
+            rx.button(
+                rx.icon("zoom-out"),
+                on_click=lambda: HBState.zoom_chart(2),
+                variant="soft",
+            ),
+            rx.button(
+                rx.icon("zoom-in"),
+                on_click=lambda: HBState.zoom_chart(0.5),
+                variant="soft",
+            ),
+            rx.button(
+                rx.icon("chevron-right"),
+                on_click=lambda: HBState.pan_chart(0.5),
+                variant="soft",
+            ),
+            spacing="4",
+        ),
         rx.recharts.line_chart(
+            rx.foreach(
+                HBState.pump_runs,
+                lambda run: rx.recharts.reference_area(
+                    x1=run["x1"],
+                    x2=run["x2"],
+                    y_axis_id="right",
+                    fill="#38A169",
+                    fill_opacity=0.15,
+                    if_overflow="hidden",
+                ),
+            ),
             rx.recharts.line(
-                data_key="water_depth",
-                unit="cm",
+                data_key="d",
+                unit=HBState.measurement_unit,
                 stroke="#3182CE",
                 stroke_width=3,
-                name="Depth",
+                name=HBState.level_label,
                 type_="monotone",
                 dot=False,
                 y_axis_id="right",
             ),
-            # FIXME: This looks OK-ish with datetime and "category" type,
-            # but the x-axis then gives equal space to each data element, rather
-            # than their semantic meaning.
-            # (e.g. a graph with points last Sunday & Monday and this Friday
-            #  appears equally spaced rather than two points left and one point right)
-            # Native React recharts charts get around this by setting type="number",
-            # using the data's timestamp as the x-axis value, and applying a
-            # custom formatting function (tickFunction) to the x-axis labels.
-            # From what I can see, this is not possible in Reflex, because we can't
-            # pass a callable for tickFunction.
-            rx.recharts.x_axis(data_key="datetime", type_="category", tick_count=2),
-            rx.recharts.y_axis(
-                data_key="water_depth", orientation="right", y_axis_id="right"
+            # A numeric time axis spaces points by when they were taken, not
+            # by their index. Reflex can't pass a Python callable as
+            # tickFormatter, so we hand recharts a JS function instead
+            rx.recharts.x_axis(
+                data_key="t",
+                type_="number",
+                scale="time",
+                domain=[HBState.view_start, HBState.view_end],
+                allow_data_overflow=True,
+                tick_count=3,
+                custom_attrs={"tickFormatter": time_tick_formatter()},
             ),
+            rx.recharts.y_axis(data_key="d", orientation="right", y_axis_id="right"),
             # When showing raw values as well as depth values, we put an
             # extra axis on the left. Turned off for now
             # rx.recharts.line(
@@ -716,14 +717,73 @@ def water_depth_chart() -> rx.Component:
             # rx.recharts.y_axis(
             #     data_key="raw_value", orientation="left", y_axis_id="left"
             # ),
-            rx.recharts.graphing_tooltip(),
-            data=HBState.depth_data,
+            rx.recharts.graphing_tooltip(
+                custom_attrs={
+                    "labelFormatter": rx.Var(
+                        _js_expr="(t) => new Date(t * 1000).toLocaleString()"
+                    )
+                }
+            ),
+            data=depth_chart_points(),
             width=360,
             height=240,
         ),
     )
 
 
+def water_use_table() -> rx.Component:
+    """Daily water use, newest first"""
+    return rx.vstack(
+        rx.heading("Water Use", size="xl"),
+        rx.table.root(
+            rx.table.header(
+                rx.table.row(
+                    rx.table.column_header_cell("Day"),
+                    rx.table.column_header_cell("Pumped"),
+                    rx.table.column_header_cell("Other use"),
+                    rx.table.column_header_cell("Refilled"),
+                ),
+            ),
+            rx.table.body(
+                rx.foreach(
+                    HBState.water_use,
+                    lambda day: rx.table.row(
+                        rx.table.cell(day["day"]),
+                        rx.table.cell(day["pumped"]),
+                        rx.table.cell(day["used"]),
+                        rx.table.cell(day["refilled"]),
+                    ),
+                ),
+            ),
+            size="1",
+        ),
+    )
+
+
+def depth_chart_points() -> rx.Var:
+    """Zip HBState.depth_data's columns back into the points recharts plots"""
+    cols = HBState.depth_data
+    return rx.Var(
+        _js_expr=f"{cols}.t.map((t, i) => ({{t: t, d: {cols}.d[i]}}))",
+        _var_type=list[dict],
+        _var_data=cols._get_all_var_data(),
+    )
+
+
+def time_tick_formatter() -> rx.Var:
+    """JS label for epoch-second ticks: times up to two days, dates beyond"""
+    span = HBState.view_end - HBState.view_start
+    return rx.Var(
+        _js_expr=(
+            "(t) => { const d = new Date(t * 1000); "
+            f"return {span} <= 172800 "
+            "? d.toLocaleTimeString([], {hour: '2-digit', minute: '2-digit'}) "
+            ": d.toLocaleDateString([], {month: 'short', day: 'numeric'}); }"
+        ),
+        _var_data=span._get_all_var_data(),
+    )
+
+
 def calibration_accordion() -> rx.Component:
     return rx.accordion.root(
         rx.accordion.item(
@@ -762,4 +822,79 @@ app = rx.App(
     title="Hosebeast Irrigation Controller",
     description="Irrigation control system for Raspberry Pi 4",
 )
-app.add_page(hosebeast_layout(), "/")
\ No newline at end of file
+if hub.HUB_DIR:
+    # A hub has no sensor or pumps of its own
+    app.add_page(fleet.fleet_layout(), "/")
+else:
+    app.add_page(hosebeast_layout(), "/")
+
+config = rx.config.get_config()
+if (config.gunicorn_workers or 1) > 1 and not config.redis_url:
+    # Sessions may hop between workers, so they need a shared store
+    app._state_manager = StateManagerSQLite(state=app.state)
+
+
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+app.api.add_api_route("/metrics", metrics_endpoint)
+app.register_lifespan_task(metrics.monitor_event_loop_lag, loop_name="backend")
+if hub.HUB_DIR:
+    app.register_lifespan_task(hub.run)
+elif not HOSEBEAST_CONTROLLER:
+    # No separate controller process; every worker stands for election
+    app.register_lifespan_task(serve_when_elected, path=DEFAULT_SOCKET)
+
+
+async def controller_metrics_endpoint():
+    return PlainTextResponse(
+        await CONTROLLER.metrics(), media_type=metrics.CONTENT_TYPE
+    )
+
+
+# The controller's own metrics: sampling, DB writes and pump changes
+app.api.add_api_route("/metrics/controller", controller_metrics_endpoint)
+
+async def export_endpoint(
+    table: str, fmt: str, since: str | None = None, until: str | None = None
+):
+    try:
+        export.check(table, fmt)
+        start_ts = export.parse_time(since) if since else None
+        end_ts = export.parse_time(until) if until else None
+    except export.ExportError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return StreamingResponse(
+        export.stream_file(storage.DB_PATH, table, fmt, start_ts, end_ts),
+        media_type=export.MEDIA_TYPES[fmt],
+        headers={
+            "Content-Disposition": f'attachment; filename="hosebeast-{table}.{fmt}"'
+        },
+    )
+
+
+# e.g. /export/water_depths.csv?since=week
+app.api.add_api_route("/export/{table}.{fmt}", export_endpoint)
+
+
+async def sync_endpoint(table: str, since: float = 0.0, limit: int = hub.BATCH_ROWS):
+    if table not in hub.SYNC_TABLES:
+        raise HTTPException(status_code=404, detail=f"Can't sync {table!r}")
+    # Compressed on the reader thread, so a big batch doesn't stall the loop
+    body = await storage.POOL.read(
+        hub.encoded_changes, table, since, min(limit, hub.MAX_BATCH_ROWS)
+    )
+    return Response(
+        body, media_type="application/json", headers={"Content-Encoding": "gzip"}
+    )
+
+
+# For hubs: rows newer than `since`, e.g. /sync/water_depths?since=1725148800
+app.api.add_api_route("/sync/{table}", sync_endpoint)
+
+# Last, since it answers every path the API routes above don't
+if HOSEBEAST_FRONTEND := os.environ.get("HOSEBEAST_FRONTEND"):
+    mount_frontend(app.api, HOSEBEAST_FRONTEND)
@@ -0,0 +1,270 @@
+"""
+A hub that gathers several Hosebeast units into one fleet view.
+
+Each unit serves `/sync/<table>?since=<timestamp>`: its rows newer than
+`since`, oldest first, at most `BATCH_ROWS` at a time, as gzipped JSON.
+Rows that share a timestamp are never split across batches, so the
+timestamp of the last row merged is all a hub needs to carry on.
+
+The hub (HOSEBEAST_HUB=<directory>) keeps one SQLite file per site in that
+directory, e.g. `hub-data/garden.db`, laid out like a unit's own database,
+so pyramids, pump runs and runtime totals work on it unchanged. Every few
+minutes it asks each site in HOSEBEAST_HUB_SITES ("garden=http://pi1:8000,
+barn=http://pi2:8000") for what's new since the newest row it holds, a
+batch at a time, and commits each batch as it arrives. A dropped link
+costs at most the batch in flight, and a site that's down is retried
+less and less often until it's back. The hub's dashboard is the fleet
+page (fleet.py); phones ask the hub, never the units.
+
+Only new rows travel. Readings a unit imports or prunes after the hub has
+passed them aren't seen; delete the site's file on the hub to start over.
+"""
+
+import asyncio
+import fcntl
+import gzip
+import json
+import logging
+import math
+import os
+import time
+import urllib.request
+from dataclasses import dataclass
+from datetime import date
+from pathlib import Path
+from urllib.parse import urlencode
+
+from sqlite_utils import Database
+
+from . import partitions, pyramid, relay_log, storage
+
+log = logging.getLogger(__name__)
+
+HUB_DIR = os.environ.get("HOSEBEAST_HUB")
+# Rows per batch, and the most a hub may ask for at once
+BATCH_ROWS = 5000
+MAX_BATCH_ROWS = 50_000
+# How often to sync each site, and the longest wait after failures
+POLL_SECS = 5 * 60
+MAX_BACKOFF_SECS = 60 * 60
+TIMEOUT_SECS = 30
+
+# Table: the columns sent, or None for all of them
+SYNC_TABLES = {
+    "water_depths": None,
+    "relay_events": "timestamp, pin, zone, is_on, source",
+    "flow_rates": "timestamp, pin, zone, pulses, litres",
+}
+
+
+@dataclass
+class Site:
+    name: str
+    url: str
+
+
+def parse_sites(spec: str) -> list[Site]:
+    """Sites from e.g. "garden=http://pi1:8000,barn=http://pi2:8000" """
+    sites = []
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, url = item.partition("=")
+        if not name.isidentifier() or not url:
+            raise ValueError(f"Bad site {item!r}; expected <name>=<url>")
+        sites.append(Site(name, url.rstrip("/")))
+    return sites
+
+
+# ========
+# = UNIT =
+# ========
+def changes(table: str, since: float, limit: int, db: Database) -> dict:
+    """Up to `limit` rows of `table` newer than `since`, for a hub"""
+    if table not in SYNC_TABLES:
+        raise ValueError(f"Can't sync {table!r}; choose from {list(SYNC_TABLES)}")
+    batch: dict = {"table": table, "columns": [], "rows": [], "more": False}
+    if table not in db.table_names():
+        return batch
+    columns = SYNC_TABLES[table] or "*"
+    rows: list[tuple] = []
+    months = partitions.each_month(db, since) if table == "water_depths" else [None]
+    for _ in months:
+        cursor = db.execute(
+            f"SELECT {columns} FROM [{table}] WHERE timestamp > ? "
+            "ORDER BY timestamp LIMIT ?",
+            [since, limit + 1 - len(rows)],
+        )
+        batch["columns"] = [column[0] for column in cursor.description]
+        rows += cursor.fetchall()
+        if len(rows) > limit:
+            break
+    if len(rows) > limit:
+        batch["more"] = True
+        ts_index = batch["columns"].index("timestamp")
+        next_ts = rows.pop()[ts_index]
+        # Leave rows sharing the next batch's first timestamp to that batch
+        while rows and rows[-1][ts_index] == next_ts:
+            rows.pop()
+        if not rows:
+            rows = db.execute(
+                f"SELECT {columns} FROM [{table}] WHERE timestamp = ?", [next_ts]
+            ).fetchall()
+    batch["rows"] = rows
+    return batch
+
+
+def encoded_changes(table: str, since: float, limit: int, db: Database) -> bytes:
+    return gzip.compress(json.dumps(changes(table, since, limit, db)).encode())
+
+
+# =======
+# = HUB =
+# =======
+def site_path(directory: str, name: str) -> Path:
+    return Path(directory) / f"{name}.db"
+
+
+def last_seen(table: str, db: Database) -> float:
+    """The newest timestamp merged from `table`, or 0"""
+    if table not in db.table_names():
+        return 0.0
+    return db.execute(f"SELECT MAX(timestamp) FROM [{table}]").fetchone()[0] or 0.0
+
+
+def fetch(site: Site, table: str, since: float, limit: int = BATCH_ROWS) -> dict:
+    query = urlencode({"since": repr(since), "limit": limit})
+    request = urllib.request.Request(
+        f"{site.url}/sync/{table}?{query}", headers={"Accept-Encoding": "gzip"}
+    )
+    with urllib.request.urlopen(request, timeout=TIMEOUT_SECS) as response:
+        body = response.read()
+        if response.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+    return json.loads(body)
+
+
+def merge(batch: dict, db: Database):
+    """Write a batch from `changes()` into a site's database"""
+    table, rows = batch["table"], batch["rows"]
+    if not rows:
+        return
+    if table == "water_depths":
+        index = {name: i for i, name in enumerate(batch["columns"])}
+        columns = [index[name] for name in ("timestamp", "datetime", "raw_value")]
+        columns.append(index["water_depth"])
+        flag = index.get("interpolated")
+        for interpolated in (False, True):
+            partitions.write_depths(
+                db,
+                (
+                    [row[i] for i in columns]
+                    for row in rows
+                    if bool(flag is not None and row[flag]) == interpolated
+                ),
+                interpolated=interpolated,
+            )
+        pyramid.refresh_range(
+            rows[0][index["timestamp"]], rows[-1][index["timestamp"]], db
+        )
+    elif table == "relay_events":
+        relay_log.write_events([tuple(row) for row in rows], db)
+    elif table == "flow_rates":
+        storage.store_flow_rates([tuple(row) for row in rows], db)
+
+
+def _record_sync(db: Database, site: Site, error: str | None):
+    status = {"id": 1, "url": site.url, "error": error}
+    if error is None:
+        # Otherwise keep when it last worked
+        status["synced_ts"] = time.time()
+    db["hub_sync"].upsert(status, pk="id", alter=True)
+
+
+def sync_site(site: Site, directory: str) -> int:
+    """Bring a site's database up to date; returns how many rows were merged"""
+    db = Database(site_path(directory, site.name))
+    merged = 0
+    try:
+        for table in SYNC_TABLES:
+            while True:
+                batch = fetch(site, table, last_seen(table, db))
+                merge(batch, db)
+                merged += len(batch["rows"])
+                if not batch["more"]:
+                    break
+        _record_sync(db, site, None)
+    except Exception as e:
+        _record_sync(db, site, str(e) or type(e).__name__)
+        raise
+    finally:
+        db.close()
+    return merged
+
+
+async def follow(site: Site, directory: str, poll_secs: float = POLL_SECS):
+    """Sync `site` every `poll_secs`, backing off while it can't be reached"""
+    delay = poll_secs
+    while True:
+        try:
+            merged = await asyncio.to_thread(sync_site, site, directory)
+            log.debug("Synced %d rows from %s", merged, site.name)
+            delay = poll_secs
+        except Exception as e:  # noqa: BLE001
+            delay = min(delay * 2, MAX_BACKOFF_SECS)
+            log.warning("Couldn't sync %s (retrying in %ds): %s", site.name, delay, e)
+        await asyncio.sleep(delay)
+
+
+async def run(directory: str | None = None, sites: list[Site] | None = None):
+    """
+    Keep every site in sync. Every backend worker runs this, and whichever
+    holds the lock in `directory` does the syncing.
+    """
+    directory = directory or HUB_DIR
+    sites = sites or parse_sites(os.environ.get("HOSEBEAST_HUB_SITES", ""))
+    os.makedirs(directory, exist_ok=True)
+    lock_file = await asyncio.to_thread(open, Path(directory) / ".sync.lock", "a")
+    with lock_file:
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                await asyncio.sleep(POLL_SECS)
+        log.info("Syncing %s into %s", [site.name for site in sites], directory)
+        await asyncio.gather(*(follow(site, directory) for site in sites))
+
+
+# =========
+# = FLEET =
+# =========
+def site_summary(path: Path, days: int = 7) -> dict:
+    """What the fleet page shows for the site stored at `path`"""
+    db = Database(path)
+    try:
+        now = time.time()
+        latest = storage.recent_depths(1, db=db)
+        today = date.today()
+        runtime = relay_log.daily_runtime(today, today, db)
+        sync = next(db["hub_sync"].rows, {}) if "hub_sync" in db.table_names() else {}
+        chart = {"t": [], "d": []}
+        if latest:
+            # The week up to the last reading, so a site that's been offline
+            # still shows something
+            end = min(now, latest[0]["timestamp"])
+            chart = storage.load_depth_range(end - days * 86400, end, 100, db=db)
+        return {
+            "name": path.stem,
+            "depth": latest[0]["water_depth"] if latest else None,
+            "reading_ts": latest[0]["timestamp"] if latest else None,
+            "pump_minutes": math.fsum(day["seconds"] for day in runtime) / 60,
+            "synced_ts": sync.get("synced_ts"),
+            "error": sync.get("error"),
+            "chart": chart,
+        }
+    finally:
+        db.close()
+
+
+def fleet_summary(directory: str | None = None) -> list[dict]:
+    directory = directory or HUB_DIR
+    return [site_summary(path) for path in sorted(Path(directory).glob("*.db"))]
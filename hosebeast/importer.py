@@ -0,0 +1,207 @@
+"""
+Bulk import of historical depth readings, and filling short gaps.
+
+    result = importer.import_file("old_logger.csv", fill_gaps_secs=30 * 60)
+
+Readings come from CSV or JSON Lines, as written by `hosebeast export` or
+another logger. Each needs a `water_depth` and either a `timestamp` (epoch
+seconds) or a `datetime` (ISO); `raw_value` is optional. Times are floored
+to the minute, matching the rows the controller stores, so a reading
+replaces (or, with `keep_existing`, yields to) any row for the same minute.
+
+Rows are written `BATCH_ROWS` at a time with `executemany`, one transaction
+per batch (per month of the batch, when partitioned), and the chart's
+summary tables and daily water use are refreshed once at the end, so
+a year of minute data loads in seconds rather than row by row.
+
+With `fill_gaps_secs`, gaps no longer than that between stored readings
+are filled with one row per minute, interpolated linearly and marked
+`interpolated = 1`, so the chart and exports can tell them apart. Longer
+gaps, e.g. a week with the Pi unplugged, are left alone. Flat stretches
+the adaptive sampler stored sparsely (see sampling.py) count as gaps too.
+"""
+
+import csv
+import json
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+
+from sqlite_utils import Database
+
+from . import metrics, partitions, storage
+
+FORMATS = ["csv", "jsonl"]
+BATCH_ROWS = 10_000
+# Rows are keyed by minute
+STEP_SECS = 60
+
+
+class BadReading(ValueError):
+    """A reading that can't be imported"""
+
+
+@dataclass
+class ImportResult:
+    read: int = 0
+    written: int = 0
+    filled: int = 0
+    first_ts: float | None = None
+    last_ts: float | None = None
+
+
+def read_file(path: str | Path, fmt: str | None = None) -> Iterator[dict]:
+    """Raw records from a CSV or JSONL file; `fmt` defaults to its suffix"""
+    path = Path(path)
+    fmt = fmt or path.suffix.lstrip(".").lower()
+    if fmt == "ndjson":
+        fmt = "jsonl"
+    if fmt not in FORMATS:
+        raise BadReading(f"Can't tell the format of {path}; use one of {FORMATS}")
+    with path.open(newline="") as f:
+        if fmt == "csv":
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def normalize(record: dict) -> tuple[float, str, int | None, float]:
+    """(timestamp, datetime, raw_value, water_depth) for one record"""
+    try:
+        if record.get("timestamp") not in (None, ""):
+            when = datetime.fromtimestamp(float(record["timestamp"]))
+        else:
+            when = datetime.fromisoformat(record["datetime"])
+        depth = float(record["water_depth"])
+    except (KeyError, TypeError, ValueError) as e:
+        raise BadReading(f"Bad reading {record!r}: {e!r}") from None
+    raw = record.get("raw_value")
+    minute = when.replace(second=0, microsecond=0)
+    return (
+        minute.timestamp(),
+        minute.isoformat(),
+        int(float(raw)) if raw not in (None, "") else None,
+        depth,
+    )
+
+
+def _batches(rows: Iterable, size: int) -> Iterator[list]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+@metrics.timed("hosebeast_import_seconds", "Bulk imports of depth readings")
+def import_records(
+    records: Iterable[dict],
+    keep_existing: bool = False,
+    fill_gaps_secs: float = 0,
+    db: Database | None = None,
+    batch_rows: int = BATCH_ROWS,
+) -> ImportResult:
+    """Write `records` into `water_depths`, then optionally fill short gaps"""
+    db = storage.get_db() if db is None else db
+    result = ImportResult()
+    for batch in _batches(map(normalize, records), batch_rows):
+        result.read += len(batch)
+        result.written += partitions.write_depths(db, batch, replace=not keep_existing)
+        first, last = min(row[0] for row in batch), max(row[0] for row in batch)
+        result.first_ts = min(first, result.first_ts or first)
+        result.last_ts = max(last, result.last_ts or last)
+    if result.first_ts is None:
+        return result
+    if fill_gaps_secs:
+        # Include the readings either side of the import, so gaps at its
+        # edges are filled too
+        result.filled = fill_gaps(
+            result.first_ts - fill_gaps_secs,
+            result.last_ts + fill_gaps_secs,
+            fill_gaps_secs,
+            db=db,
+        )
+    storage.refresh_summaries(
+        result.first_ts - fill_gaps_secs, result.last_ts + fill_gaps_secs, db
+    )
+    return result
+
+
+def import_file(
+    path: str | Path,
+    fmt: str | None = None,
+    keep_existing: bool = False,
+    fill_gaps_secs: float = 0,
+    db: Database | None = None,
+) -> ImportResult:
+    return import_records(read_file(path, fmt), keep_existing, fill_gaps_secs, db=db)
+
+
+def _gaps(
+    start_ts: float, end_ts: float, max_gap_secs: float, db: Database
+) -> list[tuple[tuple, tuple]]:
+    """
+    (timestamp, raw_value, water_depth) of the readings either side of each
+    gap up to `max_gap_secs`
+    """
+    gaps = []
+    prev = None
+    # Walked in Python rather than with LAG(), so gaps across the start of a
+    # month are found in partitioned databases too
+    for row in storage.depth_rows(start_ts, end_ts, db=db):
+        reading = (row["timestamp"], row["raw_value"], row["water_depth"])
+        if prev is not None and STEP_SECS < reading[0] - prev[0] <= max_gap_secs:
+            gaps.append((prev, reading))
+        prev = reading
+    return gaps
+
+
+def _gap_rows(gaps: Iterable[tuple[tuple, tuple]]) -> Iterator[tuple]:
+    """Interpolated rows for each missing minute in `gaps`"""
+    for (prev_ts, prev_raw, prev_depth), (ts, raw, depth) in gaps:
+        span = ts - prev_ts
+        fill_ts = prev_ts + STEP_SECS
+        while fill_ts < ts:
+            frac = (fill_ts - prev_ts) / span
+            fill_raw = None
+            if prev_raw is not None and raw is not None:
+                fill_raw = round(prev_raw + (raw - prev_raw) * frac)
+            yield (
+                fill_ts,
+                datetime.fromtimestamp(fill_ts).isoformat(),
+                fill_raw,
+                round(prev_depth + (depth - prev_depth) * frac, 1),
+            )
+            fill_ts += STEP_SECS
+
+
+def fill_gaps(
+    start_ts: float,
+    end_ts: float,
+    max_gap_secs: float,
+    db: Database | None = None,
+    batch_rows: int = BATCH_ROWS,
+) -> int:
+    """
+    Fill gaps of up to `max_gap_secs` between readings in [start_ts, end_ts]
+    with interpolated rows. Returns the number of rows added. Summary tables
+    aren't refreshed; `import_records` does that, and so should other callers.
+    """
+    db = storage.get_db() if db is None else db
+    if "water_depths" not in db.table_names():
+        return 0
+    # Find the gaps first: writing while the readings are still being read
+    # would move the rows under them. There's a pair of readings per gap,
+    # far fewer than the rows that fill them, which are made a batch at a time
+    filled = 0
+    gaps = _gaps(start_ts, end_ts, max_gap_secs, db)
+    for batch in _batches(_gap_rows(gaps), batch_rows):
+        partitions.write_depths(db, batch, replace=False, interpolated=True)
+        filled += len(batch)
+    return filled
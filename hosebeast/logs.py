@@ -0,0 +1,277 @@
+"""
+Logging setup for Hosebeast.
+
+Modules log through `logging.getLogger(__name__)` as usual. `configure_logging()`
+(called once by the app) routes everything under the `hosebeast` logger
+through a queue to a background thread, so the event loop never formats
+strings or blocks on file or console I/O. That thread writes:
+
+- `<log_dir>/<log_name>.log`: JSON lines, one record per line, with any
+  `extra={...}` fields included as keys. `log_name` is "hosebeast" for the
+  dashboard and "controller" for the controller process, so the two never
+  share a file
+- `<log_dir>/pumps.log`: the same, but only the `hosebeast.pumps` logger,
+  never rate limited, as a durable record of every pump action
+- the console (the tmux pane): WARNING and above only
+
+Files rotate at `max_bytes` with `backup_count` old copies kept, so the log
+directory never grows past about `(backup_count + 1) * max_bytes` per file.
+
+Only the process that called `configure_logging()` writes the files, so
+rotating them is safe. Processes forked from it afterwards, like gunicorn
+workers with `--preload`, have no writer thread of their own. Instead each
+starts a small thread that passes its records back to that process over a
+pipe, marked with `worker_pid`.
+
+Repeated messages (same logger and format string) are limited to `burst`
+records per `per_seconds`; the next one through reports how many were
+dropped.
+
+Environment:
+    HOSEBEAST_LOG_DIR      directory for log files (default: logs)
+    HOSEBEAST_LOG_LEVEL    level for `hosebeast` loggers (default: INFO)
+    HOSEBEAST_LOG_LEVELS   per-module overrides, e.g.
+                           "hosebeast.storage=DEBUG,hosebeast.metrics=WARNING"
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import multiprocessing.queues
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+PUMP_LOGGER = "hosebeast.pumps"
+
+# Attributes every LogRecord has; anything else came from `extra=`
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+_listener: logging.handlers.QueueListener | None = None
+# In the process that writes the files: its listener for forked processes'
+# records. In a forked process: the thread sending them there
+_forwarding: logging.handlers.QueueListener | None = None
+# Forked processes' records, on their way to the process writing the files
+_pipe: multiprocessing.queues.SimpleQueue | None = None
+
+
+def pump_log() -> logging.Logger:
+    """The logger for pump on/off actions; see module docstring"""
+    return logging.getLogger(PUMP_LOGGER)
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let at most `burst` records with the same logger and format string
+    through every `per_seconds`. Loggers in `exempt` are never limited.
+    """
+
+    def __init__(self, burst: int = 5, per_seconds: float = 60, exempt=(PUMP_LOGGER,)):
+        super().__init__()
+        self.burst = burst
+        self.per_seconds = per_seconds
+        self.exempt = set(exempt)
+        # (logger, msg template) -> [window start, count in window, suppressed]
+        self._windows: dict[tuple[str, str], list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.name in self.exempt:
+            return True
+        key = (record.name, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.per_seconds:
+                suppressed = window[2] if window else 0
+                self._windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hand records to the listener thread unformatted. The stock QueueHandler
+    formats the message in the caller's thread so records can be pickled;
+    everything here stays in-process, so that work moves off the hot path.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class _ForkedRecordListener(logging.handlers.QueueListener):
+    """Writes records that forked processes send over a `multiprocessing` pipe"""
+
+    def dequeue(self, block: bool) -> logging.LogRecord | None:
+        return self.queue.get()
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class _ForwardHandler(logging.Handler):
+    """Sends records from a forked process to the one writing the files"""
+
+    def __init__(self, pipe: multiprocessing.queues.SimpleQueue):
+        super().__init__()
+        self.pipe = pipe
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self.pipe.put(_picklable(record))
+        except Exception:  # noqa: BLE001
+            self.handleError(record)
+
+
+def _picklable(record: logging.LogRecord) -> logging.LogRecord:
+    record = logging.makeLogRecord(vars(record))
+    record.msg = record.getMessage()
+    record.args = None
+    if record.exc_info:
+        record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+    for key, value in vars(record).items():
+        if key not in _RECORD_ATTRS and not isinstance(
+            value, (str, int, float, bool, type(None))
+        ):
+            setattr(record, key, str(value))
+    record.worker_pid = os.getpid()
+    return record
+
+
+def _after_fork_in_child():
+    """Forward this process's records to the writer it was forked from"""
+    global _listener, _forwarding
+    if _listener is None and _forwarding is None:
+        return
+    # The parent's threads didn't survive the fork, and one of them may
+    # have held a lock; this process gets its own
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    for handler in logging.getLogger("hosebeast").handlers:
+        if isinstance(handler, DeferredQueueHandler):
+            handler.queue = log_queue
+            for log_filter in handler.filters:
+                if isinstance(log_filter, RateLimitFilter):
+                    log_filter._lock = threading.Lock()
+    _listener = None
+    _forwarding = logging.handlers.QueueListener(log_queue, _ForwardHandler(_pipe))
+    _forwarding.start()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def _parse_levels(spec: str) -> dict[str, str]:
+    levels = {}
+    for item in spec.split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging(
+    log_dir: str | os.PathLike | None = None,
+    level: str | None = None,
+    module_levels: dict[str, str] | None = None,
+    max_bytes: int = 2 * 1024 * 1024,
+    backup_count: int = 4,
+    console_level: int = logging.WARNING,
+    burst: int = 5,
+    per_seconds: float = 60,
+    log_name: str = "hosebeast",
+):
+    """Set up the `hosebeast` loggers; calling this more than once is a no-op"""
+    global _listener, _forwarding, _pipe
+    if _listener is not None or _forwarding is not None:
+        return
+
+    log_dir = Path(log_dir or os.environ.get("HOSEBEAST_LOG_DIR", "logs"))
+    log_dir.mkdir(parents=True, exist_ok=True)
+    level = level or os.environ.get("HOSEBEAST_LOG_LEVEL", "INFO")
+    if module_levels is None:
+        module_levels = _parse_levels(os.environ.get("HOSEBEAST_LOG_LEVELS", ""))
+
+    formatter = JSONFormatter()
+    main_file = logging.handlers.RotatingFileHandler(
+        log_dir / f"{log_name}.log", maxBytes=max_bytes, backupCount=backup_count
+    )
+    main_file.setFormatter(formatter)
+    pump_file = logging.handlers.RotatingFileHandler(
+        log_dir / "pumps.log", maxBytes=max_bytes, backupCount=backup_count
+    )
+    pump_file.setFormatter(formatter)
+    pump_file.addFilter(logging.Filter(PUMP_LOGGER))
+    console = logging.StreamHandler()
+    console.setLevel(console_level)
+    console.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    )
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(burst, per_seconds))
+
+    root = logging.getLogger("hosebeast")
+    root.setLevel(level.upper())
+    root.addHandler(queue_handler)
+    # Records stop at our queue instead of also hitting the root logger
+    root.propagate = False
+    # Pump actions are always recorded, whatever the overall level
+    pump_log().setLevel(logging.INFO)
+    for name, module_level in module_levels.items():
+        logging.getLogger(name).setLevel(module_level)
+
+    handlers = (main_file, pump_file, console)
+    _listener = logging.handlers.QueueListener(
+        log_queue, *handlers, respect_handler_level=True
+    )
+    _listener.start()
+    _pipe = multiprocessing.SimpleQueue()
+    _forwarding = _ForkedRecordListener(_pipe, *handlers, respect_handler_level=True)
+    _forwarding.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """Flush queued records and stop the writer thread(s)"""
+    global _listener, _forwarding
+    # In a forked process, this flushes its records to the writer
+    if _forwarding is not None:
+        _forwarding.stop()
+        _forwarding = None
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
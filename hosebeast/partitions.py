@@ -0,0 +1,415 @@
+"""
+Monthly partitions of `water_depths`, each in its own SQLite file.
+
+    db = PartitionedDatabase("hosebeast.db", "hosebeast-data")
+
+With HOSEBEAST_PARTITIONS=<directory> set, `storage` opens its databases
+this way. Each calendar month (UTC) of readings goes to its own file,
+`<directory>/water_depths-2024-09.db`, while calibration, schedules and the
+chart's summary tables stay in the main file. Backing up a month is copying
+one file, a retention delete of a whole month unlinks it, and VACUUM only
+rewrites the months that changed.
+
+A query attaches only the months its range overlaps and reads them through
+a temporary `water_depths` view, a UNION ALL of their tables, so the SQL in
+`storage`, `pyramid` and `export` runs unchanged:
+
+    with partitions.covering(db, start_ts, end_ts):
+        db.execute("SELECT ... FROM water_depths WHERE timestamp >= ?", ...)
+
+SQLite attaches at most 10 databases to a connection, so work over longer
+spans goes a month at a time with `each_month()`. Both helpers, and
+`write_depths()` and `delete_depths()`, also take a plain `Database`, so
+callers needn't care which kind they have.
+
+Once a later month has begun, earlier ones are sealed: taken out of WAL mode
+and made read-only on disk, so they can be copied or rsynced while the app
+runs. Writing into a sealed month (an import, gap filling) unseals it for
+the duration.
+"""
+
+import contextlib
+import logging
+import sqlite3
+import stat
+import time
+from collections.abc import Iterable, Iterator
+from datetime import UTC, datetime
+from pathlib import Path
+
+from sqlite_utils import Database
+
+log = logging.getLogger(__name__)
+
+# Also the most that may be attached at once, so this is also how many
+# months `covering()` can span
+MAX_ATTACHED = 10
+DEPTH_COLUMNS = "timestamp, datetime, raw_value, water_depth, interpolated"
+# Stands in for the view when no month is attached, so it keeps its columns
+EMPTY_TABLE = "water_depths_none"
+# How long a write waits on a month another process is writing
+BUSY_TIMEOUT_MS = 5000
+
+
+class PartitionError(ValueError):
+    """A query spanning more months than can be attached at once"""
+
+
+def create_depths_table(db: Database, schema: str = "main", temp: bool = False):
+    """`water_depths` in `schema`, with the `interpolated` flag"""
+    name = EMPTY_TABLE if temp else f"[{schema}].water_depths"
+    db.execute(
+        f"""CREATE {"TEMP " if temp else ""}TABLE IF NOT EXISTS {name} (
+            [timestamp] FLOAT PRIMARY KEY,
+            [datetime] TEXT,
+            [raw_value] INTEGER,
+            [water_depth] FLOAT,
+            [interpolated] INTEGER NOT NULL DEFAULT 0
+        )"""
+    )
+
+
+def month_of(ts: float) -> str:
+    """The partition holding epoch time `ts`, e.g. "2024-09" """
+    return datetime.fromtimestamp(ts, UTC).strftime("%Y-%m")
+
+
+def month_bounds(month: str) -> tuple[float, float]:
+    """[start, end) of `month` in epoch seconds"""
+    year, number = map(int, month.split("-"))
+    start = datetime(year, number, 1, tzinfo=UTC)
+    end = start.replace(year=year + number // 12, month=number % 12 + 1)
+    return start.timestamp(), end.timestamp()
+
+
+def _overlaps(month: str, start_ts: float | None, end_ts: float | None) -> bool:
+    lo, hi = month_bounds(month)
+    return (start_ts is None or hi > start_ts) and (end_ts is None or lo <= end_ts)
+
+
+def _schema(month: str) -> str:
+    return "p_" + month.replace("-", "_")
+
+
+def _sealed(path: Path) -> bool:
+    return not path.stat().st_mode & stat.S_IWUSR
+
+
+class PartitionedDatabase(Database):
+    """A `Database` whose `water_depths` is split into monthly files"""
+
+    def __init__(self, filename_or_conn, directory: str | Path, **kwargs):
+        super().__init__(filename_or_conn, **kwargs)
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # month -> (schema name, inode), oldest use first
+        self._attached: dict[str, tuple[str, int]] = {}
+        self._view: tuple[str, ...] | None = None
+        self.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        create_depths_table(self, temp=True)
+        self._set_view(())
+        if "water_depths" in super().table_names():
+            log.warning(
+                "%s still has its own water_depths table, hidden by the "
+                "partitions; move it with `hosebeast partition`",
+                self.conn.execute("PRAGMA database_list").fetchone()[2],
+            )
+
+    def partition_path(self, month: str) -> Path:
+        return self.directory / f"water_depths-{month}.db"
+
+    def sealed(self, month: str) -> bool:
+        return _sealed(self.partition_path(month))
+
+    def months(self) -> list[str]:
+        """Months with a partition file, oldest first"""
+        return sorted(
+            path.stem.removeprefix("water_depths-")
+            for path in self.directory.glob("water_depths-????-??.db")
+        )
+
+    def table_names(self, *args, **kwargs) -> list[str]:
+        names = super().table_names(*args, **kwargs)
+        if "water_depths" not in names:
+            names.append("water_depths")
+        return names
+
+    # ===========
+    # = READING =
+    # ===========
+    @contextlib.contextmanager
+    def covering(self, start_ts: float | None = None, end_ts: float | None = None):
+        """Point the `water_depths` view at every month in [start_ts, end_ts]"""
+        months = [m for m in self.months() if _overlaps(m, start_ts, end_ts)]
+        if len(months) > MAX_ATTACHED:
+            raise PartitionError(
+                f"{len(months)} months of readings can't be read at once; "
+                f"at most {MAX_ATTACHED} can be attached"
+            )
+        self._use(months)
+        yield months
+
+    def each_month(
+        self,
+        start_ts: float | None = None,
+        end_ts: float | None = None,
+        reverse: bool = False,
+    ) -> Iterator[str]:
+        """Point the view at each month in [start_ts, end_ts] in turn"""
+        months = [m for m in self.months() if _overlaps(m, start_ts, end_ts)]
+        for month in reversed(months) if reverse else months:
+            self._use([month])
+            yield month
+
+    # ===========
+    # = WRITING =
+    # ===========
+    def write_depths(
+        self, rows: Iterable[tuple], replace: bool = True, interpolated: bool = False
+    ) -> int:
+        """
+        Write (timestamp, datetime, raw_value, water_depth) rows into their
+        months. Returns the number of rows written.
+        """
+        by_month: dict[str, list[tuple]] = {}
+        for row in rows:
+            by_month.setdefault(month_of(row[0]), []).append(row)
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        written = 0
+        for month, month_rows in by_month.items():
+            with self._writable(month) as schema, self.conn:
+                cursor = self.conn.executemany(
+                    f"{verb} INTO [{schema}].water_depths ({DEPTH_COLUMNS}) "
+                    f"VALUES (?, ?, ?, ?, {int(interpolated)})",
+                    month_rows,
+                )
+            written += max(cursor.rowcount, 0)
+        return written
+
+    def delete_depths(self, start_ts: float, end_ts: float) -> int:
+        """
+        Delete readings in [start_ts, end_ts]. Months wholly inside it are
+        dropped by deleting their file. Returns the number of rows deleted.
+        """
+        deleted = 0
+        for month in self.months():
+            if not _overlaps(month, start_ts, end_ts):
+                continue
+            lo, hi = month_bounds(month)
+            if start_ts <= lo and end_ts >= hi:
+                schema = self._attach(month)
+                deleted += self.execute(
+                    f"SELECT COUNT(*) FROM [{schema}].water_depths"
+                ).fetchone()[0]
+                self._detach(month)
+                for suffix in ("", "-wal", "-shm"):
+                    Path(f"{self.partition_path(month)}{suffix}").unlink(
+                        missing_ok=True
+                    )
+                log.info("Dropped partition %s", month)
+                continue
+            with self._writable(month) as schema, self.conn:
+                cursor = self.execute(
+                    f"DELETE FROM [{schema}].water_depths "
+                    "WHERE timestamp >= ? AND timestamp <= ?",
+                    [start_ts, end_ts],
+                )
+            deleted += cursor.rowcount
+        return deleted
+
+    def seal_before(self, month: str):
+        """
+        Make every month before `month` read-only, leaving WAL mode first so
+        a reader doesn't need to write a -shm file beside it. Months still
+        open elsewhere can't leave WAL mode; they're tried again next time.
+        """
+        for earlier in self.months():
+            path = self.partition_path(earlier)
+            if earlier >= month or _sealed(path):
+                continue
+            self._detach(earlier)
+            conn = sqlite3.connect(path)
+            try:
+                mode = conn.execute("PRAGMA journal_mode=DELETE").fetchone()[0]
+            except sqlite3.OperationalError as e:
+                mode = str(e)
+            finally:
+                conn.close()
+            if mode != "delete":
+                log.debug("Can't seal partition %s yet: %s", earlier, mode)
+                continue
+            path.chmod(path.stat().st_mode & ~0o222)
+            log.info("Sealed partition %s", earlier)
+
+    # ============
+    # = PLUMBING =
+    # ============
+    @contextlib.contextmanager
+    def _writable(self, month: str) -> Iterator[str]:
+        """Attach `month` for writing, creating or unsealing it as needed"""
+        path = self.partition_path(month)
+        created = not path.exists()
+        sealed = not created and _sealed(path)
+        if sealed:
+            # Reattach after unsealing: SQLite opened it read-only
+            self._detach(month)
+            path.chmod(path.stat().st_mode | stat.S_IWUSR)
+        try:
+            yield self._attach(month, create=created)
+        finally:
+            if sealed:
+                self._detach(month)
+                path.chmod(path.stat().st_mode & ~0o222)
+        if created:
+            self.seal_before(month)
+
+    def _use(self, months: list[str]):
+        """Attach just `months` and point the view at them"""
+        for month in list(self._attached):
+            if month not in months:
+                self._detach(month)
+        for month in months:
+            self._attach(month)
+        self._set_view(tuple(months))
+
+    def _attach(self, month: str, create: bool = False) -> str:
+        """Attach `month` if it isn't already; returns its schema name"""
+        path = self.partition_path(month)
+        inode = path.stat().st_ino if path.exists() else None
+        if month in self._attached:
+            schema, attached_inode = self._attached.pop(month)
+            if attached_inode == inode:
+                self._attached[month] = (schema, attached_inode)
+                return schema
+            # Deleted, and maybe recreated, by another process
+            self._detach_schema(schema)
+        if len(self._attached) >= MAX_ATTACHED:
+            self._detach(next(iter(self._attached)))
+        schema = _schema(month)
+        self.execute("ATTACH DATABASE ? AS " + schema, [str(path)])
+        if create:
+            self.execute(f"PRAGMA [{schema}].journal_mode=WAL")
+            create_depths_table(self, schema)
+            inode = path.stat().st_ino
+        self.execute(f"PRAGMA [{schema}].synchronous=NORMAL")
+        self._attached[month] = (schema, inode)
+        return schema
+
+    def _detach(self, month: str):
+        if month in self._attached:
+            self._detach_schema(self._attached.pop(month)[0])
+
+    def _detach_schema(self, schema: str):
+        if self._view and schema in map(_schema, self._view):
+            self._set_view(())
+        self.execute("DETACH DATABASE " + schema)
+
+    def _set_view(self, months: tuple[str, ...]):
+        if months == self._view:
+            return
+        selects = [
+            f"SELECT {DEPTH_COLUMNS} FROM [{self._attached[m][0]}].water_depths"
+            for m in months
+        ] or [f"SELECT {DEPTH_COLUMNS} FROM temp.{EMPTY_TABLE}"]
+        self.execute("DROP VIEW IF EXISTS temp.water_depths")
+        self.execute("CREATE TEMP VIEW water_depths AS " + " UNION ALL ".join(selects))
+        self._view = months
+
+
+# ====================
+# = EITHER KIND OF DB =
+# ====================
+def covering(db: Database, start_ts: float | None = None, end_ts: float | None = None):
+    """`db.covering()`, or nothing for a plain database"""
+    if isinstance(db, PartitionedDatabase):
+        return db.covering(start_ts, end_ts)
+    return contextlib.nullcontext()
+
+
+def each_month(
+    db: Database,
+    start_ts: float | None = None,
+    end_ts: float | None = None,
+    reverse: bool = False,
+) -> Iterator[str | None]:
+    """`db.each_month()`; a plain database is one "month", None"""
+    if isinstance(db, PartitionedDatabase):
+        yield from db.each_month(start_ts, end_ts, reverse)
+    else:
+        yield None
+
+
+def write_depths(
+    db: Database,
+    rows: Iterable[tuple],
+    replace: bool = True,
+    interpolated: bool = False,
+) -> int:
+    """Write (timestamp, datetime, raw_value, water_depth) rows"""
+    if isinstance(db, PartitionedDatabase):
+        return db.write_depths(rows, replace, interpolated)
+    create_depths_table(db)
+    if "interpolated" not in db["water_depths"].columns_dict:
+        # Created before readings could be interpolated
+        db.execute(
+            "ALTER TABLE water_depths "
+            "ADD COLUMN interpolated INTEGER NOT NULL DEFAULT 0"
+        )
+    verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+    with db.conn:
+        cursor = db.conn.executemany(
+            f"{verb} INTO water_depths ({DEPTH_COLUMNS}) "
+            f"VALUES (?, ?, ?, ?, {int(interpolated)})",
+            rows,
+        )
+    return max(cursor.rowcount, 0)
+
+
+def delete_depths(db: Database, start_ts: float, end_ts: float) -> int:
+    """Delete readings in [start_ts, end_ts]; returns how many"""
+    if isinstance(db, PartitionedDatabase):
+        return db.delete_depths(start_ts, end_ts)
+    if "water_depths" not in db.table_names():
+        return 0
+    with db.conn:
+        cursor = db.execute(
+            "DELETE FROM water_depths WHERE timestamp >= ? AND timestamp <= ?",
+            [start_ts, end_ts],
+        )
+    return cursor.rowcount
+
+
+def migrate(db: PartitionedDatabase) -> int:
+    """
+    Move readings from the main file's own `water_depths` table into
+    partitions, a month at a time, then drop it. Returns the number moved.
+    """
+    if "water_depths" not in Database.table_names(db):
+        return 0
+    first, last = db.execute(
+        "SELECT MIN(timestamp), MAX(timestamp) FROM main.water_depths"
+    ).fetchone()
+    has_flag = any(
+        row[1] == "interpolated"
+        for row in db.execute("PRAGMA main.table_info(water_depths)")
+    )
+    moved = 0
+    month = month_of(first) if first is not None else None
+    while month is not None and month <= month_of(last):
+        lo, hi = month_bounds(month)
+        rows = db.execute(
+            "SELECT timestamp, datetime, raw_value, water_depth, "
+            f"{'interpolated' if has_flag else '0'} FROM main.water_depths "
+            "WHERE timestamp >= ? AND timestamp < ?",
+            [lo, hi],
+        ).fetchall()
+        for interpolated in (0, 1):
+            moved += db.write_depths(
+                [row[:4] for row in rows if row[4] == interpolated],
+                interpolated=bool(interpolated),
+            )
+        month = month_of(hi)
+    with db.conn:
+        db.execute("DROP TABLE main.water_depths")
+    db.seal_before(month_of(time.time()))
+    return moved
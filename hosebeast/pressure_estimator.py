@@ -1,5 +1,6 @@
 #! /usr/bin/env python3
 
+import logging
 import time
 from datetime import datetime
 from math import sin, pi
@@ -10,6 +11,8 @@ from typing import TypeAlias
 # sudo raspi-config
 # (menus: Interfacing Options -> I2C -> Enable -> Finish)
 # reboot Pi
+log = logging.getLogger(__name__)
+
 MOCK = False
 try:
     import board
@@ -19,7 +22,7 @@ try:
 
     # SomeADCWrapper: TypeAlias = "ADCWrapper"
 except (ImportError, NotImplementedError):
-    print("Couldn't import I2C; using mock ADC data")
+    log.warning("Couldn't import I2C; using mock ADC data")
     MOCK = True
 SomeADCWrapper: TypeAlias = "MockADCWrapper | ADCWrapper"
 
@@ -0,0 +1,212 @@
+"""
+Multi-resolution summaries of `water_depths` for zooming and panning.
+
+Alongside the per-minute `water_depths` table we keep aggregate tables at
+10-minute, hourly, 6-hourly and daily resolution. Each row is one bucket,
+keyed by its start in epoch seconds, holding the count, sum, min and max of
+the depths in it. `query_range()` answers any (start, end) request from
+the coarsest level that still yields about `target_points` points, so a
+query over five years reads about as many rows as a query over a day.
+
+Buckets are refreshed from the level below whenever rows are inserted or
+deleted (`refresh_range()`); `ensure_pyramid()` builds any missing levels
+from scratch. Both write, so only the database writer calls them;
+`query_range()` only reads, and aggregates raw rows itself for a level
+that hasn't been built yet. Raw rows are only ever read a month at a time,
+so this works the same over monthly partitions (see partitions.py).
+`storage` calls all of these; use its wrappers rather than this module
+directly.
+"""
+
+from sqlite_utils import Database
+
+from . import partitions
+
+# (table, bucket size in seconds), finest first. The first level is the
+# raw per-minute table itself
+LEVELS = [
+    ("water_depths", 60),
+    ("water_depths_10m", 600),
+    ("water_depths_1h", 3600),
+    ("water_depths_6h", 6 * 3600),
+    ("water_depths_1d", 86400),
+]
+SUMMARY_LEVELS = LEVELS[1:]
+# Per-connection scratch table for the finest summary level
+STAGING = "water_depths_staged"
+
+
+def ensure_pyramid(db: Database):
+    """Create and fill any summary tables that don't exist yet"""
+    if "water_depths" not in db.table_names():
+        return
+    existing = set(db.table_names())
+    missing = [table for table, _ in SUMMARY_LEVELS if table not in existing]
+    if not missing:
+        return
+    if SUMMARY_LEVELS[0][0] in missing:
+        _stage(db)
+    with db.conn:
+        for (finer, _), (table, size) in zip(LEVELS, SUMMARY_LEVELS):
+            if table in missing:
+                _create(db, table)
+                if finer == "water_depths":
+                    db.execute(
+                        f"INSERT OR REPLACE INTO [{table}] SELECT * FROM {STAGING}"
+                    )
+                else:
+                    _fill(db, finer, table, size)
+
+
+def refresh_range(start_ts: float, end_ts: float, db: Database):
+    """Recompute every summary bucket overlapping [start_ts, end_ts]"""
+    if "water_depths" not in db.table_names():
+        return
+    ensure_pyramid(db)
+    size = SUMMARY_LEVELS[0][1]
+    _stage(db, start_ts // size * size, end_ts // size * size + size)
+    with db.conn:
+        for (finer, _), (table, size) in zip(LEVELS, SUMMARY_LEVELS):
+            first = int(start_ts // size * size)
+            last = int(end_ts // size * size)
+            db.execute(
+                f"DELETE FROM [{table}] WHERE bucket >= ? AND bucket <= ?",
+                [first, last],
+            )
+            if finer == "water_depths":
+                db.execute(f"INSERT OR REPLACE INTO [{table}] SELECT * FROM {STAGING}")
+            else:
+                _fill(db, finer, table, size, first, last + size)
+
+
+def _create(db: Database, table: str, temp: bool = False):
+    db.execute(
+        f"""CREATE {"TEMP " if temp else ""}TABLE IF NOT EXISTS [{table}] (
+            bucket INTEGER PRIMARY KEY,
+            n INTEGER,
+            sum_depth FLOAT,
+            min_depth FLOAT,
+            max_depth FLOAT,
+            sum_raw FLOAT
+        )"""
+    )
+
+
+def _stage(db: Database, start_ts: float | None = None, end_ts: float | None = None):
+    """
+    Aggregate raw rows in [start_ts, end_ts) into the finest buckets, in
+    the temporary STAGING table. A partitioned database is read a month at
+    a time, each month outside any transaction as attaching needs, so the
+    summary tables themselves can then be updated in one transaction.
+    Months start on a bucket boundary, so no bucket spans two.
+    """
+    size = SUMMARY_LEVELS[0][1]
+    _create(db, STAGING, temp=True)
+    with db.conn:
+        db.execute(f"DELETE FROM {STAGING}")
+    for _ in partitions.each_month(db, start_ts, end_ts):
+        with db.conn:
+            _fill(db, "water_depths", STAGING, size, start_ts, end_ts)
+
+
+def _fill(
+    db: Database,
+    finer: str,
+    table: str,
+    size: int,
+    start_ts: float | None = None,
+    end_ts: float | None = None,
+):
+    """Aggregate `finer` (raw rows or smaller buckets) into `table`"""
+    if finer == "water_depths":
+        time_col = "timestamp"
+        aggregates = (
+            "COUNT(*), SUM(water_depth), MIN(water_depth), MAX(water_depth), "
+            "SUM(raw_value)"
+        )
+    else:
+        time_col = "bucket"
+        aggregates = (
+            "SUM(n), SUM(sum_depth), MIN(min_depth), MAX(max_depth), SUM(sum_raw)"
+        )
+    where, params = "", []
+    if start_ts is not None:
+        where = f"WHERE {time_col} >= ? AND {time_col} < ?"
+        params = [start_ts, end_ts]
+    db.execute(
+        f"""INSERT OR REPLACE INTO [{table}]
+        SELECT CAST({time_col} / {size} AS INTEGER) * {size} AS b, {aggregates}
+        FROM [{finer}] {where}
+        GROUP BY b""",
+        params,
+    )
+
+
+def choose_level(start_ts: float, end_ts: float, target_points: int) -> tuple[str, int]:
+    """
+    The coarsest level that still gives at least half of `target_points`
+    across the range, so results land between target/2 and a few times target
+    """
+    span = max(0.0, end_ts - start_ts)
+    for table, size in reversed(LEVELS):
+        if span / size >= target_points / 2:
+            return table, size
+    return LEVELS[0]
+
+
+def query_range(
+    start_ts: float, end_ts: float, target_points: int, db: Database
+) -> dict[str, list]:
+    """
+    Depths between `start_ts` and `end_ts` as columns `t` (integer epoch
+    seconds) and `d` (cm, rounded to 0.1), from the level that best fits
+    `target_points`. Summary points are bucket means, placed mid-bucket.
+    """
+    chart = {"t": [], "d": []}
+    if "water_depths" not in db.table_names():
+        return chart
+    table, size = choose_level(start_ts, end_ts, target_points)
+    if table == "water_depths":
+        with partitions.covering(db, start_ts, end_ts):
+            cursor = db.execute(
+                """SELECT timestamp, water_depth FROM water_depths
+                WHERE timestamp >= ? AND timestamp <= ? ORDER BY timestamp""",
+                [start_ts, end_ts],
+            )
+    elif table not in db.table_names():
+        cursor = _raw_buckets(start_ts, end_ts, size, db)
+    else:
+        cursor = db.execute(
+            f"""SELECT bucket + {size // 2}, sum_depth / n FROM [{table}]
+            WHERE bucket >= ? AND bucket <= ? ORDER BY bucket""",
+            [start_ts // size * size, end_ts],
+        )
+    for timestamp, depth in cursor:
+        chart["t"].append(int(timestamp))
+        chart["d"].append(round(depth, 1))
+    return chart
+
+
+def _raw_buckets(
+    start_ts: float, end_ts: float, size: int, db: Database
+) -> list[tuple[float, float]]:
+    """(mid-bucket time, mean depth) straight from the raw rows, a month at a time"""
+    # bucket: [count, sum of depths]; a bucket may straddle two months
+    buckets: dict[int, list] = {}
+    # Whole buckets, like the summary tables
+    lo, hi = start_ts // size * size, end_ts // size * size + size
+    for _ in partitions.each_month(db, lo, hi):
+        for bucket, n, sum_depth in db.execute(
+            f"""SELECT CAST(timestamp / {size} AS INTEGER) * {size} AS b,
+                COUNT(*), SUM(water_depth)
+            FROM water_depths WHERE timestamp >= ? AND timestamp < ?
+            GROUP BY b""",
+            [lo, hi],
+        ):
+            totals = buckets.setdefault(bucket, [0, 0.0])
+            totals[0] += n
+            totals[1] += sum_depth
+    return [
+        (bucket + size // 2, sum_depth / n)
+        for bucket, (n, sum_depth) in sorted(buckets.items())
+    ]
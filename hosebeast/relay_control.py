@@ -1,12 +1,18 @@
 #! /usr/bin/env python3
 
 import asyncio
+import logging
 import time
 
+from . import metrics
+from .logs import pump_log
+
+log = logging.getLogger(__name__)
+
 try:
     import RPi.GPIO as GPIO
 except Exception:
-    print("Error importing RPi.GPIO. Using Mock.GPIO instead")
+    log.warning("Error importing RPi.GPIO. Using Mock.GPIO instead")
     import Mock.GPIO as GPIO
 
 """
@@ -65,7 +71,26 @@ PIN_NAMES = {
 
 IS_CONFIGURED = False
 
-def configure_relays():
+# The last level each relay was set to; True (HIGH) is off
+RELAY_OFF = {pin: True for pin in PIN_NAMES}
+
+
+def use_gpio_backend(backend) -> None:
+    """
+    Replace the GPIO module used by this file, e.g. with
+    `simulation.SimulatedGPIO`. Relays are reconfigured on next use.
+    """
+    global GPIO, IS_CONFIGURED
+    GPIO = backend
+    IS_CONFIGURED = False
+
+
+def configure_relays(keep: tuple[int, ...] = ()):
+    """
+    Set up the relay pins, driving each off except those in `keep`, which
+    stay at whatever level the last process left them and are read back
+    into RELAY_OFF.
+    """
     # This call is idempotent; calling it more than once is a no-op
     global IS_CONFIGURED
     if IS_CONFIGURED:
@@ -74,32 +99,54 @@ def configure_relays():
 
     GPIO.setmode(GPIO.BCM)
     GPIO.setwarnings(False)
-    GPIO.setup(RELAY_1, GPIO.OUT)
-    GPIO.setup(RELAY_2, GPIO.OUT)
+    for pin in PIN_NAMES:
+        if pin in keep:
+            # Without an initial level the output keeps the one it had, and
+            # input() reads it back
+            GPIO.setup(pin, GPIO.OUT)
+            RELAY_OFF[pin] = GPIO.input(pin) != GPIO.LOW
+        else:
+            # Drive the relay off (HIGH) from the start; a pin set up without
+            # an initial level can come up LOW after a reboot, running its pump
+            GPIO.setup(pin, GPIO.OUT, initial=GPIO.HIGH)
+            RELAY_OFF[pin] = True
 
 
 def set_relay(relay_pin: int, state: bool):
+    # Relays are active-low: a HIGH (True) output switches the pump off
     configure_relays()
+    GPIO.output(relay_pin, state)
+    RELAY_OFF[relay_pin] = state
     desc = PIN_NAMES.get(relay_pin)
     if desc:
-        print(f"{desc} {'ON' if state else 'OFF'} ")
-    GPIO.output(relay_pin, state)
+        pump_log().info(
+            "%s %s", desc, "OFF" if state else "ON", extra={"pin": relay_pin}
+        )
+    metrics.counter("hosebeast_relay_changes_total", "Relay outputs set").inc(
+        pin=relay_pin
+    )
 
 
 async def relay_on(relay_pin: int, duration: float | None = None):
     desc = PIN_NAMES.get(relay_pin)
     if desc:
-        print(f"{get_elapsed():5.2f}: {desc} ON for {duration}s")
+        pump_log().info("%5.2f: %s ON for %ss", get_elapsed(), desc, duration)
     GPIO.output(relay_pin, GPIO.LOW)
+    RELAY_OFF[relay_pin] = False
     if duration is not None:
-        await asyncio.sleep(duration, desc)
-        relay_off(relay_pin)
+        await asyncio.sleep(duration)
+        relay_off(relay_pin, desc)
 
 
 def relay_off(relay_pin: int, desc: str | None = None):
     if desc:
-        print(f"{get_elapsed():5.2f}: {desc} OFF")
+        pump_log().info("%5.2f: %s OFF", get_elapsed(), desc)
     GPIO.output(relay_pin, GPIO.HIGH)
+    RELAY_OFF[relay_pin] = True
+
+
+def any_relay_on() -> bool:
+    return not all(RELAY_OFF.values())
 
 
 async def stagger_relay_starts():
@@ -0,0 +1,280 @@
+"""
+A permanent record of when the pumps ran.
+
+Every relay change the controller makes is appended to `relay_events`:
+when, which pin (and its zone name), on or off, and why ("manual" from
+the dashboard or CLI, "schedule", or "restart" for a run cut short by the
+controller stopping). Each on/off pair also becomes a row of `pump_runs`,
+and as a run ends its seconds are added to `pump_runtime_daily`, per day
+and zone, split at midnight. Runtime reports read a row per day; they
+never replay events.
+
+Runs are also indexed in an R*Tree, so "which runs overlap this window"
+(the chart's pump overlay) is a single index probe however long the
+history. The R*Tree keeps 32-bit floats, which round epoch seconds
+outward by up to a couple of minutes, so matches are re-checked against
+`pump_runs`. A run still going has no end yet; it's found separately.
+
+The controller switches relays from its event loop, so it never waits on
+SQLite there: `RelayEventWriter` buffers events and writes them a batch at
+a time on the database writer thread.
+"""
+
+import asyncio
+import contextlib
+import logging
+import sqlite3
+import time
+from datetime import date, datetime, timedelta
+
+from sqlite_utils import Database
+
+from .db_pool import DBPool
+
+log = logging.getLogger(__name__)
+
+SOURCES = ["manual", "schedule", "restart"]
+# Buffered events are written at least this often
+FLUSH_SECS = 5.0
+# ...or as soon as this many are waiting
+MAX_BUFFERED = 50
+
+
+def ensure_tables(db: Database):
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS relay_events (
+            id INTEGER PRIMARY KEY,
+            timestamp FLOAT NOT NULL,
+            pin INTEGER NOT NULL,
+            zone TEXT,
+            is_on INTEGER NOT NULL,
+            source TEXT NOT NULL
+        )"""
+    )
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS pump_runs (
+            id INTEGER PRIMARY KEY,
+            pin INTEGER NOT NULL,
+            zone TEXT,
+            source TEXT NOT NULL,
+            start_ts FLOAT NOT NULL,
+            end_ts FLOAT,
+            end_source TEXT
+        )"""
+    )
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS pump_runs_open ON pump_runs (pin) "
+        "WHERE end_ts IS NULL"
+    )
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS pump_runtime_daily (
+            day TEXT,
+            pin INTEGER,
+            zone TEXT,
+            runs INTEGER NOT NULL DEFAULT 0,
+            seconds FLOAT NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, pin)
+        )"""
+    )
+    if "pump_runs_index" in db.table_names():
+        return
+    try:
+        db.execute(
+            "CREATE VIRTUAL TABLE pump_runs_index USING rtree(id, start_ts, end_ts)"
+        )
+    except sqlite3.OperationalError as e:
+        # SQLite built without R*Tree; overlaps then scan pump_runs by start
+        log.warning("No R*Tree index for pump runs: %s", e)
+        db.execute("CREATE INDEX IF NOT EXISTS pump_runs_start ON pump_runs (start_ts)")
+
+
+def _day(ts: float) -> date:
+    return datetime.fromtimestamp(ts).date()
+
+
+def _add_runtime(db: Database, pin: int, zone: str, start_ts: float, end_ts: float):
+    """Add a finished run's seconds to each day it spans, split at midnight"""
+    day = _day(start_ts)
+    while True:
+        midnight = datetime.combine(day + timedelta(days=1), datetime.min.time())
+        until = min(end_ts, midnight.timestamp())
+        db.execute(
+            """INSERT INTO pump_runtime_daily (day, pin, zone, runs, seconds)
+            VALUES (?, ?, ?, 0, ?)
+            ON CONFLICT (day, pin) DO UPDATE SET seconds = seconds + excluded.seconds""",
+            [day.isoformat(), pin, zone, max(0.0, until - start_ts)],
+        )
+        if until >= end_ts:
+            return
+        start_ts, day = until, day + timedelta(days=1)
+
+
+def _open_run(db: Database, pin: int) -> tuple[int, str, float] | None:
+    return db.execute(
+        "SELECT id, zone, start_ts FROM pump_runs WHERE pin = ? AND end_ts IS NULL",
+        [pin],
+    ).fetchone()
+
+
+def _end_run(db: Database, pin: int, ts: float, source: str, index: bool):
+    run = _open_run(db, pin)
+    if run is None:
+        return
+    run_id, zone, start_ts = run
+    end_ts = max(ts, start_ts)
+    db.execute(
+        "UPDATE pump_runs SET end_ts = ?, end_source = ? WHERE id = ?",
+        [end_ts, source, run_id],
+    )
+    if index:
+        db.execute(
+            "INSERT INTO pump_runs_index VALUES (?, ?, ?)", [run_id, start_ts, end_ts]
+        )
+    _add_runtime(db, pin, zone, start_ts, end_ts)
+
+
+def write_events(events: list[tuple], db: Database):
+    """
+    Append (timestamp, pin, zone, is_on, source) events, oldest first, and
+    update runs and daily runtime to match, in one transaction
+    """
+    ensure_tables(db)
+    index = "pump_runs_index" in db.table_names()
+    with db.conn:
+        for ts, pin, zone, is_on, source in events:
+            db.execute(
+                "INSERT INTO relay_events (timestamp, pin, zone, is_on, source) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [ts, pin, zone, int(is_on), source],
+            )
+            if not is_on:
+                _end_run(db, pin, ts, source, index)
+            elif _open_run(db, pin) is None:
+                db.execute(
+                    "INSERT INTO pump_runs (pin, zone, source, start_ts) "
+                    "VALUES (?, ?, ?, ?)",
+                    [pin, zone, source, ts],
+                )
+                db.execute(
+                    """INSERT INTO pump_runtime_daily (day, pin, zone, runs)
+                    VALUES (?, ?, ?, 1)
+                    ON CONFLICT (day, pin) DO UPDATE SET runs = runs + 1""",
+                    [_day(ts).isoformat(), pin, zone],
+                )
+
+
+def end_open_runs(
+    ts: float, db: Database, still_on: dict[int, str] | None = None
+) -> int:
+    """
+    End any runs left open, e.g. by a crash, at `ts`. The controller calls
+    this as it starts, with every relay off except `still_on` ({pin: zone}),
+    the pumps of a scheduled run it's resuming. Their runs carry on, and
+    one whose start never got written starts at `ts`. Returns how many
+    runs were ended.
+    """
+    ensure_tables(db)
+    still_on = still_on or {}
+    open_runs = dict(
+        db.execute("SELECT pin, zone FROM pump_runs WHERE end_ts IS NULL").fetchall()
+    )
+    events = [
+        (ts, pin, zone, False, "restart")
+        for pin, zone in open_runs.items()
+        if pin not in still_on
+    ]
+    events += [
+        (ts, pin, zone, True, "schedule")
+        for pin, zone in still_on.items()
+        if pin not in open_runs
+    ]
+    write_events(events, db)
+    return sum(1 for pin in open_runs if pin not in still_on)
+
+
+def runs_overlapping(start_ts: float, end_ts: float, db: Database) -> list[dict]:
+    """Runs that were going at any time in [start_ts, end_ts], oldest first"""
+    if "pump_runs" not in db.table_names():
+        return []
+    if "pump_runs_index" in db.table_names():
+        finished = """SELECT pump_runs.* FROM pump_runs_index
+            JOIN pump_runs USING (id)
+            WHERE pump_runs_index.start_ts <= :end
+                AND pump_runs_index.end_ts >= :start
+                AND pump_runs.start_ts <= :end AND pump_runs.end_ts >= :start"""
+    else:
+        finished = """SELECT * FROM pump_runs
+            WHERE start_ts <= :end AND end_ts >= :start"""
+    return list(
+        db.query(
+            f"""{finished}
+            UNION ALL
+            SELECT * FROM pump_runs WHERE end_ts IS NULL AND start_ts <= :end
+            ORDER BY start_ts""",
+            {"start": start_ts, "end": end_ts},
+        )
+    )
+
+
+def daily_runtime(start: date | None, end: date | None, db: Database) -> list[dict]:
+    """Runs and seconds run per day and zone, from `start` to `end` inclusive"""
+    if "pump_runtime_daily" not in db.table_names():
+        return []
+    return list(
+        db["pump_runtime_daily"].rows_where(
+            "day >= ? AND day <= ?",
+            [(start or date.min).isoformat(), (end or date.max).isoformat()],
+            order_by="day, pin",
+        )
+    )
+
+
+class RelayEventWriter:
+    """Buffers relay changes, writing them in batches through `pool`'s writer"""
+
+    def __init__(
+        self,
+        pool: DBPool,
+        flush_secs: float = FLUSH_SECS,
+        max_buffered: int = MAX_BUFFERED,
+    ):
+        self.pool = pool
+        self.flush_secs = flush_secs
+        self.max_buffered = max_buffered
+        self._buffer: list[tuple] = []
+        self._wake = asyncio.Event()
+
+    def record(
+        self,
+        pin: int,
+        zone: str | None,
+        is_on: bool,
+        source: str,
+        ts: float | None = None,
+    ):
+        """Queue one relay change; never blocks"""
+        self._buffer.append((ts or time.time(), pin, zone, is_on, source))
+        if len(self._buffer) >= self.max_buffered:
+            self._wake.set()
+
+    async def run(self):
+        """Flush every `flush_secs`, and once more when cancelled"""
+        try:
+            while True:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wake.wait(), self.flush_secs)
+                self._wake.clear()
+                await self.flush()
+        finally:
+            await self.flush()
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        batch, self._buffer = self._buffer, []
+        try:
+            await self.pool.write(write_events, batch)
+        except Exception:
+            # Keep them for the next try, ahead of anything newer
+            log.exception("Couldn't write %d relay events", len(batch))
+            self._buffer[:0] = batch
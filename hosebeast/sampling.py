@@ -0,0 +1,88 @@
+"""
+Adaptive sampling: how often to read the depth sensor, and which readings
+to store.
+
+While a pump runs or the level is moving, `AdaptiveSampler` asks for fast
+reads and a stored row every minute. When the level is flat it backs off
+to slow reads and only stores a row when depth has moved by more than a
+deadband since the last stored row, or `max_store_secs` has passed. That
+way a flat night costs a few rows rather than hundreds, and charts still
+show the flat stretch.
+
+The controller (controller.py) owns the only sampler: it reads the sensor
+at the interval the sampler asks for and stores the rows it picks, however
+many dashboards are watching.
+"""
+
+import math
+from dataclasses import dataclass
+
+
+@dataclass
+class SamplingPolicy:
+    # Read intervals while active (pump on or level moving) and at rest
+    fast_secs: float = 1.0
+    slow_secs: float = 10.0
+    # The level counts as moving above this rate
+    active_cm_per_min: float = 0.1
+    # At rest, store once depth has moved this far from the last stored row
+    deadband_cm: float = 0.3
+    # Rows are keyed by minute, so there's no point storing more often
+    min_store_secs: float = 60
+    # Store at least this often, even when nothing changes
+    max_store_secs: float = 15 * 60
+    # Smoothing for the rate estimate
+    rate_time_constant_secs: float = 60
+
+
+class AdaptiveSampler:
+    def __init__(self, policy: SamplingPolicy | None = None):
+        self.policy = policy or SamplingPolicy()
+        # Smoothed, signed rate of change, so noise averages out
+        self.rate_cm_per_min = 0.0
+        self.pumps_on = False
+        self._last: tuple[float, float] | None = None
+        self._last_stored: tuple[float, float] | None = None
+        self._pumps_on_at_store = False
+
+    def observe(self, now: float, depth: float, pumps_on: bool):
+        """Record a (filtered) reading taken at epoch time `now`"""
+        self.pumps_on = pumps_on
+        last, self._last = self._last, (now, depth)
+        dt = 0.0 if last is None else now - last[0]
+        # The controller reads at least fast_secs apart, so only the clock
+        # stepping back (NTP setting a Pi's clock after boot) leaves no
+        # interval to measure a rate over; carry on from this reading
+        if dt >= self.policy.fast_secs / 2:
+            rate = (depth - last[1]) / dt * 60
+            alpha = 1 - math.exp(-dt / self.policy.rate_time_constant_secs)
+            self.rate_cm_per_min += alpha * (rate - self.rate_cm_per_min)
+
+    @property
+    def active(self) -> bool:
+        return (
+            self.pumps_on or abs(self.rate_cm_per_min) >= self.policy.active_cm_per_min
+        )
+
+    def interval(self) -> float:
+        """Seconds until the next sensor read"""
+        return self.policy.fast_secs if self.active else self.policy.slow_secs
+
+    def should_store(self, now: float, depth: float) -> bool:
+        if self._last_stored is None:
+            return True
+        stored_at, stored_depth = self._last_stored
+        elapsed = now - stored_at
+        if elapsed < self.policy.min_store_secs:
+            return False
+        return (
+            self.active
+            or elapsed >= self.policy.max_store_secs
+            # Catch the minute a pump stops, too
+            or self.pumps_on != self._pumps_on_at_store
+            or abs(depth - stored_depth) >= self.policy.deadband_cm
+        )
+
+    def stored(self, now: float, depth: float):
+        self._last_stored = (now, depth)
+        self._pumps_on_at_store = self.pumps_on
@@ -0,0 +1,83 @@
+"""Pure scheduling math for the pump relays.
+
+Nothing in here touches Reflex, the ADC or GPIO, so it can be imported
+from simulations, benchmarks and command-line tools.
+"""
+
+from datetime import datetime, timedelta
+
+VALID_TIME_UNITS = ["minutes", "hours", "days"]
+
+# Used until someone saves a schedule
+DEFAULT_SCHEDULE = {
+    "start_time": "4:30",
+    "duration_mins": 15,
+    "repeat_interval": 1,
+    "repeat_units": "days",
+}
+
+
+def repeat_step(repeat_interval: int, repeat_units: str) -> timedelta | None:
+    """Time between runs, or None if the repeat pattern isn't usable"""
+    try:
+        step = timedelta(**{repeat_units: repeat_interval})
+    except TypeError:
+        # unknown units, or a non-numeric interval
+        return None
+    if step <= timedelta(0):
+        return None
+    return step
+
+
+def calculate_next_relay_times(
+    start_time: str,
+    duration_mins: int,
+    repeat_interval: int,
+    repeat_units: str,
+    now: datetime | None = None,
+) -> tuple[datetime, datetime]:
+    """
+    Given input values defining a range & repeat pattern, tell us the next
+    time it will be valid. BUT- if we're currently INSIDE a valid range, return
+    that range.
+
+    Runs repeat every `repeat_interval` `repeat_units` before and after
+    `start_time` today, so a run that started yesterday evening and is still
+    going counts as the current one. This runs in constant time however many
+    intervals have passed today. `now` defaults to the wall clock; simulations
+    pass their virtual time.
+    """
+    now = now or datetime.now()
+    today = now.date()
+    start_hour, start_minute = (0, 0)
+    try:
+        # users will often have invalid values in a text field ('4:', '', '3')
+        # in the course of entering a date. ignore it if it doesn't work
+        start_hour, start_minute = map(int, start_time.split(":"))
+    except ValueError:
+        pass
+
+    base = datetime.combine(
+        today, datetime.min.time().replace(hour=start_hour, minute=start_minute)
+    )
+    duration = timedelta(minutes=duration_mins)
+    step = repeat_step(repeat_interval, repeat_units)
+    if step is None:
+        return base, base + duration
+
+    # The latest run that started at or before now...
+    latest = (now - base) // step
+    # ...and the earliest run that hasn't ended yet. If that one has already
+    # started, we're inside it; durations longer than the interval overlap,
+    # and we report the earliest of the overlapping runs
+    earliest_unfinished = -((base + duration - now) // step)
+    if earliest_unfinished <= latest:
+        next_start = base + earliest_unfinished * step
+    else:
+        next_start = base + (latest + 1) * step
+    return next_start, next_start + duration
+
+
+def even_minute(dt: datetime | None = None) -> datetime:
+    dt = dt or datetime.now()
+    return dt.replace(second=0, microsecond=0)
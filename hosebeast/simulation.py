@@ -0,0 +1,344 @@
+#! /usr/bin/env python3
+"""
+Simulated hardware for running Hosebeast without a Pi.
+
+A `Simulation` ties together a virtual clock, a physical tank model, a
+simulated ADS1115 channel and a stand-in for the `RPi.GPIO` module. Pumps
+switched on through the GPIO stand-in drain the tank, a constant inflow
+refills it, and the ADC reports the resulting pressure with configurable
+noise, spikes and I2C faults. Everything is driven by a seeded RNG and the
+virtual clock, so runs are repeatable and can go much faster than real time:
+
+    sim = Simulation(start=datetime(2024, 1, 1), seed=1)
+    for row in sim.replay(days=90, schedule={...}):
+        ...
+
+To run the dashboard against the simulation, set `HOSEBEAST_SIM=1`.
+"""
+
+import asyncio
+import random
+import time
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any
+
+from .pressure_estimator import VALID_GAINS
+from .relay_control import RELAY_1, RELAY_2
+from .scheduling import calculate_next_relay_times, even_minute
+
+# ADS1115 full-scale voltage at gain 1; other gains scale it by 1/gain
+ADC_FULL_SCALE_VOLTS = 4.096
+ADC_MAX_COUNT = 32767
+
+
+class VirtualClock:
+    """
+    A clock that only moves when told to.
+
+    With `speed=None` (the default) time stands still until `advance()` is
+    called, and `sleep()` advances it instantly. With a `speed`, the clock
+    also follows the wall clock, scaled by that factor, so a live app can
+    run at (or faster than) real time.
+    """
+
+    def __init__(self, start: datetime | None = None, speed: float | None = None):
+        self._start = start or datetime.now()
+        self._offset = 0.0
+        self.speed = speed
+        self._wall_start = time.monotonic()
+
+    def elapsed(self) -> float:
+        elapsed = self._offset
+        if self.speed is not None:
+            elapsed += (time.monotonic() - self._wall_start) * self.speed
+        return elapsed
+
+    def now(self) -> datetime:
+        return self._start + timedelta(seconds=self.elapsed())
+
+    def time(self) -> float:
+        return self.now().timestamp()
+
+    def advance(self, seconds: float):
+        self._offset += seconds
+
+    async def sleep(self, seconds: float):
+        if self.speed is None:
+            self.advance(seconds)
+            await asyncio.sleep(0)
+        else:
+            await asyncio.sleep(seconds / self.speed)
+
+
+@dataclass
+class TankModel:
+    """Water level in a tank fed by a steady inflow and drained by pumps."""
+
+    depth_cm: float = 80.0
+    max_depth_cm: float = 120.0
+    # Drain rate for each running pump
+    pump_drain_cm_per_min: float = 0.8
+    # Constant inflow, e.g. a float valve or roof runoff
+    refill_cm_per_min: float = 0.008
+    evaporation_cm_per_day: float = 0.3
+
+    def step(self, seconds: float, pumps_running: int = 0) -> float:
+        minutes = seconds / 60
+        delta = self.refill_cm_per_min * minutes
+        delta -= self.evaporation_cm_per_day * minutes / 1440
+        delta -= self.pump_drain_cm_per_min * minutes * pumps_running
+        self.depth_cm = min(self.max_depth_cm, max(0.0, self.depth_cm + delta))
+        return self.depth_cm
+
+
+@dataclass
+class SensorModel:
+    """
+    Pressure transducer feeding an ADS1115. The transducer outputs
+    `zero_volts` at an empty tank and rises linearly with depth.
+    """
+
+    zero_volts: float = 0.5
+    volts_per_cm: float = 0.01
+    # Standard deviation of gaussian noise, in ADC counts at gain 1
+    noise_counts: float = 6.0
+    # Chance per read of a single large outlier
+    spike_probability: float = 0.0
+    spike_counts: int = 3000
+    # Chance per read that the I2C transaction fails
+    fault_probability: float = 0.0
+
+    def volts(self, depth_cm: float) -> float:
+        return self.zero_volts + depth_cm * self.volts_per_cm
+
+    def raw(self, depth_cm: float, gain: float, rng: random.Random) -> int:
+        if rng.random() < self.fault_probability:
+            # This is what the Adafruit driver surfaces on a flaky bus
+            raise OSError(121, "Remote I/O error")
+        counts = self.volts(depth_cm) * gain / ADC_FULL_SCALE_VOLTS * ADC_MAX_COUNT
+        counts += rng.gauss(0, self.noise_counts * gain)
+        if rng.random() < self.spike_probability:
+            counts += rng.choice((-1, 1)) * self.spike_counts
+        return int(min(ADC_MAX_COUNT, max(-ADC_MAX_COUNT - 1, counts)))
+
+    def calibration(self, gain: float = 1.0) -> tuple[float, float]:
+        """
+        The (slope, intercept) that converts raw values at `gain` to depth,
+        i.e. what `HBState.calibrate_depth` would converge to.
+        """
+        volts_per_count = ADC_FULL_SCALE_VOLTS / gain / ADC_MAX_COUNT
+        slope = volts_per_count / self.volts_per_cm
+        intercept = -self.zero_volts / self.volts_per_cm
+        return slope, intercept
+
+
+class SimulatedGPIO:
+    """
+    Enough of the `RPi.GPIO` module interface for `relay_control`.
+    Relays are active-low: a pin driven LOW means its pump is running.
+    """
+
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    HIGH = 1
+    LOW = 0
+
+    def __init__(self, on_change: Callable[[], None] | None = None):
+        self.levels: dict[int, int] = {}
+        self._on_change = on_change
+
+    def setmode(self, mode: int):
+        pass
+
+    def setwarnings(self, flag: bool):
+        pass
+
+    def setup(self, pin: int, mode: int, initial: int | None = None):
+        # Like RPi.GPIO, an initial level drives the pin; without one it keeps
+        # whatever level it had
+        if initial is not None:
+            self.levels[pin] = int(initial)
+        else:
+            self.levels.setdefault(pin, self.HIGH)
+
+    def output(self, pin: int, state: Any):
+        if self._on_change:
+            self._on_change()
+        self.levels[pin] = int(bool(state))
+
+    def input(self, pin: int) -> int:
+        return self.levels.get(pin, self.HIGH)
+
+    def cleanup(self):
+        self.levels.clear()
+
+    def pins_low(self, pins: tuple[int, ...]) -> int:
+        return sum(1 for p in pins if self.levels.get(p, self.HIGH) == self.LOW)
+
+
+class SimulatedADCWrapper:
+    """Same interface as `ADCWrapper`, reading from a `Simulation`."""
+
+    def __init__(
+        self,
+        sim: "Simulation",
+        pin_0: int,
+        pin_1: int | None = None,
+        gain: float = 1.0,
+    ):
+        self.sim = sim
+        self._gain = gain or VALID_GAINS[0]
+
+    @property
+    def gain(self) -> float:
+        return self._gain
+
+    @gain.setter
+    def gain(self, gain: float):
+        if float(gain) not in VALID_GAINS:
+            raise ValueError(f"Gain must be one of {VALID_GAINS}")
+        self._gain = gain
+
+    @property
+    def value(self) -> int:
+        return self.sim.read_raw(self._gain)
+
+    @property
+    def voltage(self) -> float:
+        return self.value / ADC_MAX_COUNT * ADC_FULL_SCALE_VOLTS / self._gain
+
+
+class Simulation:
+    def __init__(
+        self,
+        start: datetime | None = None,
+        seed: int = 0,
+        tank: TankModel | None = None,
+        sensor: SensorModel | None = None,
+        speed: float | None = None,
+        pump_pins: tuple[int, ...] = (RELAY_1, RELAY_2),
+    ):
+        self.clock = VirtualClock(start, speed)
+        self.tank = tank or TankModel()
+        self.sensor = sensor or SensorModel()
+        self.rng = random.Random(seed)
+        self.pump_pins = pump_pins
+        self.gpio = SimulatedGPIO(on_change=self.sync)
+        self.i2c_faults = 0
+        self.reads = 0
+        self._synced_at = self.clock.elapsed()
+
+    def sync(self):
+        """Bring the tank up to the current virtual time."""
+        elapsed = self.clock.elapsed()
+        seconds = elapsed - self._synced_at
+        if seconds > 0:
+            self.tank.step(seconds, self.gpio.pins_low(self.pump_pins))
+        self._synced_at = elapsed
+
+    def read_raw(self, gain: float = 1.0) -> int:
+        self.sync()
+        self.reads += 1
+        try:
+            return self.sensor.raw(self.tank.depth_cm, gain, self.rng)
+        except OSError:
+            self.i2c_faults += 1
+            raise
+
+    def channel(
+        self, pin_0: int, pin_1: int | None = None, gain: float = 1.0
+    ) -> SimulatedADCWrapper:
+        return SimulatedADCWrapper(self, pin_0, pin_1, gain)
+
+    def replay(
+        self,
+        days: float,
+        schedule: dict | None = None,
+        sample_secs: int = 60,
+        reads_per_sample: int = 1,
+    ) -> Iterator[dict]:
+        """
+        Step the clock through `days` of virtual time, running the pump
+        `schedule` (keys as in the `schedules` table) on RELAY_1 and
+        yielding one `water_depths` row per `sample_secs`. Samples where
+        every read hit an I2C fault are skipped, like the live app would.
+        """
+        slope, intercept = self.sensor.calibration()
+        end = self.clock.now() + timedelta(days=days)
+        run_until = None
+        while self.clock.now() < end:
+            self.clock.advance(sample_secs)
+            now = self.clock.now()
+            if schedule and (run_until is None or now >= run_until):
+                next_start, next_end = calculate_next_relay_times(
+                    schedule["start_time"],
+                    schedule["duration_mins"],
+                    schedule["repeat_interval"],
+                    schedule["repeat_units"],
+                    now=now,
+                )
+                pump_on = next_start <= now < next_end
+                run_until = next_end if pump_on else next_start
+                self.gpio.output(RELAY_1, self.gpio.LOW if pump_on else self.gpio.HIGH)
+
+            total, count = 0, 0
+            for _ in range(reads_per_sample):
+                try:
+                    total += self.read_raw()
+                    count += 1
+                except OSError:
+                    pass
+            if count == 0:
+                continue
+            mean_raw = int(total / count)
+            now_minute = even_minute(now)
+            yield {
+                "timestamp": now_minute.timestamp(),
+                "datetime": now_minute.isoformat(),
+                "raw_value": mean_raw,
+                "water_depth": max(0, round(mean_raw * slope + intercept, 1)),
+            }
+
+
+def main():
+    import argparse
+
+    from sqlite_utils import Database
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("db_path", help="SQLite file to write water_depths into")
+    parser.add_argument("--days", type=float, default=90)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--noise", type=float, default=SensorModel.noise_counts)
+    parser.add_argument("--faults", type=float, default=0.0)
+    args = parser.parse_args()
+
+    sim = Simulation(
+        start=even_minute() - timedelta(days=args.days),
+        seed=args.seed,
+        sensor=SensorModel(noise_counts=args.noise, fault_probability=args.faults),
+    )
+    schedule = {
+        "start_time": "4:30",
+        "duration_mins": 15,
+        "repeat_interval": 1,
+        "repeat_units": "days",
+    }
+    db = Database(args.db_path)
+    start = time.perf_counter()
+    db["water_depths"].insert_all(
+        sim.replay(args.days, schedule), pk="timestamp", replace=True, batch_size=1000
+    )
+    elapsed = time.perf_counter() - start
+    print(
+        f"Simulated {args.days} days ({db['water_depths'].count} rows, "
+        f"{sim.i2c_faults} I2C faults) in {elapsed:.2f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
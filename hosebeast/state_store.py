@@ -0,0 +1,202 @@
+"""
+Session state shared between backend workers, kept in SQLite.
+
+Reflex keeps each browser session's state inside the backend process
+unless it's given Redis. With several backend workers, a session's events
+can land on any of them, so they need one store. Set REDIS_URL and Reflex
+uses Redis; otherwise `StateManagerSQLite` stands in for it with nothing
+but a file:
+
+- Each substate is pickled into its own row of `hosebeast-state.db`, the
+  way `StateManagerRedis` keys them, and only substates that changed are
+  written back.
+- A `locks` row per session stands in for Redis' SET NX: a worker must
+  insert it before changing that session, and rows older than Reflex's
+  `redis_lock_expiration` are taken over, so a crashed worker can't wedge
+  a session.
+
+All SQLite work runs on a `DBPool`, off the event loop.
+"""
+
+import asyncio
+import contextlib
+import logging
+import time
+import uuid
+from collections.abc import AsyncIterator
+
+import dill
+from reflex.config import get_config
+from reflex.state import BaseState, StateManager
+from sqlite_utils import Database
+
+from .db_pool import DBPool
+
+try:
+    import pydantic.v1 as pydantic
+except ModuleNotFoundError:
+    import pydantic  # type: ignore
+
+log = logging.getLogger(__name__)
+
+STATE_DB_PATH = "hosebeast-state.db"
+# How often a worker retries a session lock another worker holds
+LOCK_POLL_SECS = 0.02
+
+
+def create_tables(db: Database):
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS states "
+        "(client TEXT, name TEXT, data BLOB, updated REAL, PRIMARY KEY (client, name))"
+    )
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS locks "
+        "(client TEXT PRIMARY KEY, lock_id TEXT, expires REAL)"
+    )
+
+
+def load_rows(client: str, db: Database) -> dict[str, bytes]:
+    """Pickled substates of session `client`, by full state name"""
+    rows = db.execute("SELECT name, data FROM states WHERE client = ?", [client])
+    return dict(rows.fetchall())
+
+
+def save_rows(client: str, rows: list[tuple[str, bytes]], db: Database):
+    now = time.time()
+    with db.conn:
+        db.conn.executemany(
+            "INSERT OR REPLACE INTO states (client, name, data, updated) "
+            "VALUES (?, ?, ?, ?)",
+            [(client, name, data, now) for name, data in rows],
+        )
+
+
+def try_lock(client: str, lock_id: str, expiration_secs: float, db: Database) -> bool:
+    now = time.time()
+    with db.conn:
+        db.execute("DELETE FROM locks WHERE client = ? AND expires < ?", [client, now])
+        cursor = db.execute(
+            "INSERT OR IGNORE INTO locks (client, lock_id, expires) VALUES (?, ?, ?)",
+            [client, lock_id, now + expiration_secs],
+        )
+    return cursor.rowcount == 1
+
+
+def release_lock(client: str, lock_id: str, db: Database) -> bool:
+    """Release the lock; False if it had expired and been taken over"""
+    with db.conn:
+        cursor = db.execute(
+            "DELETE FROM locks WHERE client = ? AND lock_id = ?", [client, lock_id]
+        )
+    return cursor.rowcount == 1
+
+
+def purge_expired(max_age_secs: float, db: Database):
+    cutoff = time.time() - max_age_secs
+    with db.conn:
+        db.execute("DELETE FROM states WHERE updated < ?", [cutoff])
+        db.execute("DELETE FROM locks WHERE expires < ?", [time.time()])
+
+
+class StateManagerSQLite(StateManager):
+    """A state manager that shares states between processes through SQLite"""
+
+    path: str = STATE_DB_PATH
+
+    # Sessions untouched for this long (s) are dropped at startup
+    token_expiration: int = pydantic.Field(
+        default_factory=lambda: get_config().redis_token_expiration
+    )
+
+    # The longest a worker may hold a session's lock (ms)
+    lock_expiration: int = pydantic.Field(
+        default_factory=lambda: get_config().redis_lock_expiration
+    )
+
+    _pool: DBPool = pydantic.PrivateAttr()
+
+    # Workers in this process queue here rather than polling the lock table
+    _client_locks: dict[str, asyncio.Lock] = pydantic.PrivateAttr({})
+
+    def __init__(self, state: type[BaseState], path: str = STATE_DB_PATH):
+        super().__init__(state=state, path=path)
+        db = Database(path)
+        create_tables(db)
+        purge_expired(self.token_expiration, db)
+        db.close()
+        self._pool = DBPool(path)
+
+    def _build(
+        self, state_cls: type[BaseState], parent: BaseState | None, rows: dict
+    ) -> BaseState:
+        """Unpickle `state_cls` and its substates, creating any not yet stored"""
+        state = None
+        data = rows.get(state_cls.get_full_name())
+        if data is not None:
+            try:
+                state = dill.loads(data)
+            except Exception as e:  # noqa: BLE001
+                # e.g. stored by an older version of the app
+                log.debug("Discarding stored %s: %s", state_cls.get_full_name(), e)
+        if state is None:
+            state = state_cls(
+                parent_state=parent, init_substates=False, _reflex_internal_init=True
+            )
+        if parent is not None:
+            parent.substates[state.get_name()] = state
+            state.parent_state = parent
+        for substate_cls in state_cls.get_substates():
+            self._build(substate_cls, state, rows)
+        return state
+
+    async def get_state(self, token: str) -> BaseState:
+        # Like the memory manager, always return the whole tree from the top
+        client = _client(token)
+        rows = await self._pool.read(load_rows, client)
+        return self._build(self.state, None, rows)
+
+    async def set_state(self, token: str, state: BaseState):
+        rows = []
+        pending = [state._get_root_state()]
+        while pending:
+            substate = pending.pop()
+            pending.extend(substate.substates.values())
+            if substate._get_was_touched():
+                rows.append(
+                    (substate.get_full_name(), dill.dumps(substate, byref=True))
+                )
+        if rows:
+            await self._pool.write(save_rows, _client(token), rows)
+
+    @contextlib.asynccontextmanager
+    async def modify_state(self, token: str) -> AsyncIterator[BaseState]:
+        async with self._lock(_client(token)):
+            state = await self.get_state(token)
+            yield state
+            await self.set_state(token, state)
+
+    @contextlib.asynccontextmanager
+    async def _lock(self, client: str) -> AsyncIterator[str]:
+        local_lock = self._client_locks.setdefault(client, asyncio.Lock())
+        lock_id = uuid.uuid4().hex
+        async with local_lock:
+            expiration_secs = self.lock_expiration / 1000
+            while not await self._pool.write(
+                try_lock, client, lock_id, expiration_secs
+            ):
+                await asyncio.sleep(LOCK_POLL_SECS)
+            try:
+                yield lock_id
+            finally:
+                if not await self._pool.write(release_lock, client, lock_id):
+                    log.warning(
+                        "State lock for %s expired while held; consider raising "
+                        "redis_lock_expiration",
+                        client,
+                    )
+
+
+def _client(token: str) -> str:
+    # Tokens may carry a substate suffix, "<client>_<state path>"
+    return token.partition("_")[0]
@@ -0,0 +1,617 @@
+"""
+SQLite storage for depth readings, calibration and schedules.
+
+Everything that touches `hosebeast.db` lives here, without importing Reflex,
+so the dashboard, benchmarks and maintenance scripts share one code path.
+Each function takes an optional `db` to run against another database.
+
+With HOSEBEAST_PARTITIONS=<directory>, readings are kept in one file per
+month in that directory rather than in `hosebeast.db` (see partitions.py);
+`open_db()` opens either kind, and everything here works with both.
+"""
+
+import functools
+import os
+import sqlite3
+from collections.abc import Iterator
+from datetime import date, datetime, timedelta
+
+from sqlite_utils import Database
+
+from . import metrics, partitions, pyramid, relay_log, tank, usage
+from .db_pool import DBPool
+
+DB_PATH = "hosebeast.db"
+PARTITION_DIR = os.environ.get("HOSEBEAST_PARTITIONS")
+
+
+def open_db(path_or_conn: str | sqlite3.Connection = DB_PATH) -> Database:
+    """A database, partitioned by month if HOSEBEAST_PARTITIONS is set"""
+    if PARTITION_DIR:
+        return partitions.PartitionedDatabase(path_or_conn, PARTITION_DIR)
+    return Database(path_or_conn)
+
+
+# For scripts and one-off maintenance; the app goes through POOL instead.
+# Opened on first use, so merely importing this (e.g. `hosebeast --db x.db`)
+# doesn't create `hosebeast.db` in the current directory.
+@functools.cache
+def get_db() -> Database:
+    """The default database, `hosebeast.db`"""
+    return open_db()
+
+
+# Awaitable access from the event loop, e.g.
+# `await POOL.read(load_depth_range, start_ts, end_ts)`
+POOL = DBPool(DB_PATH, connect=open_db)
+
+VALID_TIME_RANGES = ["day", "week", "month", "all"]
+
+
+def time_range_start(time_range: str, now: datetime) -> datetime | None:
+    """Start of `time_range` ending at `now`; None means all time"""
+    if time_range == "day":
+        return now - timedelta(days=1)
+    elif time_range == "week":
+        return now - timedelta(weeks=1)
+    elif time_range == "month":
+        return now - timedelta(days=30)
+    return None
+
+
+def load_water_depth_data(
+    time_range: str,
+    rows_to_fetch: int = 200,
+    now: datetime | None = None,
+    db: Database | None = None,
+) -> list[dict]:
+    """Full `water_depths` rows sampled evenly across `time_range`"""
+    db = get_db() if db is None else db
+    return list(_sampled_depth_rows("*", time_range, rows_to_fetch, now, db))
+
+
+def load_depth_chart(
+    time_range: str,
+    target_points: int = 200,
+    now: datetime | None = None,
+    db: Database | None = None,
+) -> dict[str, list]:
+    """The depth chart's data for one of `VALID_TIME_RANGES`, ending at `now`"""
+    db = get_db() if db is None else db
+    now = now or datetime.now()
+    start = time_range_start(time_range, now)
+    if start is None:
+        earliest = earliest_depth_time(db)
+        if earliest is None:
+            return {"t": [], "d": []}
+        start_ts = earliest
+    else:
+        start_ts = start.timestamp()
+    return load_depth_range(start_ts, now.timestamp(), target_points, db=db)
+
+
+@metrics.timed("hosebeast_chart_query_seconds", "Chart data queries")
+def load_depth_range(
+    start_ts: float,
+    end_ts: float,
+    target_points: int = 200,
+    db: Database | None = None,
+) -> dict[str, list]:
+    """
+    The depth chart's data between two epoch times, in compact columnar
+    form: `t` holds integer epoch seconds and `d` depths rounded to the
+    displayed 0.1 cm. The browser zips the columns back into points, so each
+    point costs two short numbers on the wire and in session state, rather
+    than a five-key dict.
+
+    Long ranges are served from the `pyramid` summary tables, so any range,
+    from an hour to years, returns roughly `target_points` points at about
+    the same cost. Only reads; the writer builds the tables
+    (`ensure_summaries`).
+    """
+    db = get_db() if db is None else db
+    return pyramid.query_range(start_ts, end_ts, target_points, db)
+
+
+def ensure_summaries(db: Database | None = None):
+    """Build any chart summary tables that are missing; for the writer only"""
+    pyramid.ensure_pyramid(get_db() if db is None else db)
+
+
+def earliest_depth_time(db: Database | None = None) -> float | None:
+    """Epoch seconds of the first stored depth, if any"""
+    db = get_db() if db is None else db
+    if "water_depths" not in db.table_names():
+        return None
+    for _ in partitions.each_month(db):
+        earliest = db.execute("SELECT MIN(timestamp) FROM water_depths").fetchone()[0]
+        if earliest is not None:
+            return earliest
+    return None
+
+
+def recent_depths(limit: int = 20, db: Database | None = None) -> list[dict]:
+    """The latest `limit` stored readings, oldest first"""
+    db = get_db() if db is None else db
+    if "water_depths" not in db.table_names():
+        return []
+    rows = []
+    for _ in partitions.each_month(db, reverse=True):
+        rows += db["water_depths"].rows_where(
+            order_by="-timestamp", limit=limit - len(rows)
+        )
+        if len(rows) >= limit:
+            break
+    return rows[::-1]
+
+
+def depth_rows(
+    start_ts: float | None = None,
+    end_ts: float | None = None,
+    db: Database | None = None,
+) -> Iterator[dict]:
+    """Every stored reading between two epoch times (inclusive), oldest first"""
+    db = get_db() if db is None else db
+    if "water_depths" not in db.table_names():
+        return
+    window = [start_ts or 0, end_ts if end_ts is not None else float("inf")]
+    for _ in partitions.each_month(db, *window):
+        yield from db["water_depths"].rows_where(
+            "timestamp >= ? AND timestamp <= ?", window, order_by="timestamp"
+        )
+
+
+def depth_stats(
+    start_ts: float | None = None,
+    end_ts: float | None = None,
+    db: Database | None = None,
+) -> dict | None:
+    """Count, extent and summary of the readings in a range; None if empty"""
+    db = get_db() if db is None else db
+    if "water_depths" not in db.table_names():
+        return None
+    window = [start_ts or 0, end_ts if end_ts is not None else float("inf")]
+    stats = None
+    # Month by month, for partitioned databases
+    for _ in partitions.each_month(db, *window):
+        month = next(
+            db.query(
+                """
+                SELECT COUNT(*) AS count, MIN(timestamp) AS first_ts,
+                    MAX(timestamp) AS last_ts, MIN(water_depth) AS min_depth,
+                    MAX(water_depth) AS max_depth, SUM(water_depth) AS sum_depth
+                FROM water_depths WHERE timestamp >= ? AND timestamp <= ?
+                """,
+                window,
+            )
+        )
+        if not month["count"]:
+            continue
+        if stats is None:
+            stats = month
+            stats["first_depth"] = _depth_at(month["first_ts"], db)
+        else:
+            stats["count"] += month["count"]
+            stats["last_ts"] = month["last_ts"]
+            stats["min_depth"] = min(stats["min_depth"], month["min_depth"])
+            stats["max_depth"] = max(stats["max_depth"], month["max_depth"])
+            stats["sum_depth"] += month["sum_depth"]
+        stats["last_depth"] = _depth_at(month["last_ts"], db)
+    if stats is None:
+        return None
+    stats["mean_depth"] = stats.pop("sum_depth") / stats["count"]
+    return stats
+
+
+def _depth_at(ts: float, db: Database) -> float:
+    return db.execute(
+        "SELECT water_depth FROM water_depths WHERE timestamp = ?", [ts]
+    ).fetchone()[0]
+
+
+def _sampled_depth_rows(
+    columns: str,
+    time_range: str,
+    rows_to_fetch: int,
+    now: datetime | None,
+    db: Database,
+) -> Iterator[dict]:
+    now = now or datetime.now()
+    if "water_depths" not in db.table_names():
+        return
+    start_ts = earliest_depth_time(db)
+    if start_ts is None:
+        return
+    earliest_date = datetime.fromtimestamp(start_ts)
+
+    start_date = time_range_start(time_range, now) or earliest_date
+    start_date = max(earliest_date, start_date)
+    start_ts = start_date.timestamp()
+
+    # NOTE: 2024-08-31: Because this query skips integer-numbered rows,
+    # we can only be precise about the number of rows fetched within
+    # +/- rows_to_fetch rows. So... don't limit the query to rows_to_fetch
+    # rows; that results in missing the most recent data.
+
+    # Count the rows we'd get, in the entire range from start_ts to now,
+    # then divide by the number of rows we want to fetch and query for
+    # that many rows.
+    # NOTE: if we've been adding to the table irregularly, this will
+    # skip those gaps, overrepresenting times when we did get data
+    # Maybe we really want something like "get one value for each of
+    # rows_to_fetch timeslots between start_ts and now, and interpolate
+    # vals if a given timeslot is empty"
+    month_rows = []
+    for _ in partitions.each_month(db, start_ts):
+        month_rows.append(db["water_depths"].count_where("timestamp >= ?", [start_ts]))
+    rows_available = sum(month_rows)
+    interval_rows = max(1, int(rows_available / rows_to_fetch))
+
+    # Rows are numbered across the whole range, carrying the count on from
+    # month to month when partitioned
+    query = f"""
+    SELECT {columns} FROM (
+        SELECT *, ROW_NUMBER() OVER (ORDER BY timestamp) + ? AS row_num
+        FROM water_depths
+        WHERE timestamp >= ?
+    ) AS numbered
+    WHERE row_num % ? = 0
+    ORDER BY timestamp
+    """
+    offset = 0
+    for _, count in zip(partitions.each_month(db, start_ts), month_rows):
+        yield from db.query(query, [offset, start_ts, interval_rows])
+        offset += count
+
+
+@metrics.timed("hosebeast_db_insert_seconds", "water_depths inserts")
+def store_water_depth(row: dict, db: Database | None = None):
+    db = get_db() if db is None else db
+    partitions.write_depths(
+        db, [(row["timestamp"], row["datetime"], row["raw_value"], row["water_depth"])]
+    )
+    pyramid.refresh_range(row["timestamp"], row["timestamp"], db)
+    if table := tank.from_env():
+        usage.record(table, db)
+
+
+def refresh_summaries(start_ts: float, end_ts: float, db: Database | None = None):
+    """
+    Bring the chart's summary tables and daily water use up to date after
+    readings in [start_ts, end_ts] were added or deleted out of order
+    """
+    db = get_db() if db is None else db
+    pyramid.refresh_range(start_ts, end_ts, db)
+    if table := tank.from_env():
+        usage.refresh_from(start_ts, table, db)
+
+
+def delete_db_range(
+    start_dt: datetime | None = None,
+    end_dt: datetime | None = None,
+    table_name: str = "water_depths",
+    db: Database | None = None,
+) -> int:
+    db = get_db() if db is None else db
+    if start_dt is None:
+        start_dt = datetime(2024, 8, 1)
+    if end_dt is None:
+        end_dt = datetime.now()
+
+    start_ts = start_dt.timestamp()
+    end_ts = end_dt.timestamp()
+
+    if table_name == "water_depths":
+        deleted = partitions.delete_depths(db, start_ts, end_ts)
+        refresh_summaries(start_ts, end_ts, db)
+        return deleted
+
+    table = db[table_name]
+    rows_before = table.count
+    table.delete_where("timestamp >= ? AND timestamp <= ?", [start_ts, end_ts])
+    rows_after = table.count
+
+    return rows_before - rows_after
+
+
+# =============
+# = WATER USE =
+# =============
+def load_water_use(
+    start: date | None = None, end: date | None = None, db: Database | None = None
+) -> list[dict]:
+    """
+    Litres pumped, otherwise used and refilled on each day from `start` to
+    `end` (inclusive), oldest first. Empty until the controller has built
+    the totals, which it only does with HOSEBEAST_TANK set.
+    """
+    db = get_db() if db is None else db
+    return usage.load_water_use(start, end, db)
+
+
+def update_water_use(db: Database | None = None):
+    """
+    Bring the daily totals up to date, building them from history the first
+    time or after the tank changes. For the writer only; storing a reading
+    does this too.
+    """
+    db = get_db() if db is None else db
+    if table := tank.from_env():
+        usage.record(table, db)
+
+
+# =============
+# = PUMP RUNS =
+# =============
+def store_relay_events(events: list[tuple], db: Database | None = None):
+    """Append (timestamp, pin, zone, is_on, source) relay changes"""
+    relay_log.write_events(events, get_db() if db is None else db)
+
+
+def end_open_pump_runs(
+    ts: float, still_on: dict[int, str] | None = None, db: Database | None = None
+) -> int:
+    """End runs the last controller left open at `ts`; returns how many"""
+    return relay_log.end_open_runs(ts, get_db() if db is None else db, still_on)
+
+
+def pump_runs(start_ts: float, end_ts: float, db: Database | None = None) -> list[dict]:
+    """Pump runs overlapping [start_ts, end_ts]; `end_ts` is None while running"""
+    return relay_log.runs_overlapping(start_ts, end_ts, get_db() if db is None else db)
+
+
+def pump_runtime(
+    start: date | None = None, end: date | None = None, db: Database | None = None
+) -> list[dict]:
+    """Runs started and seconds run on each day and zone, oldest first"""
+    return relay_log.daily_runtime(start, end, get_db() if db is None else db)
+
+
+# ========
+# = FLOW =
+# ========
+def store_flow_rates(rows: list[tuple], db: Database | None = None):
+    """Append (timestamp, pin, zone, pulses, litres) seconds from the flow meters"""
+    db = get_db() if db is None else db
+    with db.conn:
+        db.execute(
+            """CREATE TABLE IF NOT EXISTS flow_rates (
+                timestamp INTEGER NOT NULL,
+                pin INTEGER NOT NULL,
+                zone TEXT NOT NULL,
+                pulses INTEGER NOT NULL,
+                litres FLOAT NOT NULL,
+                PRIMARY KEY (zone, timestamp, pin)
+            )"""
+        )
+        db.conn.executemany(
+            "INSERT OR REPLACE INTO flow_rates VALUES (?, ?, ?, ?, ?)", rows
+        )
+
+
+def delivered_litres(
+    start_ts: float, end_ts: float, zone: str | None = None, db: Database | None = None
+) -> dict[str, float]:
+    """Litres the flow meters counted in [start_ts, end_ts], by zone"""
+    db = get_db() if db is None else db
+    if "flow_rates" not in db.table_names():
+        return {}
+    where = "timestamp >= ? AND timestamp <= ?"
+    params: list = [start_ts, end_ts]
+    if zone is not None:
+        where = "zone = ? AND " + where
+        params.insert(0, zone)
+    return dict(
+        db.execute(
+            f"SELECT zone, SUM(litres) FROM flow_rates WHERE {where} GROUP BY zone",
+            params,
+        ).fetchall()
+    )
+
+
+# ==========
+# = ALERTS =
+# ==========
+def _alerts_table(db: Database):
+    return db["alerts"].create(
+        {
+            "id": int,
+            "kind": str,
+            "message": str,
+            "value": float,
+            "raised_ts": float,
+            "cleared_ts": float,
+        },
+        pk="id",
+        if_not_exists=True,
+    )
+
+
+def raise_alert(
+    kind: str, message: str, value: float, ts: float, db: Database | None = None
+):
+    db = get_db() if db is None else db
+    _alerts_table(db).insert(
+        {"kind": kind, "message": message, "value": value, "raised_ts": ts}
+    )
+
+
+def clear_alert(kind: str, ts: float, db: Database | None = None):
+    db = get_db() if db is None else db
+    with db.conn:
+        _alerts_table(db)
+        db.execute(
+            "UPDATE alerts SET cleared_ts = ? WHERE kind = ? AND cleared_ts IS NULL",
+            [ts, kind],
+        )
+
+
+def load_alerts(
+    since_ts: float = 0, active_only: bool = False, db: Database | None = None
+) -> list[dict]:
+    """Alerts still active or raised since `since_ts`, oldest first"""
+    db = get_db() if db is None else db
+    if "alerts" not in db.table_names():
+        return []
+    where = "cleared_ts IS NULL"
+    if not active_only:
+        where += " OR raised_ts >= ?"
+    return list(
+        db["alerts"].rows_where(
+            where, [] if active_only else [since_ts], order_by="raised_ts"
+        )
+    )
+
+
+# ===============
+# = CALIBRATION =
+# ===============
+def store_calibration_point(
+    when: datetime,
+    adc_raw: int,
+    actual_depth: float,
+    adc_gain: float,
+    db: Database | None = None,
+):
+    db = get_db() if db is None else db
+    db["calibration_points"].insert(
+        {
+            "timestamp": when.timestamp(),
+            "datetime": when.isoformat(),
+            "adc_raw": adc_raw,
+            "actual_depth": actual_depth,
+            "adc_gain": adc_gain,
+        },
+        pk="timestamp",
+        replace=True,
+        alter=True,
+    )
+
+
+def calibration_points(
+    adc_gain: float, db: Database | None = None
+) -> list[tuple[int, float]]:
+    """All (adc_raw, actual_depth) pairs recorded at `adc_gain`"""
+    db = get_db() if db is None else db
+    if "calibration_points" not in db.table_names():
+        return []
+    return [
+        (row["adc_raw"], float(row["actual_depth"]))
+        for row in db["calibration_points"].rows_where("adc_gain = ?", [adc_gain])
+    ]
+
+
+def store_calibration(
+    when: datetime,
+    slope: float,
+    intercept: float,
+    adc_gain: float,
+    db: Database | None = None,
+):
+    db = get_db() if db is None else db
+    db["calibration"].insert(
+        {
+            "timestamp": when.timestamp(),
+            "datetime": when.isoformat(),
+            "slope": slope,
+            "intercept": intercept,
+            "adc_gain": adc_gain,
+        },
+        pk="timestamp",
+        replace=True,
+        alter=True,
+    )
+
+
+def latest_calibration(db: Database | None = None) -> dict | None:
+    """The most recent calibration record, if any"""
+    db = get_db() if db is None else db
+    if "calibration" not in db.table_names():
+        return None
+    return next(db["calibration"].rows_where(order_by="-timestamp", limit=1), None)
+
+
+def calibrations_by_gain(db: Database | None = None) -> dict[float, dict]:
+    """The latest calibration record at each ADC gain, skipping failed fits"""
+    db = get_db() if db is None else db
+    if "calibration" not in db.table_names():
+        return {}
+    # SQLite fills the bare columns from the row with the MAX
+    rows = db.query(
+        "SELECT adc_gain, slope, intercept, datetime, MAX(timestamp) AS timestamp "
+        "FROM calibration WHERE slope != 0 GROUP BY adc_gain"
+    )
+    return {row["adc_gain"]: row for row in rows}
+
+
+# =============
+# = SCHEDULES =
+# =============
+def load_schedule(db: Database | None = None) -> dict | None:
+    db = get_db() if db is None else db
+    if "schedules" not in db.table_names():
+        return None
+    # Assuming we use id=1 for the first schedule
+    return next(db["schedules"].rows_where("id = ?", [1]), None)
+
+
+def store_schedule(
+    start_time: str,
+    duration_mins: int,
+    repeat_interval: int,
+    repeat_units: str,
+    db: Database | None = None,
+):
+    db = get_db() if db is None else db
+    db["schedules"].upsert(
+        {
+            "id": 1,
+            "start_time": start_time,
+            "duration_mins": duration_mins,
+            "repeat_interval": repeat_interval,
+            "repeat_units": repeat_units,
+        },
+        pk="id",
+    )
+
+
+def load_scheduled_run(db: Database | None = None) -> dict | None:
+    """The scheduled run the controller last started, stopped or finished"""
+    db = get_db() if db is None else db
+    if "scheduled_run" not in db.table_names():
+        return None
+    return next(db["scheduled_run"].rows_where("id = ?", [1]), None)
+
+
+def store_scheduled_run(
+    pin: int,
+    zone: str,
+    window_start: float,
+    planned_end: float,
+    state: str,
+    db: Database | None = None,
+):
+    """
+    Save the controller's scheduled run: "running", "stopped" by hand, or
+    "done". The controller saves it before switching the relay, so a
+    restarted controller knows whether to carry on.
+    """
+    db = get_db() if db is None else db
+    # This has to survive a power cut, not just a crash, so sync the commit
+    # to disk rather than leaving it in the WAL
+    synchronous = db.execute("PRAGMA synchronous").fetchone()[0]
+    db.execute("PRAGMA synchronous=FULL")
+    try:
+        db["scheduled_run"].upsert(
+            {
+                "id": 1,
+                "pin": pin,
+                "zone": zone,
+                "window_start": window_start,
+                "planned_end": planned_end,
+                "state": state,
+            },
+            pk="id",
+        )
+    finally:
+        db.execute(f"PRAGMA synchronous={synchronous}")
@@ -0,0 +1,148 @@
+"""
+Tank geometry: how much water a depth means.
+
+The tank is described by HOSEBEAST_TANK, a short spec like the sensor's
+filter chain:
+
+    cylinder:<diameter cm>:<height cm>           an upright round tank
+    box:<length cm>:<width cm>:<height cm>       a rectangular tank
+    table:<path>                                 anything else, from a CSV
+                                                 of depth_cm,litres rows
+
+`compile_tank()` turns any of these into a `VolumeTable`, the volume at
+every 0.1 cm of depth (the resolution depths are stored at). Converting a
+depth is then an index and one interpolation whatever the shape, so a
+volume chart costs the same as the depth chart it's converted from, and
+measured tables for odd-shaped tanks cost no more than a cylinder.
+"""
+
+import csv
+import math
+import os
+from array import array
+from dataclasses import dataclass
+from functools import cache
+from itertools import pairwise
+from pathlib import Path
+
+# Depths are stored to 0.1 cm, so finer steps wouldn't be used
+STEP_CM = 0.1
+LITRES_PER_GALLON = 3.785411784
+CM_PER_INCH = 2.54
+
+VALID_MEASUREMENT_UNITS = ["cm", "in", "gal", "L"]
+DEPTH_UNITS = ["cm", "in"]
+VOLUME_UNITS = ["gal", "L"]
+
+
+@dataclass
+class VolumeTable:
+    """Litres at each `STEP_CM` of depth, from empty to full"""
+
+    litres_at: array
+    spec: str = ""
+
+    @property
+    def max_depth(self) -> float:
+        return (len(self.litres_at) - 1) * STEP_CM
+
+    @property
+    def capacity(self) -> float:
+        return self.litres_at[-1]
+
+    def litres(self, depth_cm: float) -> float:
+        position = min(max(depth_cm, 0.0), self.max_depth) / STEP_CM
+        i = min(int(position), len(self.litres_at) - 2)
+        below, above = self.litres_at[i], self.litres_at[i + 1]
+        return below + (above - below) * (position - i)
+
+
+def _cylinder(diameter: float, height: float):
+    area = math.pi * (diameter / 2) ** 2
+    return height, lambda depth: area * depth / 1000
+
+
+def _box(length: float, width: float, height: float):
+    return height, lambda depth: length * width * depth / 1000
+
+
+def _table(path: str):
+    with Path(path).open(newline="") as f:
+        points = sorted(
+            (float(row["depth_cm"]), float(row["litres"])) for row in csv.DictReader(f)
+        )
+    if len(points) < 2:
+        raise ValueError(f"{path} needs at least two depth_cm,litres rows")
+    depths = [depth for depth, _ in points]
+
+    def litres(depth: float) -> float:
+        # Linear between measured points, flat beyond them
+        for (d0, l0), (d1, l1) in pairwise(points):
+            if depth <= d1:
+                return l0 + (l1 - l0) * max(0.0, depth - d0) / (d1 - d0)
+        return points[-1][1]
+
+    return depths[-1], litres
+
+
+SHAPES = {
+    "cylinder": (_cylinder, float),
+    "box": (_box, float),
+    "table": (_table, str),
+}
+
+
+def compile_tank(spec: str) -> VolumeTable:
+    """
+    A `VolumeTable` for e.g. "cylinder:150:120", "box:200:100:80" or
+    "table:tank.csv"
+    """
+    name, *args = spec.strip().split(":", 1 if spec.startswith("table:") else -1)
+    if name not in SHAPES:
+        raise ValueError(f"Unknown tank shape {name!r}; must be one of {list(SHAPES)}")
+    shape, arg_type = SHAPES[name]
+    try:
+        height, litres = shape(*(arg_type(arg) for arg in args))
+    except TypeError:
+        raise ValueError(f"Wrong number of dimensions in tank spec {spec!r}") from None
+    steps = max(1, round(height / STEP_CM))
+    return VolumeTable(
+        array("d", (litres(i * STEP_CM) for i in range(steps + 1))), spec=spec
+    )
+
+
+@cache
+def from_env() -> VolumeTable | None:
+    """The tank described by HOSEBEAST_TANK, if it's set"""
+    spec = os.environ.get("HOSEBEAST_TANK")
+    return compile_tank(spec) if spec else None
+
+
+def units(table: VolumeTable | None) -> list[str]:
+    """The measurement units that can be shown for a tank"""
+    return VALID_MEASUREMENT_UNITS if table else DEPTH_UNITS
+
+
+def convert(depth_cm: float, unit: str, table: VolumeTable | None) -> float:
+    """`depth_cm` in `unit`, to one decimal place"""
+    if unit == "cm":
+        return round(depth_cm, 1)
+    if unit == "in":
+        return round(depth_cm / CM_PER_INCH, 1)
+    if unit not in VOLUME_UNITS:
+        raise ValueError(f"Unknown unit {unit!r}; must be one of {units(table)}")
+    if table is None:
+        raise ValueError("Volumes need the tank's shape; set HOSEBEAST_TANK")
+    return litres_in(table.litres(depth_cm), unit)
+
+
+def litres_in(litres: float, unit: str) -> float:
+    """A volume in litres, in `unit` ("L" or "gal"), to one decimal place"""
+    return round(litres / LITRES_PER_GALLON if unit == "gal" else litres, 1)
+
+
+def convert_chart(chart: dict, unit: str, table: VolumeTable | None) -> dict:
+    """A `load_depth_range` chart with its depths converted to `unit`"""
+    if unit == "cm":
+        return chart
+    return {"t": chart["t"], "d": [convert(d, unit, table) for d in chart["d"]]}
@@ -0,0 +1,211 @@
+"""
+Daily water use and refill, kept up to date as readings are stored.
+
+`water_use` holds a row per (local) day: litres pumped out, litres
+otherwise lost (a tap, a leak, evaporation) and litres refilled. It's
+materialized. Each stored reading advances it by the change in volume since
+the last one (`record()`), so a usage report reads a row per day however
+much history there is, and never recomputes from raw readings.
+
+- Changes smaller than `NOISE_CM` are held until they add up, so sensor
+  noise doesn't count as both use and refill.
+- A drop counts as pumped when the level is falling faster than
+  `PUMP_CM_PER_MIN` between consecutive readings. The sampler stores a
+  reading every minute while a pump runs (see sampling.py), and pumps
+  drain the tank far faster than anything else does.
+
+When stored readings change after the fact (an import, gap filling, a
+prune), `refresh_from()` replays readings from the start of the first
+changed day. The tank spec is saved alongside, so changing HOSEBEAST_TANK
+rebuilds the table from history once. `storage` calls all of these; use its
+wrappers rather than this module directly.
+
+Only writers call `record()` and `refresh_from()`; reading the totals never
+updates them. Totals are added, not set, so each update checks the state
+it started from in the same `BEGIN IMMEDIATE` transaction that adds to
+them. If another writer (e.g. `hosebeast import` beside the controller)
+moved the state on in the meantime, the update is dropped and worked out
+again from the new state, so no reading is ever counted twice.
+"""
+
+from datetime import date, datetime
+
+from sqlite_utils import Database
+
+from . import partitions
+from .tank import VolumeTable
+
+# Smallest change in level that counts as use or refill
+NOISE_CM = 0.3
+# Falling at least this fast between readings means a pump is running
+PUMP_CM_PER_MIN = 0.2
+# Readings further apart than this say nothing about how fast water left
+MAX_RATE_GAP_SECS = 20 * 60
+
+
+def ensure_tables(db: Database):
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS water_use (
+            day TEXT PRIMARY KEY,
+            pumped_l FLOAT NOT NULL DEFAULT 0,
+            used_l FLOAT NOT NULL DEFAULT 0,
+            refilled_l FLOAT NOT NULL DEFAULT 0
+        )"""
+    )
+    # One row: how far `water_use` has got, and the level it measures from
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS water_use_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            tank TEXT,
+            last_ts FLOAT,
+            last_depth FLOAT,
+            baseline_depth FLOAT
+        )"""
+    )
+
+
+def _day(ts: float) -> str:
+    return datetime.fromtimestamp(ts).date().isoformat()
+
+
+def _day_start(ts: float) -> float:
+    day = datetime.fromtimestamp(ts).date()
+    return datetime(day.year, day.month, day.day).timestamp()
+
+
+def _readings_after(ts: float, db: Database) -> list[tuple[float, float]]:
+    """(timestamp, depth) of every reading after `ts`, oldest first"""
+    readings = []
+    for _ in partitions.each_month(db, ts):
+        readings += db.execute(
+            "SELECT timestamp, water_depth FROM water_depths "
+            "WHERE timestamp > ? ORDER BY timestamp",
+            [ts],
+        ).fetchall()
+    return readings
+
+
+def _reading_before(ts: float, db: Database) -> tuple[float, float] | None:
+    for _ in partitions.each_month(db, None, ts, reverse=True):
+        row = db.execute(
+            "SELECT timestamp, water_depth FROM water_depths "
+            "WHERE timestamp < ? ORDER BY timestamp DESC LIMIT 1",
+            [ts],
+        ).fetchone()
+        if row:
+            return row
+    return None
+
+
+def _state(db: Database) -> tuple | None:
+    return db.execute(
+        "SELECT tank, last_ts, last_depth, baseline_depth FROM water_use_state"
+    ).fetchone()
+
+
+def record(table: VolumeTable, db: Database):
+    """Add readings stored since the last call to their days' totals"""
+    if "water_depths" not in db.table_names():
+        return
+    ensure_tables(db)
+    while True:
+        state = _state(db)
+        if state is None or state[0] != table.spec:
+            refresh_from(None, table, db)
+            return
+        if _advance(table, state[1], state[2], state[3], db):
+            return
+
+
+def refresh_from(start_ts: float | None, table: VolumeTable, db: Database):
+    """Recompute every day from the one holding `start_ts`; None means all"""
+    if "water_depths" not in db.table_names():
+        return
+    ensure_tables(db)
+    last_ts, last_depth, baseline = float("-inf"), None, None
+    if start_ts is not None:
+        start_ts = _day_start(start_ts)
+        before = _reading_before(start_ts, db)
+        if before is not None:
+            last_ts, last_depth = before
+            baseline = last_depth
+    db.execute("BEGIN IMMEDIATE")
+    with db.conn:
+        if start_ts is None:
+            db.execute("DELETE FROM water_use")
+        else:
+            db.execute("DELETE FROM water_use WHERE day >= ?", [_day(start_ts)])
+        db.execute(
+            "INSERT OR REPLACE INTO water_use_state VALUES (1, ?, ?, ?, ?)",
+            [table.spec, last_ts, last_depth, baseline],
+        )
+    if not _advance(table, last_ts, last_depth, baseline, db):
+        record(table, db)
+
+
+def _advance(
+    table: VolumeTable,
+    last_ts: float,
+    last_depth: float | None,
+    baseline: float | None,
+    db: Database,
+) -> bool:
+    """
+    Add readings after `last_ts` to their days. Returns False, having
+    changed nothing, if the state no longer starts at `last_ts`.
+    """
+    start_ts = last_ts
+    totals: dict[str, list[float]] = {}
+    for ts, depth in _readings_after(last_ts, db):
+        if baseline is None:
+            baseline = depth
+        elif abs(depth - baseline) >= NOISE_CM:
+            litres = table.litres(depth) - table.litres(baseline)
+            day = totals.setdefault(_day(ts), [0.0, 0.0, 0.0])
+            if litres > 0:
+                day[2] += litres
+            elif (
+                ts - last_ts <= MAX_RATE_GAP_SECS
+                and (last_depth - depth) / (ts - last_ts) * 60 >= PUMP_CM_PER_MIN
+            ):
+                day[0] -= litres
+            else:
+                day[1] -= litres
+            baseline = depth
+        last_ts, last_depth = ts, depth
+    if last_depth is None or last_ts == start_ts:
+        return True
+    # Holds the write lock from the state check to the commit
+    db.execute("BEGIN IMMEDIATE")
+    with db.conn:
+        state = _state(db)
+        if state is None or state[0] != table.spec or state[1] != start_ts:
+            return False
+        db.conn.executemany(
+            """INSERT INTO water_use (day, pumped_l, used_l, refilled_l)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (day) DO UPDATE SET
+                pumped_l = pumped_l + excluded.pumped_l,
+                used_l = used_l + excluded.used_l,
+                refilled_l = refilled_l + excluded.refilled_l""",
+            [(day, *litres) for day, litres in totals.items()],
+        )
+        db.execute(
+            "UPDATE water_use_state "
+            "SET last_ts = ?, last_depth = ?, baseline_depth = ?",
+            [last_ts, last_depth, baseline],
+        )
+    return True
+
+
+def load_water_use(start: date | None, end: date | None, db: Database) -> list[dict]:
+    """Daily totals from `start` to `end` (inclusive), oldest first"""
+    if "water_use" not in db.table_names():
+        return []
+    return list(
+        db["water_use"].rows_where(
+            "day >= ? AND day <= ?",
+            [(start or date.min).isoformat(), (end or date.max).isoformat()],
+            order_by="day",
+        )
+    )
@@ -5,12 +5,16 @@ print_help() {
     echo "Options:"
     echo "  --mock VALUE    Set mock value (default: 0)"
     echo "  --env VALUE     Set environment (dev or prod, default: dev)"
+    echo "  --workers N     Backend worker processes, prod only (default: 1)"
+    echo "  --rebuild       Rebuild the prod frontend, e.g. after an update"
     echo "  -h, --help      Display this help message"
 }
 
 # Global variables
 MOCK=0
 ENV="dev"
+WORKERS=1
+REBUILD=0
 
 # Function to parse command line arguments
 parse_arguments() {
@@ -28,9 +32,21 @@ parse_arguments() {
                 fi
                 shift 2
                 ;;
+            --workers)
+                WORKERS="$2"
+                if ! [[ "$WORKERS" =~ ^[1-9][0-9]*$ ]]; then
+                    echo "Error: --workers must be a positive integer"
+                    exit 1
+                fi
+                shift 2
+                ;;
+            --rebuild)
+                REBUILD=1
+                shift
+                ;;
             -h|--help)
                 print_help
-                echo "Parsed arguments: mock=$MOCK, env=$ENV"
+                echo "Parsed arguments: mock=$MOCK, env=$ENV, workers=$WORKERS"
                 exit 0
                 ;;
             *)
@@ -41,7 +57,24 @@ parse_arguments() {
         esac
     done
 
-    echo "Parsed arguments: mock=$MOCK, env=$ENV"
+    echo "Parsed arguments: mock=$MOCK, env=$ENV, workers=$WORKERS"
+}
+
+# In prod, the backend serves a frontend built once by
+# hosebeast-build-frontend, so boot doesn't wait minutes for a rebuild
+web_command() {
+    if [[ "$ENV" == "prod" ]]; then
+        echo "HOSEBEAST_FRONTEND=frontend_build uv run reflex run --env prod --backend-only"
+    else
+        echo "uv run reflex run --env dev"
+    fi
+}
+
+build_frontend_if_needed() {
+    if [[ "$ENV" == "prod" && ( "$REBUILD" == 1 || ! -d frontend_build ) ]]; then
+        echo "Building the frontend; this takes a few minutes on a Pi..."
+        uv run hosebeast-build-frontend || exit 1
+    fi
 }
 
 # Function to check and attach to tmux session
@@ -54,9 +87,17 @@ attach_or_start_hosebeast() {
         # Create a new tmux session named "hosebeast", start the application, and attach to it
         echo "Starting Hosebeast in a new tmux session..."
         export HOSEBEAST_MOCK=$MOCK
-        tmux new-session -d -s hosebeast
+        export HOSEBEAST_CONTROLLER=hosebeast-controller.sock
+        # Reflex reads this; with more than one worker, sessions are kept
+        # in hosebeast-state.db (or Redis, if REDIS_URL is set)
+        export GUNICORN_WORKERS=$WORKERS
+        # The controller owns the sensor and pumps in its own window, so
+        # reloading or restarting the web app never interrupts watering
+        tmux new-session -d -s hosebeast -n controller
         sleep 0.4 
-        tmux send-keys -t hosebeast "uv run reflex run --env $ENV" C-m
+        tmux send-keys -t hosebeast:controller "uv run hosebeast-controller" C-m
+        tmux new-window -t hosebeast -n web
+        tmux send-keys -t hosebeast:web "$(web_command)" C-m
         tmux attach -t hosebeast
     fi    
     # Note: The script will end here when the tmux session is detached
@@ -70,6 +111,7 @@ main() {
     # echo "Arguments passed to script: $@"
     parse_arguments "$@"
     cd $HOME/dev/hosebeast
+    build_frontend_if_needed
     attach_or_start_hosebeast
 }
 